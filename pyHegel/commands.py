@@ -34,6 +34,7 @@ import re
 import string
 import sys
 import textwrap
+import json
 import threading
 import operator
 import numpy as np
@@ -48,6 +49,7 @@ from . import instruments_base
 #from . import local_config
 from . import util
 from . import config
+from . import container
 from . import gui_tools
 
 local_config = config.load_local_config()
@@ -60,9 +62,9 @@ from .comp2to3 import is_py3, warn_deprecation, comp_execfile, reload, string_ty
                         StringIO, open_utf8, fu, builtins_set
 
 __all__ = ['collect_garbage', 'traces', 'instruments', 'instruments_base', 'instruments_registry',
-           'util', 'help_pyHegel', 'reset_pyHegel', 'clock', 'sweep', 'sweep_multi', 'wait',
+           'util', 'help_pyHegel', 'reset_pyHegel', 'clock', 'sweep', 'sweep_multi', 'sweep_adaptive', 'sweep_estimate', 'wait',
            'readfile', '_readfile_lastnames', '_readfile_lastheaders', '_readfile_lasttitles',
-           'set', 'move', 'copy', 'spy', 'snap', 'record', 'trace', 'scope',
+           'set', 'move', 'copy', 'spy', 'snap', 'record', 'trace', 'scope', 'timing',
            '_process_filename', 'get', 'setget', 'getasync', 'make_dir',
            'iprint', 'ilist', 'dlist', 'find_all_instruments', 'checkmode', 'check',
            'batch', 'sleep', 'load', 'load_all_usb', 'load_all_gpib', 'test_gpib_srq_state',
@@ -520,13 +522,85 @@ def _dev_filename(root, dev_name, npts, reuse, append=False):
     n = int(np.log10(maxn))+1
     return root + '_'+ dev_name+'_%0'+('%ii'%n)+ext
 
-def _readall(devs, formats, i, async_st=None, noflat=False, extra_kw={}, output_full=False):
+def _batch_gets(devs, formats, extra_kw={}):
+    """
+    Finds the runs of consecutive devices of the same instrument that can be read
+    with a single request (instruments with _batch_get_sep set and batch_en True,
+    see visaInstrument.batch_get).
+    Returns a dict of the index of the first entry of a run: run (list of (index, dev, options))
+    The gets are done with _batch_gets_do so the order is kept.
+    """
+    runs = []
+    current = None
+    for j, (dev, fmt) in enumerate(zip(devs, formats)):
+        dev, kwarg = _get_dev_kw(dev, **extra_kw)
+        instr = None
+        if (not fmt['file'] and isinstance(dev, instruments_base.scpiDevice) and
+                getattr(dev.instr, '_batch_get_sep', None) is not None and dev.instr.batch_en):
+            instr = dev.instr
+        if current is not None and instr is not None and current[0] == instr:
+            current[1].append((j, dev, kwarg))
+            continue
+        current = None
+        if instr is not None:
+            current = (instr, [(j, dev, kwarg)])
+            runs.append(current)
+    return {run[0][0]: run for instr, run in runs if len(run) > 1}
+
+def _batch_gets_do(run):
+    """
+    Does the gets of a run from _batch_gets.
+    Returns a dict of index: value
+    """
+    instr = run[0][1].instr
+    vals = instr.batch_get([(dev, kwarg) for j, dev, kwarg in run])
+    return {j: val for (j, dev, kwarg), val in zip(run, vals)}
+
+def _batch_sets(entries):
+    """
+    entries is a list of (index, dev, value, options) in the order they need to be set.
+    Finds the runs of consecutive entries of the same instrument that can be set
+    with a single write (instruments with _batch_set_sep set and batch_en True,
+    see visaInstrument.batch_set).
+    Returns a dict of the index of the first entry of a run: run (list of entries)
+    The sets are done with _batch_sets_do so the order is kept.
+    """
+    runs = []
+    current = None
+    for j, dev, v, dev_opt in entries:
+        instr = None
+        if (isinstance(dev, instruments_base.scpiDevice) and
+                getattr(dev.instr, '_batch_set_sep', None) is not None and dev.instr.batch_en):
+            instr = dev.instr
+        if current is not None and instr is not None and current[0] == instr:
+            current[1].append((j, dev, v, dev_opt))
+            continue
+        current = None
+        if instr is not None:
+            current = (instr, [(j, dev, v, dev_opt)])
+            runs.append(current)
+    return {run[0][0]: run for instr, run in runs if len(run) > 1}
+
+def _batch_sets_do(run):
+    """
+    Does the sets of a run from _batch_sets.
+    Returns a dict of index: cache value after the set
+    """
+    instr = run[0][1].instr
+    vals = instr.batch_set([(dev, v, dev_opt) for j, dev, v, dev_opt in run])
+    return {j: val for (j, dev, v, dev_opt), val in zip(run, vals)}
+
+def _readall(devs, formats, i, async_st=None, noflat=False, extra_kw={}, output_full=False, pipeline=None):
     if devs == []:
         if output_full:
             return [], []
         return []
     ret = [None]*len(devs)
     ret_full = [None]*len(devs)
+    batched = {}
+    batch_runs = {}
+    if async_st is None:
+        batch_runs = _batch_gets(devs, formats, extra_kw)
     for j, (dev, fmt) in enumerate(zip(devs, formats)):
         dev, kwarg = _get_dev_kw(dev, **extra_kw)
         filename = fmt['basename']
@@ -544,6 +618,10 @@ def _readall(devs, formats, i, async_st=None, noflat=False, extra_kw={}, output_
                 val = dev.getasync(async_st=3, **kwarg)
             if async_st != 2:
                 continue
+        elif j in batched or j in batch_runs:
+            if j in batch_runs:
+                batched.update(_batch_gets_do(batch_runs[j]))
+            val = batched[j]
         else:
             val = dev.get(**kwarg)
         val_full = val
@@ -558,7 +636,14 @@ def _readall(devs, formats, i, async_st=None, noflat=False, extra_kw={}, output_
                 if isinstance(val, dict):
                     val = list(val.values())
                 if not isinstance(fmt['multi'], list):
-                    instruments_base._write_dev(val, filename, format=fmt, first= i==0)
+                    if pipeline is None:
+                        to = instruments_base.timing_stats.enabled and time.time()
+                        instruments_base._write_dev(val, filename, format=fmt, first= i==0)
+                        if to:
+                            instruments_base.timing_stats.add(dev, 'dev_write', time.time()-to)
+                    else:
+                        pipeline.submit(instruments_base._write_dev, _pipeline_copy(val), filename,
+                                        _pipeline_format(fmt, i==0), i==0, op='dev_write')
                     val = i
         ret[j] = val
         ret_full[j] = val_full
@@ -568,11 +653,11 @@ def _readall(devs, formats, i, async_st=None, noflat=False, extra_kw={}, output_
         return ret, ret_full
     return ret
 
-def _readall_async(devs, formats, i, noflat=False, extra_kw={}, output_full=False):
+def _readall_async(devs, formats, i, noflat=False, extra_kw={}, output_full=False, pipeline=None):
     try:
         _readall(devs, formats, i, async_st=0, noflat=noflat, extra_kw=extra_kw, output_full=output_full)
         _readall(devs, formats, i, async_st=1, noflat=noflat, extra_kw=extra_kw, output_full=output_full)
-        return _readall(devs, formats, i, async_st=2, noflat=noflat, extra_kw=extra_kw, output_full=output_full) # includes async3
+        return _readall(devs, formats, i, async_st=2, noflat=noflat, extra_kw=extra_kw, output_full=output_full, pipeline=pipeline) # includes async3
     except KeyboardInterrupt:
         print('Rewinding async because of keyboard interrupt')
         _readall(devs, formats, i, async_st=-1, noflat=noflat, extra_kw=extra_kw, output_full=output_full)
@@ -582,6 +667,197 @@ def _checkTracePause(trace):
     while trace.pause_enabled:
         wait(.1)
 
+def _pipeline_copy(val):
+    # devices with reuse_buffer can return views that get overwritten by the
+    # next read, so the data handed over to the pipeline needs its own copy.
+    if isinstance(val, np.ndarray):
+        return val.copy()
+    if isinstance(val, (list, tuple)):
+        return [_pipeline_copy(v) for v in val]
+    return val
+
+def _atomic_write(filename, text):
+    # write to a temporary file and then rename it, so that filename is always complete.
+    tmp = filename+'.tmp'
+    with open_utf8(tmp, 'w') as f:
+        f.write(fu(text))
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        replace = os.replace
+    except AttributeError: # python 2
+        if os.path.exists(filename):
+            os.remove(filename)
+        replace = os.rename
+    replace(tmp, filename)
+
+def _json_val(v):
+    if isinstance(v, (np.ndarray, np.generic)):
+        return v.tolist()
+    return repr(v)
+
+class _SweepCheckpoint(object):
+    """
+    Keeps the state of a sweep_multi in the file filename+CHECKPOINT_EXT
+    (json) so it can be resumed after a crash.
+    mark is called after every completed point: it flushes the data file and
+    records its size and the size of the append device files (and the set values).
+    The state is saved to the checkpoint file when interval s have passed since
+    the last save and with save (at the end of the sweep).
+    The state contains:
+       filename:    the main data file
+       completed:   the number of points completed (the index of the next point)
+       set_values:  the values of the last completed point.
+       offsets:     dict of filename: size at the end of the last completed point
+       next_file_i: the sweep.next_file_i value
+       signature:   parameters of the sweep that need to be the same to resume.
+    """
+    CHECKPOINT_EXT = '.ckpt'
+    def __init__(self, f, formats, interval, state):
+        self.f = f
+        self.append_files = []
+        for fmt in formats:
+            if fmt.get('append', False) and fmt.get('container', None) is None:
+                basename = fmt['basename']
+                bin = fmt['bin']
+                if bin and bin != '.ext':
+                    basename = instruments_base._replace_ext(basename, bin)
+                self.append_files.append(basename)
+        self.interval = interval
+        self.filename = self.get_filename(state['filename'])
+        self.state = state
+        self._saved = None
+        self._last_save = time.time()
+    @classmethod
+    def get_filename(cls, filename):
+        """ filename is the data file or the checkpoint file """
+        if filename.endswith(cls.CHECKPOINT_EXT):
+            return filename
+        return filename + cls.CHECKPOINT_EXT
+    @classmethod
+    def load(cls, filename):
+        filename = cls.get_filename(filename)
+        if not os.path.isfile(filename):
+            raise ValueError('No checkpoint file found (%s). Was the sweep already completed?'%filename)
+        with open_utf8(filename, 'r') as f:
+            return json.loads(f.read())
+    @staticmethod
+    def truncate_files(offsets):
+        """ Bring back the files to their state at the checkpoint. """
+        for fn, size in offsets.items():
+            if not os.path.isfile(fn):
+                if size == 0:
+                    continue
+                raise ValueError('The file %s from the checkpoint is missing.'%fn)
+            if os.path.getsize(fn) < size:
+                raise ValueError('The file %s is shorter than it was at the checkpoint.'%fn)
+            with open(fn, 'r+b') as f:
+                f.truncate(size)
+    def mark(self, completed, set_values):
+        self.f.flush()
+        offsets = {self.f.name: os.path.getsize(self.f.name)}
+        for fn in self.append_files:
+            offsets[fn] = os.path.getsize(fn) if os.path.isfile(fn) else 0
+        self.state = dict(self.state, completed=completed, offsets=offsets,
+                          set_values=[_json_val(v) for v in set_values])
+        if time.time() - self._last_save >= self.interval:
+            self.save()
+    def save(self):
+        if self.state is self._saved or 'completed' not in self.state:
+            return
+        _atomic_write(self.filename, json.dumps(self.state, indent=1))
+        self._saved = self.state
+        self._last_save = time.time()
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+def _pipeline_format(fmt, first):
+    # header functions can talk to the instrument, so evaluate them here
+    # (in the main thread) instead of in the pipeline thread.
+    if callable(fmt['header']) and not fmt['bin'] and (first or not fmt['append']):
+        fmt = dict(fmt, header=instruments_base._get_conf_header(fmt))
+    return fmt
+
+class _SweepOutputPipeline(object):
+    """
+    Consumer thread used by the pipelined sweep mode. The functions submitted
+    (file writes) are executed in order on the background thread, while the
+    trace updates (which need to stay on the main thread because of Qt) are
+    kept pending and performed during the next settle wait.
+    The queue is bounded so a slow disk will eventually throttle the sweep
+    instead of accumulating data in memory.
+    An exception in the consumer is raised again in the main thread on the
+    following submit (or on close). After an error the remaining writes are skipped.
+    """
+    def __init__(self, maxsize=16, timing_obj=None):
+        self._queue = instruments_base.queue.Queue(maxsize)
+        self._error = None
+        self._timing_obj = timing_obj
+        self._pending_trace = None
+        self._thread = threading.Thread(target=self._run, name='sweep output pipeline')
+        self._thread.daemon = True
+        self._thread.start()
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            func, args, op = item
+            to = instruments_base.timing_stats.enabled and time.time()
+            try:
+                func(*args)
+            except Exception as exc:
+                self._error = exc
+            if to and op is not None:
+                instruments_base.timing_stats.add(self._timing_obj, op, time.time()-to)
+            item = func = args = None
+    def _check_error(self):
+        if self._error is not None:
+            exc = self._error
+            self._error = None
+            raise exc
+    def submit(self, func, *args, **kwargs):
+        """ kwargs can only be op, which is the name used in timing_stats. """
+        self._check_error()
+        item = (func, args, kwargs.pop('op', None))
+        try:
+            self._queue.put_nowait(item)
+        except instruments_base.queue.Full:
+            to = instruments_base.timing_stats.enabled and time.time()
+            self._queue.put(item)
+            if to:
+                instruments_base.timing_stats.add(self._timing_obj, 'pipeline_full', time.time()-to)
+    def set_trace_update(self, func, *args):
+        self.flush_trace()
+        self._pending_trace = (func, args)
+    def flush_trace(self):
+        pending = self._pending_trace
+        if pending is not None:
+            self._pending_trace = None
+            to = instruments_base.timing_stats.enabled and time.time()
+            pending[0](*pending[1])
+            if to:
+                instruments_base.timing_stats.add(self._timing_obj, 'trace_update', time.time()-to)
+    def close(self, raise_error=True):
+        """ Waits for all the submitted operations to be completed. """
+        if self._thread is None:
+            return
+        try:
+            self.flush_trace()
+        except Exception:
+            # when already handling an exception, don't mask it.
+            if raise_error:
+                raise
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if raise_error:
+            self._check_error()
+
 
 
 #
@@ -682,6 +958,21 @@ def _write_comment(f, text):
     # This is the new way.
     writevec(f, [_rm_nl_cr(fu(text))], pre_str=u'#C:%r# '%time.time())
 
+def _open_data_file(filename, mode, formats):
+    """ Opens the main data file. For a binary container (filename with the
+        container.CONTAINER_EXT extension), the device data of formats is also
+        saved in it instead of separate files.
+    """
+    if not container.is_container(filename):
+        for fmt in formats:
+            fmt.pop('container', None)
+        return open_utf8(filename, mode, 1)
+    f = container.ContainerWriter(filename, mode)
+    for fmt in formats:
+        if 'basename' in fmt:
+            fmt['container'] = f
+    return f
+
 class Loop_Control(object):
     def __init__(self):
         self.reset_all()
@@ -693,7 +984,7 @@ class Loop_Control(object):
         self.reset()
         self.pause_enabled = False
 
-def _handle_async_en(self, async_en, **kwargs):
+def _handle_async_en(async_en, kwargs):
     async_en2 = kwargs.pop('async', None)
     if async_en2:
         if is_py3:
@@ -705,6 +996,99 @@ def _handle_async_en(self, async_en, **kwargs):
     return async_en
 
 
+def _adaptive_loss(x, y, curvature=1.):
+    """
+    x is the sorted positions (n) and y the values (ncols, n), both scaled
+    so the full range is about 1.
+    Returns the loss of every interval (n-1): the length of the segment in
+    the scaled x-y plane plus curvature times the square root of the area of the
+    triangles the interval forms with its neighboring points (the largest among the columns).
+    """
+    dx = np.diff(x)
+    dy = np.diff(y, axis=-1)
+    loss = np.sqrt(dx**2 + dy**2).max(axis=0)
+    if curvature and len(x) > 2:
+        area = 0.5*np.abs(dx[:-1]*dy[:, 1:] - dx[1:]*dy[:, :-1]).max(axis=0)
+        tri = np.zeros(len(x))
+        tri[1:-1] = area
+        loss = loss + curvature*np.sqrt(tri[:-1] + tri[1:])
+    return loss
+
+
+def _adaptive_next(xs, ys, curvature=1., tol=0.01, min_dx=1e-4):
+    """
+    xs is the list of scaled positions (between 0 and 1) and ys the list
+    of values (a list of the graphed values for every point).
+    Returns the scaled position of the next point (the middle of the interval
+    with the largest loss) or None when all the losses are below tol.
+    The intervals smaller than 2*min_dx are not split.
+    """
+    order = np.argsort(xs, kind='mergesort')
+    x = np.asarray(xs, dtype=float)[order]
+    y = np.array(ys, dtype=float).reshape((len(xs), -1))[order].T
+    y[~np.isfinite(y)] = np.nan
+    with warnings.catch_warnings():
+        # all nan columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        yrange = np.nanmax(y, axis=1) - np.nanmin(y, axis=1)
+    yrange[~(yrange > 0)] = 1.
+    y = np.nan_to_num(y/yrange[:, np.newaxis])
+    loss = _adaptive_loss(x, y, curvature)
+    loss[np.diff(x) < 2*min_dx] = 0.
+    k = np.argmax(loss)
+    if loss[k] < tol or loss[k] == 0:
+        return None
+    return (x[k] + x[k+1])/2.
+
+
+def _estimate_schedule(spans, updown, both_updown, parallel, beforewait, first_wait):
+    """
+    Counts the operations of a sweep_multi (the spans include the updown effect).
+    Returns the number of points, the number of sets and the distance traveled
+    (the sum of the absolute changes) for every device and the total of the waits.
+    The waits use the same rules as sweep_multi (the max over the changed devices and
+    first_wait for the jumps) except that the jumps of updown 'alternate' are neglected.
+    """
+    nptsl = [len(s) for s in spans]
+    travels = [float(np.sum(np.abs(np.diff(np.asarray(s, dtype=float))))) for s in spans]
+    if parallel:
+        npts_total = nptsl[0]
+        nsets = [npts_total]*len(spans)
+        wait_total = max(first_wait) + (npts_total-1)*max(beforewait)
+        return npts_total, nsets, travels, wait_total
+    restart_wait = []
+    for k, (bw, fw, bu, ud) in enumerate(zip(beforewait, first_wait, both_updown, updown)):
+        restart_wait.append(bw if bu or (ud == 'alternate' and k > 0) else fw)
+    nsets = []
+    wait_total = max(first_wait)
+    npass = 1
+    for k, n in enumerate(nptsl):
+        nsets.append(npass*n)
+        if updown[k] == 'alternate' and k > 0:
+            jump = 0.
+        else:
+            jump = abs(float(spans[k][-1]) - float(spans[k][0]))
+        travels[k] = npass*travels[k] + (npass-1)*jump
+        # points where k is the slowest changing device (the faster ones restart)
+        wait_total += (npass*n - npass)*max([beforewait[k]] + restart_wait[k+1:])
+        npass *= n
+    return npass, nsets, travels, wait_total
+
+
+def _estimate_time(func, ncal):
+    """ Returns the mean time of ncal calls to func """
+    to = time.time()
+    for i in range(ncal):
+        func()
+    return (time.time() - to)/ncal
+
+
+def _format_duration(t):
+    m, s = divmod(t, 60)
+    h, m = divmod(int(m), 60)
+    return '%i:%02i:%04.1f'%(h, m, s)
+
+
 class _Sweep(instruments.BaseInstrument):
     # This MemoryDevice will be shared among different instances
     # So there should only be one instance of this class
@@ -826,6 +1210,22 @@ class _Sweep(instruments.BaseInstrument):
        The parameter can also be None. In that case a single file is saved containing
        both the up and down sweep.
     """)
+    pipeline = instruments.MemoryDevice(False, choices=[True, False], doc="""
+       When True, the sweeps are pipelined: the writing of the data file,
+       of the per point device files and the graph update are done while
+       the next point is being set and is waiting (beforewait).
+       The file writing is performed in a background thread (in order) and the
+       graph update is delayed until the next point. The files are the same as
+       without pipelining. However, the files of a point might not be written
+       yet when the after function (exec_after) is called.
+       It is the default value for the pipeline option of sweep and sweep_multi.
+    """)
+    _pipeline_maxsize = 16
+    checkpoint = instruments.MemoryDevice(None, doc="""
+       When set to a time in s, sweep_multi saves its state (in the data filename+'.ckpt')
+       at that interval so it can be resumed (see the resume option of sweep_multi).
+       None or False disables it. It is the default value for the checkpoint option of sweep_multi.
+    """)
     next_file_i = instruments.MemoryDevice(0,doc="""
     This number is used, and incremented automatically when {next_i:02} is used (for 00 to 99).
      {next_i:03}  is used for 000 to 999, etc
@@ -878,6 +1278,18 @@ class _Sweep(instruments.BaseInstrument):
     def init(self, full=False):
         self._sweep_trace_num = 0
         self._lastnames = []
+        # checkpoint filename of the last sweep_multi (for resume=True)
+        self._last_checkpoint = None
+        # timing statistics of the last sweep (when instruments_base.timing_stats is enabled)
+        # see the timing function.
+        self.last_timing = None
+    def _timing_start(self):
+        if instruments_base.timing_stats.enabled:
+            return instruments_base.timing_stats.snapshot()
+        return None
+    def _timing_end(self, start):
+        if start is not None:
+            self.last_timing = instruments_base.timing_diff(instruments_base.timing_stats.snapshot(), start)
     def _current_config(self, dev_obj=None, options={}):
         return self._conf_helper('before', 'after', 'beforewait')
     def __repr__(self):
@@ -998,6 +1410,17 @@ class _Sweep(instruments.BaseInstrument):
             t.set_xlogscale()
         return t, gsel
 
+    def _start_pipeline(self, pipeline):
+        if pipeline is None:
+            pipeline = self.pipeline.get()
+        if pipeline:
+            return _SweepOutputPipeline(self._pipeline_maxsize, timing_obj=self)
+        return None
+    def _comment_func(self, f, pipe):
+        if pipe is None:
+            return lambda text: _write_comment(f, text)
+        return lambda text: pipe.submit(_write_comment, f, text)
+
     def _do_inner_loop(self, iter_info, sets, devs, cformats, fobj, async_en, trace_obj, negative, gsel, clf=False, printit=False, other_options={}):
         # iter_n is used for filenames and exec_before/after (could depend on separate fwd/rev files)
         # iter_partial between 1 and iter_total: they are both used for progress update.
@@ -1008,15 +1431,26 @@ class _Sweep(instruments.BaseInstrument):
         other_options = other_options.copy()
         other_options.update(iter_info=iter_info)
         loop_control = other_options.get('loop_control', None)
+        pipeline = other_options.get('pipeline', None)
+        # row_func(iv, vals) receives the set and read values of the point
+        row_func = other_options.get('row_func', None)
         tme = clock.get()
         vv = []
         iv = []
         bwait = 0.
         next_set_cache = []
-        for dev, dev_opt, v, beforewait, doset, count, prev_set_cache in zip(*sets):
+        batch_runs = _batch_sets([(j, dev, v, dev_opt) for j, (dev, dev_opt, v, doset) in
+                                    enumerate(zip(sets[0], sets[1], sets[2], sets[4])) if doset])
+        batched = {}
+        for j, (dev, dev_opt, v, beforewait, doset, count, prev_set_cache) in enumerate(zip(*sets)):
             vv.append(v)
             if doset:
-                val = dev.set_ret_cache(v, **dev_opt) # TODO replace with move
+                if j in batch_runs:
+                    batched.update(_batch_sets_do(batch_runs[j]))
+                if j in batched:
+                    val = batched[j]
+                else:
+                    val = dev.set_ret_cache(v, **dev_opt) # TODO replace with move
                 bwait = max(bwait, beforewait)
             else:
                 # Recall previous value
@@ -1031,15 +1465,29 @@ class _Sweep(instruments.BaseInstrument):
         sets[-1] = next_set_cache
         if printit:
             printit('Sweep part: %3i/%-3i   %s'%(iter_part, iter_total, vv))
+        if pipeline is not None:
+            # the previous point trace update is done within the settle time.
+            tset = time.time()
+            pipeline.flush_trace()
+            bwait = max(0., bwait - (time.time()-tset))
         self.execbefore(iter_n, cfwd, v, vv, iv, other_options)
         wait(bwait)
         if async_en:
-            vals, vals_full = _readall_async(devs, cformats, iter_n, output_full=True)
+            vals, vals_full = _readall_async(devs, cformats, iter_n, output_full=True, pipeline=pipeline)
         else:
-            vals, vals_full = _readall(devs, cformats, iter_n, output_full=True)
+            vals, vals_full = _readall(devs, cformats, iter_n, output_full=True, pipeline=pipeline)
         self.execafter(iter_n, cfwd, v, vv, iv, iv+vals+[tme], vals, vals_full, other_options)
+        if row_func is not None:
+            row_func(iv, vals)
+        to = instruments_base.timing_stats.enabled and time.time()
         if fobj:
-            writevec(fobj, iv+vals+[tme])
+            if pipeline is not None:
+                pipeline.submit(writevec, fobj, iv+vals+[tme], op='file_write')
+            else:
+                writevec(fobj, iv+vals+[tme])
+                if to:
+                    instruments_base.timing_stats.add(self, 'file_write', time.time()-to)
+                    to = time.time()
         if trace_obj is not None:
             giv = iv[-count] # use the first value of the last set device
             gvals = gsel(iv+vals)
@@ -1049,9 +1497,15 @@ class _Sweep(instruments.BaseInstrument):
                 ivn[-1] = giv
                 gvals = gsel(ivn+vals)
             if clf:
-                trace_obj.setPoints([giv], np.array([gvals]).T)
+                trace_args = (trace_obj.setPoints, [giv], np.array([gvals]).T)
             else:
-                trace_obj.addPoint(giv, gvals)
+                trace_args = (trace_obj.addPoint, giv, gvals)
+            if pipeline is not None:
+                pipeline.set_trace_update(*trace_args)
+            else:
+                trace_args[0](*trace_args[1:])
+                if to:
+                    instruments_base.timing_stats.add(self, 'trace_update', time.time()-to)
             _checkTracePause(trace_obj)
             if trace_obj.abort_enabled:
                 return 'break'
@@ -1066,7 +1520,7 @@ class _Sweep(instruments.BaseInstrument):
     def __call__(self, dev, start, stop=None, npts=None, filename='%T.txt', rate=None,
                   close_after=False, graph=None, title=None, out=None, extra_conf=None,
                   async_en=False, reset=False, logspace=False, updown=False, first_wait=None, beforewait=None,
-                  progress=True, exec_before=None, exec_after=None, loop_control=None, **kwargs):
+                  progress=True, exec_before=None, exec_after=None, loop_control=None, pipeline=None, **kwargs):
         """
             Usage:
                 dev is the device to sweep. For more advanced uses (devices with options),
@@ -1097,7 +1551,10 @@ class _Sweep(instruments.BaseInstrument):
                       is always combined with the path device.
                       The global variable sweep._lastnames is a list of the last
                       filenames used.
-                rate: unused
+                      With the .phc extension, all the data (including the data of the
+                      devices that would go in separate files) is saved in a single binary
+                      container file (see the container module). It is read with util.readfile.
+                rate: unused by the sweep (sweep.estimate uses it to add the ramp times)
                 close_after: automatically closes the figure after the sweep when True
                 graph: If graph is True, a figure is plotted while taking data. When
                        False no figure is created. If graph is None (default) the value
@@ -1142,9 +1599,13 @@ class _Sweep(instruments.BaseInstrument):
                 loop_control: pass an instance of Loop_Control. You can then pause/abort by changing its attributes
                               pause_enabled, abort_enabled
                               (useful in GUI or background sweep)
+                pipeline: when True, the file writing and graph updates overlap with the next point.
+                          When None (default) the value from the sweep.pipeline device is used.
+                          See the sweep.pipeline device for more details.
                 The time column in the file is seconds since the epoch and represents the time at the
                 start of the current point (just before doing the set). See time.ctime to convert it to
                 text.
+                To predict how long a sweep will take, call sweep.estimate with the same parameters.
             SEE ALSO the sweep devices: before, after, beforewait, graph.
         """
         span, start, stop, npts, dev_orig, dev, dev_opt, negative = self._find_span(dev, logspace, start, stop, npts)
@@ -1177,16 +1638,19 @@ class _Sweep(instruments.BaseInstrument):
             t, gsel = self._init_graph(title, filename, hdrs, 0, span, graphsel, logspace, negative, title_pre='Sweep: ', wait_time=beforewait)
         else:
             t = gsel = None
+        timing_start = self._timing_start()
+        pipe = None
         try:
             f = None
             frev = None
+            pipe = self._start_pipeline(pipeline)
             if filename is not None:
-                f = open_utf8(fullpath, 'w', 1)
+                f = _open_data_file(fullpath, 'w', formats)
                 _write_conf(f, formats, extra_base='sweep_options', async_en=async_en, reset=reset_raw, start=start, stop=stop,
                             updown=updown, beforewait=beforewait, first_wait=first_wait)
                 writevec(f, hdrs+['time'], pre_str='#')
                 if fullpathrev is not None:
-                    frev = open_utf8(fullpathrev, 'w', 1)
+                    frev = _open_data_file(fullpathrev, 'w', formatsrev)
                     _write_conf(frev, formatsrev, extra_base='sweep_options', async_en=async_en, reset=reset_raw, start=start, stop=stop,
                                 updown=updown, beforewait=beforewait, first_wait=first_wait)
                     writevec(frev, hdrs+['time'], pre_str='#')
@@ -1208,7 +1672,7 @@ class _Sweep(instruments.BaseInstrument):
                     cycle_list = [(True, f, formats), (False, frev, formatsrev)]
                 for cfwd, cf, cformats in cycle_list:
                     if graph and cf:
-                        t_proxy.set_comment_func(lambda text: _write_comment(cf, text))
+                        t_proxy.set_comment_func(self._comment_func(cf, pipe))
                     cycle_span = span
                     if not cfwd: # doing reverse
                         cycle_span = span[::-1]
@@ -1232,11 +1696,13 @@ class _Sweep(instruments.BaseInstrument):
                 progress = instruments_base.mainStatusLine.new(timed=True)
             if loop_control:
                 loop_control.reset()
-            other_options = dict(before=exec_before, after=exec_after, loop_control=loop_control)
+            other_options = dict(before=exec_before, after=exec_after, loop_control=loop_control, pipeline=pipe)
             for iter_info, cf, cformats, sets, clf in iterator():
                 dobreak = self._do_inner_loop(iter_info, sets, devs, cformats, cf, async_en, t, negative, gsel, clf, progress, other_options)
                 if dobreak == 'break':
                     break
+            if pipe is not None:
+                pipe.close()
         except KeyboardInterrupt:
             #(exc_type, exc_value, exc_traceback) = sys.exc_info()
             #raise KeyboardInterrupt('Interrupted sweep'), None, exc_traceback
@@ -1251,12 +1717,16 @@ class _Sweep(instruments.BaseInstrument):
                 # but it contains progress. So for while, old status report will be kept around.
                 progress.remove()
                 del progress
+            if pipe is not None:
+                # wait for the already acquired data to be written.
+                pipe.close(raise_error=False)
             if graph:
                 t.set_comment_func(None)
             if f:
                 f.close()
             if fullpathrev is not None and frev:
                 frev.close()
+            self._timing_end(timing_start)
         if graph:
             if t.abort_enabled:
                 t.set_status(False, 'abort')
@@ -1276,7 +1746,8 @@ class _Sweep(instruments.BaseInstrument):
     def sweep_multi(self, dev, start, stop=None, npts=None, filename='%T.txt', rate=None,
                   close_after=False, graph=None, title=None, out=None, extra_conf=None,
                   async_en=False, reset=False, logspace=False, updown=False, first_wait=None, beforewait=None,
-                  progress=True, exec_before=None, exec_after=None, loop_control=None, parallel=False, **kwargs):
+                  progress=True, exec_before=None, exec_after=None, loop_control=None, parallel=False, pipeline=None,
+                  checkpoint=None, resume=False, **kwargs):
         """
         The settings for sweep_multi have the same meaning as for the sweep command (see its documention).
         However, many of the settings now require lists (dev, start, stop, npts, logspace, reset, close_after
@@ -1298,6 +1769,16 @@ class _Sweep(instruments.BaseInstrument):
 
         parallel: when True, all the devs are called for each cycle. All the pts are changed in parallel
             so they need to have the same number of elements.
+        checkpoint: time in s between saves of the sweep state (in the file named like the data file
+            with '.ckpt' added). The data file is flushed after every point. The checkpoint file is removed
+            when the sweep completes. When None (default) the value of the sweep.checkpoint device is used.
+            False disables it.
+        resume: To continue an interrupted sweep_multi that had checkpoint enabled. Call sweep_multi
+            with the same parameters (except filename which is ignored) and resume set to the data
+            filename (or the checkpoint filename) or True for the last checkpoint used.
+            The data files are brought back to their state at the checkpoint, the sweep restarts from the
+            next point (setting all the devices) and continues to append to the same files.
+            The graph only shows the resumed points.
         """
         async_en = _handle_async_en(async_en, kwargs)
         multiN = len(dev)
@@ -1393,12 +1874,41 @@ class _Sweep(instruments.BaseInstrument):
                 data_row_shape = [npts]
         else:
             npts_total = np.asarray(nptsl).prod()
-        # We never use updown filenames in multiN. Everything in one base file.
-        # start, stop and npts are the lists
-        filename, fullpath, fullpathrev, fwd, updown_same = self._get_filenames(filename, False, startl, stopl, npts_total)
+        if checkpoint is None:
+            checkpoint = self.checkpoint.get()
+        resume_state = None
+        if resume:
+            if resume is True:
+                if self._last_checkpoint is None:
+                    raise ValueError('There is no previous checkpoint to resume from.')
+                resume = self._last_checkpoint
+            resume_state = _SweepCheckpoint.load(resume)
+            if checkpoint is None or checkpoint is False:
+                checkpoint = resume_state['interval']
+            fullpath = resume_state['filename']
+            filename = os.path.basename(fullpath)
+            self._lastnames = [fullpath]
+            with self._lock_instrument:
+                self.next_file_i.set(max(self.next_file_i.getcache(), resume_state['next_file_i']))
+        else:
+            # We never use updown filenames in multiN. Everything in one base file.
+            # start, stop and npts are the lists
+            filename, fullpath, fullpathrev, fwd, updown_same = self._get_filenames(filename, False, startl, stopl, npts_total)
         devs = self.get_alldevs(out)
         extra_conf = self._get_extraconf(extra_conf)
         hdrs, graphsel, formats, set_counts = _getheaders(dev_origl, devs, fullpath, npts_total, extra_conf=extra_conf)
+        ckpt_state = None
+        if checkpoint is not None and checkpoint is not False and filename is not None:
+            signature = dict(hdrs=hdrs, spans=[_json_val(np.asarray(sp)) for sp in spans], updown=[repr(u) for u in updown],
+                             parallel=parallel, npts_total=int(npts_total))
+            # go through json to compare with the saved one
+            signature = json.loads(json.dumps(signature))
+            if resume_state is not None and resume_state['signature'] != signature:
+                diff = [k for k in signature if signature[k] != resume_state['signature'].get(k)]
+                raise ValueError('The sweep_multi parameters (%s) are different from the checkpoint ones.'%', '.join(diff))
+            ckpt_state = dict(filename=fullpath, next_file_i=self.next_file_i.getcache(), interval=checkpoint, signature=signature)
+        elif resume_state is not None:
+            raise ValueError('resume needs a filename and checkpoint enabled.')
         if graph is None:
             graph = self.graph.get()
         if graph:
@@ -1408,10 +1918,22 @@ class _Sweep(instruments.BaseInstrument):
             t_proxy = instruments_base.weakref.proxy(t) # needed to allow "del t" below
         else:
             t = gsel = None
+        timing_start = self._timing_start()
+        pipe = None
+        ckpt = None
+        start_i = 0
         try:
             f = None
-            if filename is not None:
-                f = open_utf8(fullpath, 'w', 1)
+            pipe = self._start_pipeline(pipeline)
+            if resume_state is not None:
+                start_i = resume_state['completed']
+                _SweepCheckpoint.truncate_files(resume_state['offsets'])
+                f = _open_data_file(fullpath, 'a', formats)
+                _write_comment(f, u'resumed at point %i'%start_i)
+                if graph:
+                    t.set_comment_func(self._comment_func(f, pipe))
+            elif filename is not None:
+                f = _open_data_file(fullpath, 'w', formats)
                 _write_conf(f, formats, extra_base='sweep_multi_options', async_en=async_en, reset=reset_raw, start=start, stop=stop,
                                 updown=updown, beforewait=beforewait, first_wait=first_wait, parallel=parallel)
                 # This needs to match the line in util.readfile
@@ -1419,7 +1941,7 @@ class _Sweep(instruments.BaseInstrument):
                 writevec(f, [read_dims], pre_str='#')
                 writevec(f, hdrs+['time'], pre_str='#')
                 if graph:
-                    t.set_comment_func(lambda text: _write_comment(f, text))
+                    t.set_comment_func(self._comment_func(f, pipe))
 
             ###############################
             # Start of loop
@@ -1523,11 +2045,28 @@ class _Sweep(instruments.BaseInstrument):
                 progress = instruments_base.mainStatusLine.new(timed=True)
             if loop_control:
                 loop_control.reset()
-            other_options = dict(before=exec_before, after=exec_after, loop_control=loop_control)
+            if ckpt_state is not None:
+                ckpt = _SweepCheckpoint(f, formats, checkpoint, ckpt_state)
+                self._last_checkpoint = ckpt.filename
+            other_options = dict(before=exec_before, after=exec_after, loop_control=loop_control, pipeline=pipe)
             for iter_info, cf, cformats, sets, clf in iterator():
+                i = iter_info[0]
+                if i < start_i:
+                    continue
+                if i == start_i and start_i > 0:
+                    # resuming: set all the devices, with the first_wait
+                    sets[3] = first_wait
+                    sets[4] = [True]*multiN
                 dobreak = self._do_inner_loop(iter_info, sets, devs, cformats, cf, async_en, t, negativel[-1], gsel, clf, progress, other_options)
+                if ckpt is not None:
+                    if pipe is not None:
+                        pipe.submit(ckpt.mark, i+1, sets[2])
+                    else:
+                        ckpt.mark(i+1, sets[2])
                 if dobreak == 'break':
                     break
+            if pipe is not None:
+                pipe.close()
         except KeyboardInterrupt:
             #(exc_type, exc_value, exc_traceback) = sys.exc_info()
             #raise KeyboardInterrupt('Interrupted sweep_multi'), None, exc_traceback
@@ -1542,10 +2081,19 @@ class _Sweep(instruments.BaseInstrument):
                 # but it contains progress. So for while, old status report will be kept around.
                 progress.remove()
                 del progress
+            if pipe is not None:
+                # wait for the already acquired data to be written.
+                pipe.close(raise_error=False)
+            if ckpt is not None:
+                if ckpt.state.get('completed', None) == npts_total:
+                    ckpt.remove()
+                else:
+                    ckpt.save()
             if graph:
                 t.set_comment_func(None)
             if f:
                 f.close()
+            self._timing_end(timing_start)
         if graph:
             if t.abort_enabled:
                 t.set_status(False, 'abort')
@@ -1563,9 +2111,317 @@ class _Sweep(instruments.BaseInstrument):
             t = t.destroy()
             del t
 
+    def sweep_adaptive(self, dev, start, stop=None, npts=11, filename='%T.txt', max_npts=201, tol=0.01,
+                  curvature=1., min_dx=1e-4, close_after=False, graph=None, title=None, out=None, extra_conf=None,
+                  async_en=False, reset=False, logspace=False, first_wait=None, beforewait=None,
+                  progress=True, exec_before=None, exec_after=None, loop_control=None, pipeline=None, **kwargs):
+        """
+        This is a sweep that adds points where they are needed.
+        It starts with the points of the normal sweep (start, stop and npts or start as a list
+        of values) which should be a coarse grid. Then it adds points, one at a time, in the
+        middle of the interval with the largest loss. The loss uses the graphed columns (see the
+        graph option of sweep.out) with x (the full span, in log for logspace) and every column
+        (its full range) scaled to 1. It is the length of the interval segment plus curvature times
+        the square root of the area of the triangles the segment forms with its neighboring points.
+        So points are added where the values change the fastest or where the curvature is largest.
+        It stops after max_npts points or when all the losses are below tol.
+        Intervals smaller than 2*min_dx (scaled like x) are not split.
+        The rows are saved in acquisition order (they are not sorted) with the set value in the
+        first column. The graph shows the sorted points.
+        The other options are the same as for sweep (see its documention).
+        """
+        span, start, stop, npts, dev_orig, dev, dev_opt, negative = self._find_span(dev, logspace, start, stop, npts)
+        async_en = _handle_async_en(async_en, kwargs)
+        if beforewait is None:
+            beforewait = self.beforewait.get()
+        if first_wait is None:
+            first_wait = 0.
+        max_npts = max(int(max_npts), len(span))
+        if checkmode():
+            max_npts = len(span)
+        reset_raw = reset
+        if isinstance(reset, bool):
+            if reset:
+                reset = span[0] # return to first value
+            else:
+                reset = None
+        sign = -1. if negative else 1.
+        if logspace:
+            xspan = np.log(sign*span)
+        else:
+            xspan = span
+        xmin = np.min(xspan)
+        xrange = np.max(xspan) - xmin
+        if not xrange > 0:
+            raise ValueError('sweep_adaptive needs at least 2 different values.')
+        def to_scaled(v):
+            if logspace:
+                v = np.log(sign*v)
+            return (v - xmin)/xrange
+        def from_scaled(u):
+            v = xmin + u*xrange
+            if logspace:
+                v = sign*np.exp(v)
+            return v
+        filename, fullpath, fullpathrev, fwd, updown_same = self._get_filenames(filename, False, start, stop, max_npts)
+        devs = self.get_alldevs(out)
+        extra_conf = self._get_extraconf(extra_conf)
+        hdrs, graphsel, formats, set_counts = _getheaders(dev_orig, devs, fullpath, max_npts, extra_conf=extra_conf)
+        if len(graphsel) == 0:
+            raise ValueError('sweep_adaptive needs at least one graphed column in the out devices.')
+        gsel = _itemgetter(*graphsel)
+        if graph is None:
+            graph = self.graph.get()
+        if graph:
+            t, gsel = self._init_graph(title, filename, hdrs, 0, span, graphsel, logspace, negative, title_pre='Sweep_adaptive: ', wait_time=beforewait)
+        else:
+            t = None
+        xs = [] # scaled positions
+        vs = [] # set values
+        ys = [] # graphed values
+        def row_func(iv, vals):
+            ys.append(gsel(iv+vals))
+        timing_start = self._timing_start()
+        pipe = None
+        try:
+            f = None
+            pipe = self._start_pipeline(pipeline)
+            if filename is not None:
+                f = _open_data_file(fullpath, 'w', formats)
+                _write_conf(f, formats, extra_base='sweep_adaptive_options', async_en=async_en, reset=reset_raw, start=start, stop=stop,
+                            npts=npts, max_npts=max_npts, tol=tol, curvature=curvature, min_dx=min_dx, beforewait=beforewait, first_wait=first_wait)
+                writevec(f, hdrs+['time'], pre_str='#')
+                if graph:
+                    t.set_comment_func(self._comment_func(f, pipe))
+            if progress:
+                progress = instruments_base.mainStatusLine.new(timed=True)
+            if loop_control:
+                loop_control.reset()
+            other_options = dict(before=exec_before, after=exec_after, loop_control=loop_control, pipeline=pipe, row_func=row_func)
+            #dev, dev_opt, v, beforewait, doset, set_counts, prev_set_cache
+            sets = [[dev], [dev_opt], [], [], [True], set_counts, [None]]
+            for i in range(max_npts):
+                if i < len(span):
+                    v = span[i]
+                else:
+                    u = _adaptive_next(xs, ys, curvature, tol, min_dx)
+                    if u is None:
+                        break
+                    v = from_scaled(u)
+                bwait = t.wait_time if graph else beforewait
+                if i == 0:
+                    bwait += first_wait
+                sets[2] = [v]
+                sets[3] = [bwait]
+                cfwd = i == 0 or v >= vs[-1]
+                iter_info = i, i+1, max_npts, cfwd, [cfwd]
+                dobreak = self._do_inner_loop(iter_info, sets, devs, formats, f, async_en, None, negative, gsel, False, progress, other_options)
+                xs.append(to_scaled(v))
+                vs.append(v)
+                if graph:
+                    order = np.argsort(xs, kind='mergesort')
+                    t.setPoints(sign*np.asarray(vs)[order], np.array(ys, dtype=float)[order].T)
+                    _checkTracePause(t)
+                    if t.abort_enabled:
+                        break
+                if dobreak == 'break':
+                    break
+            if pipe is not None:
+                pipe.close()
+        except KeyboardInterrupt:
+            if graph:
+                t.set_status(False, 'ctrl-c')
+            raise KeyboardInterrupt('Interrupted sweep_adaptive').with_traceback(sys.exc_info()[2])
+        finally:
+            if progress and isinstance(progress, instruments_base.UserStatusLine):
+                progress.remove()
+                del progress
+            if pipe is not None:
+                pipe.close(raise_error=False)
+            if graph:
+                t.set_comment_func(None)
+            if f:
+                f.close()
+            self._timing_end(timing_start)
+        if graph:
+            if t.abort_enabled:
+                t.set_status(False, 'abort')
+                raise KeyboardInterrupt('Aborted sweep_adaptive')
+            else:
+                t.set_status(False, 'completed')
+        if reset is not None:
+            dev.set(reset, **dev_opt)
+        if loop_control:
+            if loop_control.abort_enabled:
+                loop_control.abort_completed = True
+            loop_control.finished = True
+        if graph and close_after:
+            t = t.destroy()
+            del t
+
+    def estimate(self, dev, start, stop=None, npts=None, filename=None, rate=None,
+                 close_after=False, graph=None, title=None, out=None, extra_conf=None,
+                 async_en=False, reset=False, logspace=False, updown=False, first_wait=None, beforewait=None,
+                 progress=True, exec_before=None, exec_after=None, loop_control=None, parallel=False, pipeline=None,
+                 checkpoint=None, resume=False, calibrate='auto', ncal=3, as_dict=False, **kwargs):
+        """
+        Predicts the duration of a sweep (or of a sweep_multi when dev is a list) without doing it.
+        The parameters are the same as for sweep and sweep_multi, so a sweep call can be reused.
+        filename, close_after, graph, title, extra_conf, reset, progress, loop_control, checkpoint
+        and resume do not change the estimate. exec_before and exec_after are not timed.
+        With pipeline (None uses the sweep.pipeline device), the file and graph updates overlap
+        with the next point so they are shown but not counted.
+        The cost of every operation (set and get of the devices, the file and graph updates
+        of the sweep) comes from the timing statistics of this session (see the timing function)
+        or from a short calibration.
+        calibrate: 'auto' (default) calibrates the gets that have no statistics, True always
+                   calibrates (the gets and the sets) and False never does (what is unknown then
+                   counts as 0 s).
+                   The calibration does ncal gets of the out devices. Only with True, it also does
+                   ncal sets of the swept devices to their cached values. Those are writes to the
+                   instruments: a stale cache will move them (devices without a cached value are
+                   not calibrated). So by default, set times without statistics are unknown.
+        rate: the ramp rate (in device units per s, a list for sweep_multi) of the swept devices.
+              When given, every change adds abs(change)/rate to the set time.
+        async_en: the instruments are then read in parallel so a point only costs the slowest one.
+                  The time for an instrument includes the trigger to completion time (from the
+                  srq_complete statistics or the calibration of the full async read).
+        as_dict: when True, returns a dictionnary with npts, total, per_point (in s) and breakdown
+                 (a list of dictionnaries with name, operation, count, mean, total, fraction, source
+                 and counted, False for what is hidden by a slower parallel operation) instead of
+                 printing the table (largest first).
+        """
+        async_en = _handle_async_en(async_en, kwargs)
+        if isinstance(dev, list):
+            multiN = len(dev)
+            def mklist(v):
+                v = v if isinstance(v, (list, tuple, np.ndarray)) else [v]*multiN
+                if len(v) != multiN:
+                    raise ValueError('A parameter does not have the correct number of elements')
+                return v
+        else:
+            multiN = 1
+            mklist = lambda v: [v]
+            start = [start]
+        npts = mklist(npts)
+        stop = mklist(stop)
+        logspace = mklist(logspace)
+        updown = mklist(updown)
+        rate = mklist(rate)
+        first_wait = mklist(first_wait)
+        if beforewait is None:
+            beforewait = self.beforewait.get()
+        beforewait = mklist(beforewait)
+        first_wait = [b if f is None else f+b for b, f in zip(beforewait, first_wait)]
+        devl = []
+        dev_optl = []
+        spans = []
+        both_updown = []
+        for idev, ilogspace, istart, istop, inpts, ud in zip(mklist(dev), logspace, start, stop, npts, updown):
+            span, istart, istop, inpts, dev_orig, idev, dev_opt, negative = self._find_span(idev, ilogspace, istart, istop, inpts)
+            if ud == True:
+                span = np.concatenate( (span, span[::-1]) )
+            elif ud == -1:
+                span = span[::-1]
+            devl.append(idev)
+            dev_optl.append(dev_opt)
+            spans.append(span)
+            both_updown.append(ud == True)
+        if parallel and any(len(s) != len(spans[0]) for s in spans):
+            raise ValueError('For parallel, all the npts/updown comnination need to be the same length')
+        if checkmode():
+            # the spans are reduced and nothing can be timed.
+            return None
+        npts_total, nsets, travels, wait_total = _estimate_schedule(spans, updown, both_updown, parallel, beforewait, first_wait)
+        stats = instruments_base.timing_stats.snapshot()
+        skey = instruments_base.timing_stats.key
+        tname = instruments_base._timing_name
+        breakdown = []
+        def add(name, op, count, mean, source, counted=True):
+            breakdown.append(dict(name=name, operation=op, count=count, mean=mean, total=count*mean,
+                                  source=source, counted=counted))
+        def get_mean(obj, op, func=None):
+            # returns mean, source
+            st = stats.get((skey(obj), op))
+            if st is not None and st['count'] and calibrate is not True:
+                return st['mean'], 'stats'
+            if func is not None and calibrate:
+                return _estimate_time(func, ncal), 'calib'
+            return 0., 'unknown'
+        for idev, dev_opt, n, travel, r in zip(devl, dev_optl, nsets, travels, rate):
+            func = None
+            if calibrate is True:
+                # never done by default since it writes to the instrument.
+                cache = idev.getcache()
+                if cache is not None:
+                    func = lambda idev=idev, dev_opt=dev_opt, cache=cache: idev.set(cache, **dev_opt)
+            mean, source = get_mean(idev, 'set', func)
+            add(tname(idev), 'set', n, mean, source)
+            if r:
+                add(tname(idev), 'ramp', n, travel/abs(r)/n, 'rate')
+        add(tname(self), 'beforewait', npts_total, wait_total/npts_total, 'wait')
+        devs = [_get_dev_kw(d) for d in self.get_alldevs(out)]
+        if not async_en:
+            for d, kw in devs:
+                mean, source = get_mean(d, 'get', lambda d=d, kw=kw: d.get(**kw))
+                add(tname(d), 'get', npts_total, mean, source)
+        else:
+            # instr are weakref proxies (not hashable)
+            groups = []
+            for d, kw in devs:
+                instr = d._do_redir_async().instr
+                for ginstr, gdevs in groups:
+                    if ginstr == instr:
+                        gdevs.append((d, kw))
+                        break
+                else:
+                    groups.append((instr, [(d, kw)]))
+            fmt = dict(basename='', append=True, file=False, multi=None)
+            group_entries = []
+            for instr, gdevs in groups:
+                means = [get_mean(d, 'get') for d, kw in gdevs]
+                srq_mean, srq_source = get_mean(instr, 'srq_complete')
+                if all(s == 'stats' for m, s in means):
+                    mean = sum(m for m, s in means) + srq_mean
+                    source = 'stats'
+                elif calibrate:
+                    mean = _estimate_time(lambda gdevs=gdevs: _readall_async(gdevs, [fmt]*len(gdevs), 0, noflat=True), ncal)
+                    source = 'calib'
+                else:
+                    mean = sum(m for m, s in means) + srq_mean
+                    source = 'unknown'
+                group_entries.append((mean, tname(instr), source))
+            slowest = max(group_entries)[1] if group_entries else None
+            for mean, name, source in group_entries:
+                add(name, 'async', npts_total, mean, source, counted=name == slowest)
+        if pipeline is None:
+            pipeline = self.pipeline.get()
+        for op in ('file_write', 'trace_update'):
+            mean, source = get_mean(self, op)
+            if source != 'unknown':
+                add(tname(self), op, npts_total, mean, source, counted=not pipeline)
+        total = sum(b['total'] for b in breakdown if b['counted'])
+        for b in breakdown:
+            b['fraction'] = b['total']/total if total else 0.
+        breakdown.sort(key=lambda b: b['total'], reverse=True)
+        if as_dict:
+            return dict(npts=npts_total, total=total, per_point=total/npts_total, breakdown=breakdown)
+        print('Estimate for %i points: %s (%.1f s) total, %.3f ms per point'%(npts_total, _format_duration(total),
+                    total, total/npts_total*1e3))
+        print('%-30s %-12s %10s %10s %10s %8s  %s'%('name', 'operation', 'count', 'mean(ms)', 'total(s)', 'fraction', 'source'))
+        for b in breakdown:
+            fraction = '%7.1f%%'%(b['fraction']*100) if b['counted'] else '(parallel)'
+            print('%-30s %-12s %10i %10.3f %10.2f %8s  %s'%(b['name'], b['operation'], b['count'], b['mean']*1e3,
+                        b['total'], fraction, b['source']))
+        unknown = ['%s %s'%(b['name'], b['operation']) for b in breakdown if b['source'] == 'unknown']
+        if unknown:
+            print('No timing for: %s (they count as 0 s). Use calibrate or the timing function.'%', '.join(unknown))
+
 
 sweep = _Sweep()
 sweep_multi = sweep.sweep_multi
+sweep_adaptive = sweep.sweep_adaptive
+sweep_estimate = sweep.estimate
 
 
 def use_sweep_path(filename):
@@ -1597,6 +2453,49 @@ readfile.__doc__ = """
 
 
 ###  set overides set builtin function
+def timing(enable=None, clear=False, data=None, as_dict=False, sort='total'):
+    """
+    Controls and shows the timing statistics of devices (get, set, decode, file_write,
+    dev_write for the per point files of sweeps), instruments (read, write, ask, rw_wait which is
+    the wait imposed between visa operations, lock_wait) and sweeps (file_write, trace_update,
+    and dev_write and pipeline_full in pipelined mode).
+    enable: True/False to start/stop the collection. It is off by default
+            (and it costs almost nothing when off).
+    clear: when True, the statistics are restarted.
+    data: the statistics to show. By default it is all of them (since the last clear).
+          Use sweep.last_timing for a summary of the last sweep (or sweep_multi).
+    as_dict: when True, returns the dictionnary {(key, operation): stats}
+             instead of printing a table. key identifies the object (see
+             instruments_base.TimingStats.key) and stats is a dictionnary with name, count, total,
+             mean, min, max (in s), nbytes and hist (the counts for the latency bins
+             with upper edges instruments_base.timing_bins, followed by the count
+             of longer ones).
+    sort: the stats entry used to sort the table (largest first) or 'name'.
+    """
+    stats = instruments_base.timing_stats
+    if clear:
+        stats.clear()
+    if enable is not None:
+        stats.enabled = enable
+        return
+    if clear:
+        return
+    if data is None:
+        data = stats.snapshot()
+    if as_dict:
+        return data
+    if sort == 'name':
+        keys = sorted(data.keys(), key=lambda k: (data[k]['name'], k[1], k[0]))
+    else:
+        keys = sorted(data.keys(), key=lambda k: data[k][sort], reverse=True)
+    ms = lambda v: '-' if v is None else '%.3f'%(v*1e3)
+    print('%-30s %-12s %8s %10s %10s %10s %10s %10s  %s'%('name', 'operation', 'count', 'total(s)',
+                        'mean(ms)', 'min(ms)', 'max(ms)', 'bytes', 'hist'))
+    for k in keys:
+        st = data[k]
+        print('%-30s %-12s %8i %10.4f %10s %10s %10s %10i  %s'%(st['name'], k[1], st['count'], st['total'],
+                    ms(st['mean']), ms(st['min']), ms(st['max']), st['nbytes'], st['hist']))
+
 def set(dev, *value, **kwarg):
     """
        Change the value of device dev (or the alias for an instrument).
@@ -1704,19 +2603,19 @@ class _Snap(object):
             self.cycle = 0
         if filename is None:
             raise ValueError('Snap. No filename selected')
-        if new_file:
-            f = open_utf8(filename, new_file_mode, 1)
-        else:
-            f = open_utf8(filename, 'a', 1)
+        if not new_file:
+            new_file_mode = 'a'
         if new_out:
             hdrs, graphsel, formats, set_counts = _getheaders(getdevs=out, root=filename)
+        else:
+            formats = self.formats
+        f = _open_data_file(filename, new_file_mode, formats)
+        if new_out:
             self.formats = formats
             _write_conf(f, formats, extra_base='snap_options', async_en=async_en)
             writevec(f, ['time']+hdrs, pre_str='#')
             self.out = out
             self.filename = filename
-        else:
-            formats = self.formats
         tme = clock.get()
         i = self.cycle
         if async_en:
@@ -1934,7 +2833,7 @@ def record(devs, interval=1, npoints=None, filename='%T.txt', title=None, extra_
     try:
         f = None
         if filename is not None:
-            f = open_utf8(fullpath, 'w', 1)
+            f = _open_data_file(fullpath, 'w', formats)
             _write_conf(f, formats, extra_base='record options', async_en=async_en, interval=interval)
             writevec(f, ['time']+hdrs, pre_str='#')
             if graph:
@@ -24,6 +24,7 @@
 from __future__ import absolute_import, print_function, division
 
 import glob
+import json
 import os
 import os.path
 from os.path import join as pjoin, isdir, isfile, pathsep
@@ -89,6 +90,8 @@ LOCAL_CONFIG_FILE = 'local_config.py'
 DEFAULT_LOCAL_CONFIG_PATH = pjoin(PYHEGEL_DIR, 'local_config_template.py')
 
 INSTRUMENTS_BASE = 'pyHegel.instruments'
+INSTRUMENTS_INDEX_NAME = 'instruments_index.json'
+INSTRUMENTS_INDEX_VERSION = 1
 
 USER_HOME = os.path.expanduser('~')
 DEFAULT_USER_DIR = pjoin(USER_HOME, CONFIG_DOT_DIR)
@@ -204,7 +207,68 @@ def load_local_config():
     return load_source(LOCAL_CONFIG, DEFAULT_LOCAL_CONFIG_PATH)
 
 
-def load_instruments(exclude=None):
+def _instruments_index_paths():
+    # The user directory first, then the pyHegel module directory
+    return [pjoin(d, INSTRUMENTS_INDEX_NAME) for d in get_conf_dirs()[:1]+[PYHEGEL_DIR]]
+
+def get_instruments_index(filenames):
+    """
+    Returns a dictionnary of filename: instruments_registry.scan_module result
+    for all the filenames.
+    The results are kept in a cache file (INSTRUMENTS_INDEX_NAME in the user
+    or the pyHegel directory, the first one that is writable) and are only
+    recalculated when the file modification time or size changes.
+    """
+    from .instruments_registry import scan_module
+    cache = {}
+    for p in _instruments_index_paths():
+        try:
+            with open(p, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == INSTRUMENTS_INDEX_VERSION:
+                cache = data['modules']
+                break
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    ret = {}
+    changed = False
+    for fn in filenames:
+        fn = os.path.abspath(fn)
+        st = os.stat(fn)
+        entry = cache.get(fn)
+        if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            try:
+                info = scan_module(fn)
+            except SyntaxError:
+                # let the import report the problem
+                info = dict(names=[], calls=[], lazy=False)
+            entry = cache[fn] = dict(mtime=st.st_mtime, size=st.st_size, info=info)
+            changed = True
+        ret[fn] = entry['info']
+    if changed:
+        for p in _instruments_index_paths():
+            if not isdir(os.path.dirname(p)):
+                continue
+            try:
+                with open(p, 'w') as f:
+                    json.dump(dict(version=INSTRUMENTS_INDEX_VERSION, modules=cache), f)
+                break
+            except (IOError, OSError, TypeError, ValueError):
+                pass
+    return ret
+
+def load_instruments(exclude=None, lazy=False):
+    """
+    Loads all the instruments modules (in the instruments directories of get_conf_dirs)
+    into the instruments package.
+    With lazy=True (only for python 3), the modules are not imported. Their instruments
+    are registered from an index (see get_instruments_index) and the module is imported
+    when one of its names is accessed in the instruments package or when one of its
+    instruments is selected by instruments_registry.find_instr/find_usb.
+    Modules whose registration are not understood by the index, or that conflict with
+    another module (register the same names or ids) are still imported immediately.
+    Returns a dictionnary of the full module names that were imported to their filenames.
+    """
     if exclude is None:
         exclude = []
     #paths = [pjoin(d, 'instruments') for d in get_conf_dirs(skip_module_dir=True)]
@@ -213,7 +277,8 @@ def load_instruments(exclude=None):
     # Reverse paths so we load pyHegel internal first and let user override them if needed.
     paths = paths[::-1]
     loaded = {}
-    from .instruments_registry import add_to_instruments
+    from .instruments_registry import add_to_instruments, add_lazy_module, registration_keys
+    modules = []
     for p in paths:
         filenames = glob.glob(pjoin(p, '*.py'))
         for f in filenames:
@@ -223,17 +288,36 @@ def load_instruments(exclude=None):
             if re.match(r'[A-Za-z_][A-Za-z0-9_]*\Z', name) is None:
                 raise RuntimeError('Trying to load "%s" but the name is invalid (should only contain letters, numbers and _)'%
                                     f)
-            if name in loaded:
-                print('Skipping loading "%s" because a module with that name is already loaded from %s'%(f, loaded[name]))
-            fullname = INSTRUMENTS_BASE+'.'+name
-            # instead of load_source, could do
-            #  insert path in sys.path
-            #   import (using importlib.import_module)
-            #  remove inserted path
-            # But that makes reloading more complicated
-            module = load_source(fullname, f)
-            loaded[fullname] = f
-            add_to_instruments(name)(module)
+            modules.append((name, f))
+    lazy_info = {}
+    if lazy and not is_py2:
+        index = get_instruments_index([f for name, f in modules])
+        owners = {}
+        for name, f in modules:
+            info = index[os.path.abspath(f)]
+            for k in registration_keys(info) | set([('name', name)]):
+                owners.setdefault(k, set()).add(f)
+            if info['lazy']:
+                lazy_info[f] = info
+        for files in owners.values():
+            if len(files) > 1:
+                for f in files:
+                    lazy_info.pop(f, None)
+    for name, f in modules:
+        if name in loaded:
+            print('Skipping loading "%s" because a module with that name is already loaded from %s'%(f, loaded[name]))
+        fullname = INSTRUMENTS_BASE+'.'+name
+        if f in lazy_info:
+            add_lazy_module(name, fullname, f, lazy_info[f])
+            continue
+        # instead of load_source, could do
+        #  insert path in sys.path
+        #   import (using importlib.import_module)
+        #  remove inserted path
+        # But that makes reloading more complicated
+        module = load_source(fullname, f)
+        loaded[fullname] = f
+        add_to_instruments(name)(module)
     return loaded
 
 class Extra_dlls(object):
@@ -347,6 +431,12 @@ class PyHegel_Conf(object):
     @property
     def timezone(self):
         return self.config_parser.get('traces', 'timezone')
+    @property
+    def traces_max_frame_rate(self):
+        return self.config_parser.getfloat('traces', 'max_frame_rate')
+    @property
+    def lazy_instruments(self):
+        return self.config_parser.getboolean('Global', 'lazy_instruments')
 
 pyHegel_conf = PyHegel_Conf()
 additional_dll_search = Addition_dll_search()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+########################## Copyrights and license ############################
+#                                                                            #
+# Copyright 2011-2023  Christian Lupien <christian.lupien@usherbrooke.ca>    #
+#                                                                            #
+# This file is part of pyHegel.  http://github.com/lupien/pyHegel            #
+#                                                                            #
+# pyHegel is free software: you can redistribute it and/or modify it under   #
+# the terms of the GNU Lesser General Public License as published by the     #
+# Free Software Foundation, either version 3 of the License, or (at your     #
+# option) any later version.                                                 #
+#                                                                            #
+# pyHegel is distributed in the hope that it will be useful, but WITHOUT     #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or      #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public        #
+# License for more details.                                                  #
+#                                                                            #
+# You should have received a copy of the GNU Lesser General Public License   #
+# along with pyHegel.  If not, see <http://www.gnu.org/licenses/>.           #
+#                                                                            #
+##############################################################################
+
+"""
+Binary container data file.
+
+When the filename given to sweep, sweep_multi, record or snap ends with
+CONTAINER_EXT (.phc), the data is saved in a single binary file instead of
+the text file and the extra files of every point (for devices returning arrays).
+The file contains everything the text files would: the headers, the comments,
+the data rows (as float64) and the arrays of every device. It is read back
+by util.readfile with the same result (shape) as the text files.
+
+The file starts with MAGIC and is followed by records, each one with
+a 16 bytes header (the 4 bytes tag, the crc32 of the payload and the
+payload length, as uint32 and uint64 little endian) and the payload:
+    TEXT: uint64 row position followed by utf8 text lines
+          (headers and comments, including the '#' and newlines).
+    ROWS: uint32 number of columns followed by the float64 data rows.
+    DSET: json description of a dataset (id, name, headers, append, bin).
+    ARRY: uint32 length of a json description (id, count, dtype, shape)
+          followed by the data of count arrays of the dataset.
+The records are only appended, so a file interrupted by a crash is
+still readable up to the last complete record (the incomplete one is dropped).
+The rows and arrays are buffered and written in chunks (see ContainerWriter).
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import json
+import os
+import struct
+import threading
+import time
+import warnings
+import zlib
+
+import numpy as np
+
+from .comp2to3 import string_bytes_types, unicode_type, fu
+
+CONTAINER_EXT = '.phc'
+MAGIC = b'PYHGLC01'
+_rec_hdr = struct.Struct('<4sIQ')
+_text_hdr = struct.Struct('<Q')
+_rows_hdr = struct.Struct('<I')
+_arry_hdr = struct.Struct('<I')
+
+def is_container(filename):
+    """ Returns True when filename is for a binary container (from its extension). """
+    return os.path.splitext(filename)[1].lower() == CONTAINER_EXT
+
+def _crc(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+def _iter_records(f, filename, read_payload=lambda tag: True):
+    """ yields (offset, end, tag, payload) for all the valid records.
+        The payload is None when read_payload(tag) is False (then the crc is only
+        checked for the last record).
+    """
+    offset = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(offset)
+    while offset < size:
+        f.seek(offset)
+        hdr = f.read(_rec_hdr.size)
+        tag, crc, n = _rec_hdr.unpack(hdr) if len(hdr) == _rec_hdr.size else (None, 0, size)
+        end = offset + _rec_hdr.size + n
+        if end > size:
+            warnings.warn('%s: incomplete record at end of file (ignored).'%filename)
+            return
+        if read_payload(tag) or end == size:
+            payload = f.read(n)
+            if _crc(payload) != crc:
+                warnings.warn('%s: corrupted record at offset %i (it and the rest of the file are ignored).'%(filename, offset))
+                return
+            if not read_payload(tag):
+                payload = None
+        else:
+            payload = None
+        yield offset, end, tag, payload
+        offset = end
+
+def _check_magic(f, filename):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a pyHegel container file.'%filename)
+
+
+class ContainerWriter(object):
+    """
+    Writes a binary container (see the container module documentation).
+    It behaves like a text file for write (headers and comments, see also
+    commands.writevec) and adds write_row (a row of data) and write_array
+    (the array data of a device for one point).
+    mode is 'w' to create a new file or 'a' to append to an existing one (it
+    is created if necessary).
+    The data is buffered and written when chunk_rows rows (or chunk_bytes bytes of
+    arrays) are waiting or when more than flush_interval s elapsed since
+    the last write. Every write is followed by a file flush and when fsync is True
+    also by os.fsync (to also survive an os crash). Closing the file writes everything.
+    """
+    def __init__(self, filename, mode='w', chunk_rows=1000, chunk_bytes=4*1024**2, flush_interval=1., fsync=False):
+        if mode not in ['w', 'a']:
+            raise ValueError("mode needs to be 'w' or 'a'")
+        self.name = filename
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._nrows = 0
+        self._datasets = {}
+        self._text = u''
+        self._rows = []
+        self._rows_ncols = None
+        self._arrays = []
+        self._arrays_key = None
+        self._arrays_nbytes = 0
+        self._last_flush = time.time()
+        if mode == 'a' and os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self._f = open(filename, 'r+b')
+            self._scan()
+        else:
+            self._f = open(filename, 'wb')
+            self._f.write(MAGIC)
+            self._f.flush()
+    def _scan(self):
+        # find the end of the valid data (to append after it), the number of
+        # rows and the datasets already present.
+        f = self._f
+        _check_magic(f, self.name)
+        end = f.tell()
+        for offset, end, tag, payload in _iter_records(f, self.name, lambda tag: tag == b'DSET'):
+            if tag == b'ROWS':
+                f.seek(offset + _rec_hdr.size)
+                ncols, = _rows_hdr.unpack(f.read(_rows_hdr.size))
+                n = end - offset - _rec_hdr.size - _rows_hdr.size
+                self._nrows += n//8//ncols
+            elif tag == b'DSET':
+                meta = json.loads(payload.decode('utf-8'))
+                self._datasets[meta['name']] = meta['id']
+        f.seek(end)
+        f.truncate()
+    @property
+    def closed(self):
+        return self._f is None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def _write_record(self, tag, *payload):
+        payload = b''.join(payload)
+        self._f.write(_rec_hdr.pack(tag, _crc(payload), len(payload)))
+        self._f.write(payload)
+    def _sync(self):
+        self._f.flush()
+        if self.fsync:
+            os.fsync(self._f.fileno())
+        self._last_flush = time.time()
+    def _flush_rows(self):
+        if self._rows:
+            data = np.array(self._rows, dtype='<f8')
+            self._write_record(b'ROWS', _rows_hdr.pack(self._rows_ncols), data.tobytes())
+            self._rows = []
+    def _flush_arrays(self):
+        if self._arrays:
+            ds_id, dtype, shape = self._arrays_key
+            desc = json.dumps(dict(id=ds_id, count=len(self._arrays), dtype=dtype, shape=shape)).encode('utf-8')
+            data = b''.join([a.tobytes() for a in self._arrays])
+            self._write_record(b'ARRY', _arry_hdr.pack(len(desc)), desc, data)
+            self._arrays = []
+            self._arrays_nbytes = 0
+    def _check_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+    def flush(self):
+        """ Write all the buffered data to the file. """
+        with self._lock:
+            self._flush_rows()
+            self._flush_arrays()
+            self._sync()
+    def close(self):
+        with self._lock:
+            if self._f is None:
+                return
+            if self._text:
+                # incomplete line
+                self.write(u'\n')
+            self.flush()
+            self._f.close()
+            self._f = None
+    def write(self, text):
+        """ Writes text (headers or comments). Only complete lines are saved. """
+        with self._lock:
+            self._text += fu(text)
+            if u'\n' not in self._text:
+                return
+            lines, self._text = self._text.rsplit(u'\n', 1)
+            self._write_record(b'TEXT', _text_hdr.pack(self._nrows), (lines+u'\n').encode('utf-8'))
+            self._sync()
+    def write_row(self, vals):
+        """ vals is a list of numbers. Values that can't be converted to float are saved as nan. """
+        try:
+            row = [float(v) for v in vals]
+        except (TypeError, ValueError):
+            row = []
+            for v in vals:
+                try:
+                    row.append(float(v))
+                except (TypeError, ValueError):
+                    row.append(np.nan)
+        with self._lock:
+            if self._rows_ncols != len(row):
+                self._flush_rows()
+                self._rows_ncols = len(row)
+            self._rows.append(row)
+            self._nrows += 1
+            if len(self._rows) >= self.chunk_rows:
+                self.flush()
+            else:
+                self._check_flush()
+    def write_array(self, name, val, headers=None, append=False, bin=False):
+        """ Adds the array val to the dataset name. The other parameters are only used
+            for the first array of the dataset:
+              headers is a list of header lines (text including the starting #)
+              append and bin are the device format options.
+        """
+        if isinstance(val, string_bytes_types):
+            if isinstance(val, unicode_type):
+                val = val.encode('utf-8')
+            val = np.frombuffer(val, dtype=np.uint8)
+        else:
+            val = np.asarray(val)
+            if val.dtype.kind == 'O':
+                val = val.astype(float)
+        # dtype.str is byte order explicit (like '<f8')
+        val = np.ascontiguousarray(val)
+        with self._lock:
+            ds_id = self._datasets.get(name, None)
+            if ds_id is None:
+                ds_id = self._datasets[name] = len(self._datasets)
+                meta = dict(id=ds_id, name=name, headers=headers or [], append=bool(append), bin=bin)
+                self._write_record(b'DSET', json.dumps(meta).encode('utf-8'))
+            key = (ds_id, val.dtype.str, list(val.shape))
+            if key != self._arrays_key:
+                self._flush_arrays()
+                self._arrays_key = key
+            self._arrays.append(val.copy())
+            self._arrays_nbytes += val.nbytes
+            if self._arrays_nbytes >= self.chunk_bytes:
+                self.flush()
+            else:
+                self._check_flush()
+
+
+class ContainerData(object):
+    """
+    The content of a binary container (see read_container)
+    Attributes:
+      text:     list of (row_position, line) of the text (headers and comments)
+      rows:     the data rows as a 2D array (nrows, ncols)
+      datasets: dict of name: dict(headers, append, bin, values) where values
+                is the list of arrays (one per point).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.text = []
+        self.datasets = {}
+        self._rows = []
+        ids = {}
+        with open(filename, 'rb') as f:
+            _check_magic(f, filename)
+            for offset, end, tag, payload in _iter_records(f, filename):
+                if tag == b'TEXT':
+                    pos, = _text_hdr.unpack_from(payload)
+                    lines = payload[_text_hdr.size:].decode('utf-8')
+                    self.text.extend([(pos, l) for l in lines.splitlines(True)])
+                elif tag == b'ROWS':
+                    ncols, = _rows_hdr.unpack_from(payload)
+                    data = np.frombuffer(payload, dtype='<f8', offset=_rows_hdr.size).reshape((-1, ncols))
+                    self._rows.append(data)
+                elif tag == b'DSET':
+                    meta = json.loads(payload.decode('utf-8'))
+                    meta['values'] = []
+                    ids[meta['id']] = meta
+                    self.datasets[meta['name']] = meta
+                elif tag == b'ARRY':
+                    n, = _arry_hdr.unpack_from(payload)
+                    start = _arry_hdr.size + n
+                    desc = json.loads(payload[_arry_hdr.size:start].decode('utf-8'))
+                    shape = tuple(desc['shape'])
+                    data = np.frombuffer(payload, dtype=desc['dtype'], offset=start)
+                    data = data.reshape((desc['count'],)+shape)
+                    ids[desc['id']]['values'].extend(list(data))
+    @property
+    def rows(self):
+        if len(self._rows) == 0:
+            return np.zeros((0, 0))
+        if len(self._rows) > 1:
+            ncols = set([r.shape[1] for r in self._rows])
+            if len(ncols) > 1:
+                raise ValueError('%s: the number of columns changes within the file (%s).'%(self.filename, sorted(ncols)))
+            self._rows = [np.concatenate(self._rows)]
+        return self._rows[0]
+    @property
+    def headers(self):
+        """ The header lines (the text before the first row) """
+        return [l for pos, l in self.text if pos == 0]
+    def lines(self):
+        """ Generates the lines of the equivalent text file (the data lines are empty). """
+        text = self.text
+        j = 0
+        for i in range(len(self.rows)+1):
+            while j < len(text) and text[j][0] == i:
+                yield text[j][1]
+                j += 1
+            if i < len(self.rows):
+                yield u'\n'
+    def data(self):
+        """ returns the data rows like np.loadtxt(text_file).T would """
+        return np.squeeze(self.rows).T
+    def _get_dataset(self, name):
+        try:
+            return self.datasets[name]
+        except KeyError:
+            raise ValueError('%s: dataset "%s" not found. Available ones: %s'%(self.filename, name, sorted(self.datasets.keys())))
+    def dataset_headers(self, name):
+        return self._get_dataset(name)['headers']
+    def dataset_data(self, name):
+        """ Returns the data of dataset name like it would be read from the text files:
+            a list of arrays (one per point, in the per point files) or a list
+            with one array (append mode, a single file).
+        """
+        ds = self._get_dataset(name)
+        vals = ds['values']
+        if ds['append']:
+            if len(vals) == 0:
+                return []
+            return [np.squeeze(np.array([np.ravel(v) for v in vals])).T]
+        if ds['bin']:
+            return vals
+        return [np.squeeze(v) for v in vals]
+
+def read_container(filename):
+    """ Reads a binary container and returns a ContainerData """
+    return ContainerData(filename)
@@ -28,6 +28,8 @@ import numpy as np
 import sys
 import ctypes
 import os
+import struct
+import threading
 import time
 
 import time
@@ -40,6 +42,12 @@ from scipy.ndimage import uniform_filter1d
 
 from ctypes import c_uint8, c_uint16, c_long, c_int, c_uint, c_uint64, c_ubyte, POINTER, byref, create_string_buffer, Structure, Array
 
+from ..comp2to3 import is_py2
+if is_py2:
+    import Queue as queue
+else:
+    import queue
+
 from ..instruments_base import BaseInstrument, scpiDevice, ChoiceIndex,\
                             wait_on_event, BaseDevice, MemoryDevice, ReadvalDev,\
                             _retry_wait, locked_calling, CHECKING
@@ -696,6 +704,479 @@ def convert_window_function(window_function_name, samplesPerWindow):
         raise ValueError("Not a registered window function")
 
 
+def scale_into(raw, out, scale, offset=0.):
+    """
+    Computes out = raw*scale + offset in place in out (no temporary arrays).
+    This is used to convert the raw DMA buffer samples to mV directly
+    in their final location.
+
+    Input:
+        - raw (Array): raw samples (uint8 or uint16)
+        - out (Array): float array with the same length as raw. It is overwritten.
+        - scale (float): mV per raw unit
+        - offset (float): mV to add after the scaling
+    Output:
+        - out (Array)
+    """
+    np.multiply(raw, scale, out=out)
+    if offset:
+        out += offset
+    return out
+
+
+def detect_thresholds(data, t, level_descend, level_ascend, sliding_mean_points=0, chunk_rows=None, fill=-1.):
+    """
+    Detects, for all the records (rows) of data at once, the times at which the signal
+    crosses the levels with hysteresis: the signal is high once it goes above level_ascend
+    and stays high until it goes below level_descend (and vice versa).
+    A descend (ascend) detection is the time of the last sample before the high to low
+    (low to high) transition. The state before the first sample outside the levels is unknown,
+    so no detection is made there.
+
+    Input:
+        - data (Array): 2D array of shape (nrecords, nsamples)
+        - t (Array): time of each sample of a record (nsamples)
+        - level_descend, level_ascend (float): the detection levels (level_descend <= level_ascend)
+        - sliding_mean_points (int): when >0, the records are first smoothed with a sliding mean
+                                     of this number of points (like smooth_curve).
+        - chunk_rows (int): when given, the records are processed by groups of this many rows,
+                            which limits the temporary memory.
+        - fill (float): value used to pad the results
+    Output:
+        - descend, ascend (Array): 2D arrays (nrecords, max number of detections in a record),
+                                   with the times of the detections, padded with fill
+        - ndescend, nascend (Array): number of detections for each record
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[np.newaxis]
+    t = np.asarray(t)
+    if sliding_mean_points < 0:
+        raise ValueError('sliding_mean_points needs to be >= 0')
+    nrecords, nsamples = data.shape
+    if nrecords == 0:
+        empty = np.full((0, 0), fill, dtype=float)
+        counts = np.zeros(0, dtype=int)
+        return empty, empty.copy(), counts, counts.copy()
+    if chunk_rows is None:
+        chunk_rows = nrecords
+    chunk_rows = max(int(chunk_rows), 1)
+    found = {'descend':([], []), 'ascend':([], [])}
+    for start in range(0, nrecords, chunk_rows):
+        block = data[start:start+chunk_rows]
+        if sliding_mean_points > 0:
+            block = uniform_filter1d(block, size=sliding_mean_points, axis=1)
+        # 1 above level_ascend, 0 below level_descend, -1 in between (keeps the previous state)
+        marks = np.where(block > level_ascend, 1, np.where(block < level_descend, 0, -1)).astype(np.int8)
+        last_mark = np.where(marks >= 0, np.arange(nsamples), 0)
+        np.maximum.accumulate(last_mark, axis=1, out=last_mark)
+        state = marks[np.arange(len(marks))[:, np.newaxis], last_mark]
+        before, after = state[:, :-1], state[:, 1:]
+        for name, (a, b) in [('descend', (1, 0)), ('ascend', (0, 1))]:
+            rows, cols = np.nonzero((before == a) & (after == b))
+            found[name][0].append(rows + start)
+            found[name][1].append(cols)
+    results = []
+    counts = []
+    for name in ['descend', 'ascend']:
+        rows = np.concatenate(found[name][0])
+        cols = np.concatenate(found[name][1])
+        counts.append(np.bincount(rows, minlength=nrecords))
+        results.append((rows, cols))
+    width = max(counts[0].max(), counts[1].max())
+    outputs = []
+    for (rows, cols), count in zip(results, counts):
+        out = np.full((nrecords, width), fill, dtype=float)
+        # position of each detection within its row (rows are sorted)
+        row_start = np.cumsum(count) - count
+        out[rows, np.arange(len(rows)) - row_start[rows]] = t[cols]
+        outputs.append(out)
+    return outputs[0], outputs[1], counts[0], counts[1]
+
+
+class WelchAccumulator(object):
+    """
+    Computes a Power Spectrum or PSD with Welch's method (like scipy.signal.welch with
+    detrend='constant', return_onesided=True and average='mean') on data that arrives in blocks,
+    like DMA buffers. Segments overlapping two blocks are handled by keeping the end of the previous
+    block, so the result for one long record is the same as welch on that record.
+    The memory used is constant (a work buffer of about nperseg+step*chunk_segments samples),
+    so any number of blocks can be averaged.
+
+    For example:
+        acc = WelchAccumulator(fs, nperseg, window=signal.windows.hann(nperseg))
+        for block in blocks:
+            acc.add(block)
+        freqs, psd = acc.result()
+    """
+    def __init__(self, fs, nperseg, nfft=None, window=None, noverlap=None, scaling='density',
+                 scale=1., offset=0., chunk_segments=64):
+        """
+        Input:
+            - fs (float): sample rate
+            - nperseg (int): number of points per segment
+            - nfft (int): number of points of the FFT. Defaults to nperseg.
+                          When smaller than nperseg, the segments are truncated.
+            - window (Array): window function (nperseg points). Defaults to uniform.
+            - noverlap (int): number of points in common between segments. Defaults to nperseg//2
+            - scaling (String): 'density' (PSD) or 'spectrum' (Power Spectrum)
+            - scale, offset (float): the data added is converted to data*scale + offset
+                                     (to directly use raw DMA samples)
+            - chunk_segments (int): maximum number of segments transformed at once
+        """
+        if scaling not in ['density', 'spectrum']:
+            raise ValueError("scaling should be 'density' or 'spectrum'")
+        nperseg = int(nperseg)
+        if nfft is None:
+            nfft = nperseg
+        if noverlap is None:
+            noverlap = nperseg//2
+        if noverlap >= nperseg:
+            raise ValueError('noverlap must be smaller than nperseg')
+        if window is None:
+            window = np.ones(nperseg)
+        window = np.asarray(window, dtype=float)
+        if len(window) != nperseg:
+            raise ValueError('window should have nperseg points')
+        self.fs = fs
+        self.nperseg = nperseg
+        self.nfft = int(nfft)
+        self.step = nperseg - noverlap
+        self.window = window
+        self.scaling = scaling
+        self.scale = scale
+        self.offset = offset
+        self._work = np.empty(nperseg + self.step*(chunk_segments-1))
+        self.reset()
+
+    def reset(self):
+        """ Restarts the averaging (and forgets the incomplete segment) """
+        self._nwork = 0
+        self._acc = np.zeros(self.nfft//2 + 1)
+        self.count = 0
+
+    def add(self, data):
+        """
+        Adds the block data (1D Array, continuing the previous one) to the average.
+        """
+        data = np.asarray(data)
+        n = len(data)
+        pos = 0
+        work = self._work
+        while pos < n:
+            take = min(n-pos, len(work) - self._nwork)
+            scale_into(data[pos:pos+take], work[self._nwork:self._nwork+take], self.scale, self.offset)
+            self._nwork += take
+            pos += take
+            self._process()
+
+    def _process(self):
+        nperseg, step, nwork = self.nperseg, self.step, self._nwork
+        if nwork < nperseg:
+            return
+        nseg = (nwork - nperseg)//step + 1
+        work = self._work
+        segs = np.lib.stride_tricks.as_strided(work, shape=(nseg, nperseg),
+                                               strides=(step*work.strides[0], work.strides[0]))
+        segs = segs - segs.mean(axis=1, keepdims=True)
+        segs *= self.window
+        spec = np.fft.rfft(segs, n=self.nfft, axis=1)
+        self._acc += (spec.real**2 + spec.imag**2).sum(axis=0)
+        self.count += nseg
+        consumed = nseg*step
+        work[:nwork-consumed] = work[consumed:nwork]
+        self._nwork = nwork - consumed
+
+    def result(self):
+        """
+        Returns [freqs, psd] for the segments added up to now.
+        """
+        if self.count == 0:
+            raise RuntimeError('Not enough data for one segment')
+        win = self.window
+        if self.scaling == 'density':
+            scale = 1./(self.fs*(win*win).sum())
+        else:
+            scale = 1./win.sum()**2
+        psd = self._acc*(scale/self.count)
+        # one sided: double everything except DC (and Nyquist for even nfft)
+        if self.nfft % 2:
+            psd[1:] *= 2
+        else:
+            psd[1:-1] *= 2
+        freqs = np.fft.rfftfreq(self.nfft, 1./self.fs)
+        return [freqs, psd]
+
+
+def _npy_header(shape, dtype, total_length=128):
+    """
+    Returns a .npy (version 1.0) header of fixed length for an array of shape and dtype.
+    The fixed length allows to rewrite it once the final shape is known.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }"%(
+                np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(int(v) for v in shape))
+    header_length = total_length - 10
+    if len(header) >= header_length:
+        raise ValueError('Shape is too long for the npy header')
+    header = header.ljust(header_length-1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', header_length) + header.encode('latin1')
+
+
+class DMAStreamer(object):
+    """
+    Streams filled AutoDMA buffers to a file while the board keeps filling the others.
+    The buffers must already be posted to the board and the capture started
+    (see ATSBoard._async_trig). run() then waits for the buffers in order in the calling thread
+    and passes them, through a bounded queue, to a writer thread that saves them to the file
+    and hands them back to be posted again to the board. The buffers are written directly
+    (no copies), so the number of DMA buffers sets how long a slow write can be absorbed.
+
+    The file is either 'raw' (the buffers one after the other) or 'npy' (the same with a
+    numpy header for an array of shape (nbuffers,)+buffer_shape, readable with np.load(filename, mmap_mode='r')).
+
+    After run, stats contains:
+        - buffers, bytes: number of buffers and bytes written
+        - elapsed_s: time of the acquisition
+        - throughput_MBps: bytes written per second (in 1e6 bytes/s)
+        - min_margin: minimum number of buffers still available to the board when one was completed.
+                      When this reaches 0, the board relies on its on-board memory and could overflow.
+        - mean_margin: the average of the margin
+        - max_queue: maximum number of buffers waiting to be written
+        - write_busy: fraction of the time the writer thread was busy writing
+        - stall_s: time the acquisition loop waited for the writer to release a buffer
+    """
+    def __init__(self, board, buffers, filename, nbuffers, sample_type, buffer_shape,
+                 timeout_ms=10000, file_format='raw', queue_size=None):
+        """
+        Input:
+            - board: an ats.Board (or SimulatedDMABoard)
+            - buffers (List): the DMA buffers (with addr, size_bytes and buffer attributes), already posted
+            - filename (String): file to create
+            - nbuffers (int): number of buffers to acquire. None means until CTRL-C
+            - sample_type: numpy dtype of the samples
+            - buffer_shape (tuple): shape of the samples of one buffer (like (channel_count, samples_per_buffer))
+            - timeout_ms (int): maximum time to wait for one buffer
+            - file_format (String): 'raw' or 'npy'
+            - queue_size (int): maximum number of buffers waiting to be written. Defaults to len(buffers)
+        """
+        if file_format not in ['raw', 'npy']:
+            raise ValueError("file_format should be 'raw' or 'npy'")
+        self.board = board
+        self.buffers = buffers
+        self.filename = filename
+        self.nbuffers = nbuffers
+        self.sample_type = np.dtype(sample_type)
+        self.buffer_shape = tuple(buffer_shape)
+        self.timeout_ms = timeout_ms
+        self.file_format = file_format
+        if queue_size is None:
+            queue_size = len(buffers)
+        self.queue_size = queue_size
+        self.stats = {}
+
+    def _writer(self, fh, write_q, free_q):
+        busy = 0.
+        while True:
+            item = write_q.get()
+            if item is None:
+                break
+            if self._writer_error is None:
+                t0 = time.time()
+                try:
+                    np.asarray(item.buffer).tofile(fh)
+                except Exception:
+                    self._writer_error = sys.exc_info()
+                else:
+                    self._written += 1
+                    self._written_bytes += item.size_bytes
+                busy += time.time() - t0
+            free_q.put(item)
+        self._writer_busy = busy
+
+    def run(self):
+        board = self.board
+        buffers = self.buffers
+        nbuffers = self.nbuffers
+        write_q = queue.Queue(maxsize=self.queue_size)
+        free_q = queue.Queue()
+        self._writer_error = None
+        self._writer_busy = 0.
+        self._written = 0
+        self._written_bytes = 0
+        fh = open(self.filename, 'wb')
+        if self.file_format == 'npy':
+            fh.write(_npy_header((0 if nbuffers is None else nbuffers,)+self.buffer_shape, self.sample_type))
+        header_length = fh.tell()
+        writer = threading.Thread(target=self._writer, args=(fh, write_q, free_q))
+        writer.daemon = True
+        writer.start()
+        # posted is the number of acquisitions (buffers) for which a DMA buffer was given to the board.
+        posted = len(buffers)
+        completed = 0
+        min_margin = len(buffers)
+        sum_margin = 0
+        nmargin = 0
+        max_queue = 0
+        stall = 0.
+        interrupted = False
+        t_start = time.time()
+        try:
+            while nbuffers is None or completed < nbuffers:
+                while posted <= completed:
+                    # The board has no buffer for the next acquisition; wait for the writer.
+                    t0 = time.time()
+                    try:
+                        buf = free_q.get(timeout=self.timeout_ms/1000.)
+                    except queue.Empty:
+                        raise RuntimeError('Timeout waiting for the writer to release a buffer '
+                                           '(%i buffers still waiting to be written): the file writes are too slow'%(
+                                            write_q.qsize()))
+                    stall += time.time() - t0
+                    board.postAsyncBuffer(buf.addr, buf.size_bytes)
+                    posted += 1
+                buf = buffers[completed % len(buffers)]
+                board.waitAsyncBufferComplete(buf.addr, timeout_ms=self.timeout_ms)
+                completed += 1
+                if nbuffers is None or posted < nbuffers:
+                    # at the end, buffers are no longer posted so the margin is not meaningful
+                    margin = posted - completed
+                    min_margin = min(min_margin, margin)
+                    sum_margin += margin
+                    nmargin += 1
+                write_q.put(buf)
+                max_queue = max(max_queue, write_q.qsize())
+                if self._writer_error is not None:
+                    break
+                # return the buffers already written to the board
+                while nbuffers is None or posted < nbuffers:
+                    try:
+                        buf = free_q.get_nowait()
+                    except queue.Empty:
+                        break
+                    board.postAsyncBuffer(buf.addr, buf.size_bytes)
+                    posted += 1
+        except KeyboardInterrupt:
+            interrupted = True
+        finally:
+            write_q.put(None)
+            writer.join()
+            elapsed = time.time() - t_start
+            # Only the buffers the writer completed are in the file (a write error stops it
+            # and can leave a partial buffer, which is removed).
+            written = self._written
+            nbytes = self._written_bytes
+            if self._writer_error is not None:
+                try:
+                    fh.truncate(header_length + nbytes)
+                except Exception:
+                    pass
+            if self.file_format == 'npy' and written != nbuffers:
+                fh.seek(0)
+                fh.write(_npy_header((written,)+self.buffer_shape, self.sample_type))
+            fh.close()
+            self.stats = dict(buffers=written,
+                              bytes=nbytes,
+                              elapsed_s=elapsed,
+                              throughput_MBps=nbytes/elapsed/1e6 if elapsed > 0 else 0.,
+                              min_margin=min_margin,
+                              mean_margin=sum_margin/nmargin if nmargin else float(min_margin),
+                              max_queue=max_queue,
+                              write_busy=self._writer_busy/elapsed if elapsed > 0 else 0.,
+                              stall_s=stall)
+        if self._writer_error is not None:
+            exc = self._writer_error[1]
+            raise RuntimeError('Error while writing the stream file: %s'%exc)
+        if interrupted:
+            raise KeyboardInterrupt('Interrupted stream (%i buffers saved)'%self._written)
+        return self.stats
+
+
+class SimulatedDMABuffer(object):
+    """
+    Imitates ats.DMABuffer (addr, size_bytes and buffer attributes) for a SimulatedDMABoard.
+    """
+    def __init__(self, sample_type, size_bytes):
+        sample_type = np.dtype(sample_type)
+        self.size_bytes = size_bytes
+        self.buffer = np.zeros(size_bytes//sample_type.itemsize, dtype=sample_type)
+        self.addr = self.buffer.ctypes.data
+
+
+class SimulatedDMABoard(object):
+    """
+    Imitates the AutoDMA part of ats.Board (postAsyncBuffer, waitAsyncBufferComplete,
+    startCapture, abortAsyncRead) to test the acquisition loops (like DMAStreamer) without hardware.
+    The buffers are filled at sample_rate (samples per second, all channels of a buffer included)
+    and a buffer overflow error is raised when a buffer was posted too late for the on-board memory
+    (memory_bytes) to have kept the data.
+    fill is a function called with (buffer_index, array) to produce the data. The default
+    is a ramp that continues from buffer to buffer (useful to detect missing or repeated buffers).
+
+    For example:
+        buffers = [SimulatedDMABuffer(np.uint16, 2**20) for i in range(4)]
+        board = SimulatedDMABoard(sample_rate=50e6)
+        for b in buffers: board.postAsyncBuffer(b.addr, b.size_bytes)
+        board.startCapture()
+        stats = DMAStreamer(board, buffers, 'test.npy', 100, np.uint16, (2**19,), file_format='npy').run()
+    """
+    def __init__(self, sample_rate=10e6, sample_type=np.uint16, memory_bytes=256*2**20, fill=None):
+        self.sample_rate = sample_rate
+        self.sample_type = np.dtype(sample_type)
+        self.memory_bytes = memory_bytes
+        self.fill = fill
+        self._posted = []
+        self._start_time = None
+        self._next_index = 0
+        self._acquired_samples = 0
+    def _default_fill(self, index, data):
+        n = len(data)
+        mask = 2**(8*data.dtype.itemsize) - 1
+        data[:] = (np.arange(index*n, (index+1)*n) & mask).astype(data.dtype)
+    def postAsyncBuffer(self, addr, size_bytes):
+        nsamples = size_bytes//self.sample_type.itemsize
+        if self._start_time is None:
+            done_time = None
+        else:
+            # the time at which the board will have acquired the data for this buffer
+            self._acquired_samples += nsamples
+            done_time = self._start_time + self._acquired_samples/self.sample_rate
+            # The data waits in the on-board memory until a buffer is available.
+            memory_time = self.memory_bytes/self.sample_type.itemsize/self.sample_rate
+            if time.time() > done_time + memory_time:
+                done_time = -1 # overflow
+        self._posted.append((addr, size_bytes, done_time))
+    def startCapture(self):
+        self._start_time = time.time()
+        self._acquired_samples = 0
+        posted = self._posted
+        self._posted = []
+        for addr, size_bytes, done_time in posted:
+            self.postAsyncBuffer(addr, size_bytes)
+    def waitAsyncBufferComplete(self, addr, timeout_ms=10000):
+        if not self._posted or self._posted[0][0] != addr:
+            raise RuntimeError('ApiDmaInProgress: buffer is not the next one posted')
+        addr, size_bytes, done_time = self._posted[0]
+        if done_time is None:
+            raise RuntimeError('ApiWaitTimeout: capture not started')
+        if done_time < 0:
+            raise RuntimeError('ApiBufferOverflow: on-board memory overflow')
+        delay = done_time - time.time()
+        if delay > timeout_ms/1000.:
+            time.sleep(timeout_ms/1000.)
+            raise RuntimeError('ApiWaitTimeout')
+        if delay > 0:
+            time.sleep(delay)
+        self._posted.pop(0)
+        data = np.ctypeslib.as_array((c_uint8*size_bytes).from_address(addr)).view(self.sample_type)
+        fill = self._default_fill if self.fill is None else self.fill
+        fill(self._next_index, data)
+        self._next_index += 1
+    def abortAsyncRead(self):
+        self._posted = []
+        self._start_time = None
+        self._next_index = 0
+
+
 @register_instrument('AlazarTech9462', 'S902252')
 class ATSBoard(BaseInstrument):
     def __init__(self,
@@ -726,6 +1207,8 @@ class ATSBoard(BaseInstrument):
 
         self.buffers = []
         self.data = {"t":[], "A":[], "B":[]}
+        # True once all the preallocated arrays in data have been filled by an acquisition.
+        self._data_valid = False
         self.channel_count = 2
 
         self._NPTbuffersPerAcquisition = 1
@@ -737,6 +1220,8 @@ class ATSBoard(BaseInstrument):
         self._NPTrecordsPerBuffer = 1
 
         self.was_continuous = False
+        # statistics of the last stream_to_file
+        self.stream_stats = {}
 
         super(ATSBoard, self).__init__(**kwarg)
 
@@ -1635,9 +2120,18 @@ class ATSBoard(BaseInstrument):
             self._board.postAsyncBuffer(buffer.addr, buffer.size_bytes)  # Done by calling postAsyncBuffer
 
         # Initialize data
+        # The arrays for the active channels are allocated here for the full acquisition.
+        # The DMA buffers are then scaled directly into their slice (see get_scale_offset and scale_into).
+        if trig_mode == "NPT":
+            samplesPerAcquisition = recordsPerAcquisition * samplesPerRecord
+        else:
+            samplesPerAcquisition = samplesPerRecord
         self.data = {"t":np.linspace(0, self.acquisition_length_sec.get(), samplesPerRecord),
                      "A":np.array([]),
                      "B":np.array([])}
+        for channel in channels:
+            self.data[channel] = np.empty(samplesPerAcquisition)
+        self._data_valid = False
         self._initialized = True
         print(self._initialized)
         self._board.startCapture()  # Arms the board to start the acquisition
@@ -1656,11 +2150,8 @@ class ATSBoard(BaseInstrument):
         Output:
             - returned_data (Array): 2D arrays containing data  
         """
-        returned_data_sample_number = []
-        returned_data_time = []
-        for i in range(nbwindows):
-            returned_data_sample_number = np.concatenate((returned_data_sample_number, i*np.ones(nbsamples)), axis=0) 
-            returned_data_time = np.concatenate((returned_data_time, data["t"]), axis=0)
+        returned_data_sample_number = np.repeat(np.arange(nbwindows, dtype=float), nbsamples)
+        returned_data_time = np.tile(data["t"], nbwindows)
         returned_data = [data[channel] for channel in active_channels]
         return [returned_data_sample_number, returned_data_time] + returned_data
     
@@ -1686,6 +2177,21 @@ class ATSBoard(BaseInstrument):
             return 2
 
 
+    def get_scale_offset(self):
+        """
+        Returns the scale and offset to convert the raw samples to mV:
+            mV = raw*scale + offset
+
+        Output:
+            - scale (float): mV per raw unit
+            - offset (float): mV
+        """
+        screen_size = self.input_range.get()  # Size of the screen
+        screen_shift = self.get_screen_shift()
+        zero_value = self.board_info["Zero_value"]  # zero for the output data
+        return screen_size/zero_value, -screen_shift*screen_size
+
+
     def _readval_getdev(self):
         """
         Realizes a new trigger. Number of samples is possibly modified to take into account the maximum size of the buffers. We try
@@ -1719,10 +2225,8 @@ class ATSBoard(BaseInstrument):
         channels = self.active_channels.get()
         channel_count = self.channel_count
         samplesPerBuffer = self._TRIGsamplesPerBuffer
-        screen_size = self.input_range.get()  # Size of the screen
-        screen_shift = self.get_screen_shift()
+        scale, offset = self.get_scale_offset()
         sample_type = self.board_info["Sample_type"]  # output data type
-        zero_value = self.board_info["Zero_value"]  # zero for the output data
         timeout = self.timeout.get()  # timeout
 
         try:
@@ -1735,13 +2239,16 @@ class ATSBoard(BaseInstrument):
                 buffer = self.buffers[buffersCompleted % buffer_count]
                 self._board.waitAsyncBufferComplete(buffer.addr, timeout_ms=timeout)
                 received_data = np.frombuffer(buffer.buffer, dtype=sample_type)
+                start = buffersCompleted*samplesPerBuffer
                 for i in range(channel_count):
-                    self.data[channels[i]] = np.concatenate((self.data[channels[i]], (received_data[i*samplesPerBuffer:(i+1)*samplesPerBuffer]-screen_shift*zero_value)/zero_value*screen_size), axis=0)
+                    scale_into(received_data[i*samplesPerBuffer:(i+1)*samplesPerBuffer],
+                               self.data[channels[i]][start:start+samplesPerBuffer], scale, offset)
                 buffersCompleted += 1
                 bytesTransferred += buffer.size_bytes
 
                 # Add the buffer to the end of the list of available buffers.
                 self._board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self._data_valid = True
         finally:
             self._board.abortAsyncRead()
             self._initialized = False
@@ -1792,10 +2299,9 @@ class ATSBoard(BaseInstrument):
         recordsPerBuffer = self._NPTrecordsPerBuffer
         samplesPerRecord = self._NPTsamplesPerRecord
         timeout = self.timeout.get()
-        screen_size = self.input_range.get()  # Size of the screen
-        screen_shift = self.get_screen_shift()
-        zero_value = self.board_info["Zero_value"]  # zero for the output data
+        scale, offset = self.get_scale_offset()
         sample_type = self.board_info["Sample_type"]  # output data type
+        samplesPerBufferChannel = recordsPerBuffer*samplesPerRecord
         t1 = time.time()
         print(t1-t0)
         try:
@@ -1809,13 +2315,17 @@ class ATSBoard(BaseInstrument):
                 buffersCompleted += 1
                 print(buffersCompleted)
                 bytesTransferred += buffer.size_bytes
+                # NPT buffers contain all the records of channel A, then all the records of channel B ...
+                # so every channel is a contiguous block that goes directly after the previous buffer's records.
                 received_data = np.frombuffer(buffer.buffer, dtype=sample_type)
-                for i in range(recordsPerBuffer):
-                    for j in range(channel_count):
-                        self.data[channels[j]] = np.concatenate((self.data[channels[j]], (received_data[(2*j+i)*samplesPerRecord:(2*j+i+1)*samplesPerRecord]-zero_value*screen_shift)/zero_value*screen_size))
-  
+                received_data = received_data[:channel_count*samplesPerBufferChannel].reshape((channel_count, samplesPerBufferChannel))
+                start = (buffersCompleted-1)*samplesPerBufferChannel
+                for j in range(channel_count):
+                    scale_into(received_data[j], self.data[channels[j]][start:start+samplesPerBufferChannel], scale, offset)
+
                 # Add the buffer to the end of the list of available buffers.
                 self._board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self._data_valid = True
         finally:
             self._board.abortAsyncRead()
             self._initialized = False
@@ -1861,7 +2371,7 @@ class ATSBoard(BaseInstrument):
         bufferSize = self.samples_per_record.get()
         # for each channel
         for channel in channels:
-            if len(self.data[channel])<bufferSize:  # if one doesn't have enough data
+            if not self._data_valid or len(self.data[channel])<bufferSize:  # if one doesn't have enough data
                 dataFILLED=False
                 break
 
@@ -1943,10 +2453,8 @@ class ATSBoard(BaseInstrument):
         channel_count = self.channel_count
         channels = self.active_channels.get()
         samplesPerBuffer = self._TRIGsamplesPerBuffer
-        screen_size = self.input_range.get()  # Size of the screen
-        screen_shift = self.get_screen_shift()
+        scale, offset = self.get_scale_offset()
         sample_type = self.board_info["Sample_type"]  # output data type
-        zero_value = self.board_info["Zero_value"]  # zero for the output data
         timeout = self.timeout.get()  # timeout
 
         try:
@@ -1959,13 +2467,16 @@ class ATSBoard(BaseInstrument):
                 buffer = self.buffers[buffersCompleted % buffer_count]
                 self._board.waitAsyncBufferComplete(buffer.addr, timeout_ms=timeout)
                 received_data = np.frombuffer(buffer.buffer, dtype=sample_type)
+                start = buffersCompleted*samplesPerBuffer
                 for i in range(channel_count):
-                    self.data[channels[i]] = np.concatenate((self.data[channels[i]], (received_data[i*samplesPerBuffer:(i+1)*samplesPerBuffer]-screen_shift*zero_value)/zero_value*screen_size), axis=0)
+                    scale_into(received_data[i*samplesPerBuffer:(i+1)*samplesPerBuffer],
+                               self.data[channels[i]][start:start+samplesPerBuffer], scale, offset)
                 buffersCompleted += 1
                 bytesTransferred += buffer.size_bytes
 
                 # Add the buffer to the end of the list of available buffers.
                 self._board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+            self._data_valid = True
         finally:
             self._board.abortAsyncRead()
             self._initialized = False
@@ -1973,6 +2484,52 @@ class ATSBoard(BaseInstrument):
         return self.get_data(self.data, self.active_channels.get(), self.samples_per_record.get(), 1)
 
 
+    def stream_to_file(self, filename, nbuffers=None, duration=None, file_format='npy', queue_size=None):
+        """
+        Gapless acquisition (in the present trigger_mode if Triggered, otherwise Continuous)
+        saved directly to filename as the raw samples, without conversion.
+        The acquisition stops after nbuffers DMA buffers, after duration (s) or with CTRL-C
+        (the file is then completed before the KeyboardInterrupt is raised).
+        The DMA buffers hold samples_per_record/int(samples_per_record/max_samples_per_buffer+1) samples
+        per channel (see max_bytes_per_buffer) and buffer_count of them are used to absorb
+        the delays of the disk.
+
+        The file_format is 'raw' or 'npy'. The data has the shape (nbuffers, channel_count, samples_per_buffer)
+        (so np.load(filename, mmap_mode='r') is useful for large files).
+        The samples are converted to mV with: raw*scale + offset (both are in the returned stats).
+
+        Output:
+            - stats (dict): the acquisition statistics (see DMAStreamer), with also
+                            channels, sample_rate, samples_per_buffer, scale and offset.
+                            It is also kept in stream_stats.
+        """
+        if nbuffers is not None and duration is not None:
+            raise ValueError('Specify only one of nbuffers or duration')
+        if self.trigger_mode.get() not in ["Triggered", "Continuous"]:
+            self.trigger_mode.set("Continuous")
+        self._initialized = False
+        self._async_trig()
+        channels = self.active_channels.get()
+        samplesPerBuffer = self._TRIGsamplesPerBuffer
+        sample_rate = self._ext_sample_rate.get()
+        if duration is not None:
+            nbuffers = int(np.ceil(duration*sample_rate/samplesPerBuffer))
+        streamer = DMAStreamer(self._board, self.buffers, filename, nbuffers, self.board_info["Sample_type"],
+                               (self.channel_count, samplesPerBuffer), timeout_ms=self.timeout.get(),
+                               file_format=file_format, queue_size=queue_size)
+        try:
+            streamer.run()
+        finally:
+            self._board.abortAsyncRead()
+            self._initialized = False
+            scale, offset = self.get_scale_offset()
+            stats = streamer.stats
+            stats.update(channels=channels, sample_rate=sample_rate, samples_per_buffer=samplesPerBuffer,
+                         scale=scale, offset=offset)
+            self.stream_stats = stats
+        return stats
+
+
     # def make_fft(self, data):
     #     """
     #     Returns the fft of a signal having the format of the result of a continuous acquisition on one channel with continuous_read
@@ -2048,6 +2605,28 @@ class ATSBoard(BaseInstrument):
         Output:
             - psd (List[Array]): first element is frequency axis, second element is psd 
         """        
+        nperseg, nfft, scaling = self._psd_params()
+
+        # Perform PSD/Power Spectrum
+        # psd[0]: frequencies, psd[1]: PSD
+        psd = signal.welch(data[2]*1e-3,
+                            fs=self.sample_rate.get(),  # sample rate
+                            window=convert_window_function(self.window_function.get(), nperseg),  # window function
+                            nperseg=nperseg,  # number of points per segment
+                            noverlap=None,  # set to nperseg//2
+                            nfft=nfft,  # number of points for the FFT
+                            detrend='constant',
+                            return_onesided=True,  # Return only positive frequencies
+                            scaling=scaling,  # units: spectrum or density
+                            axis=- 1)
+        return self._psd_output(psd[0], psd[1])
+
+
+    def _psd_params(self):
+        """
+        Returns the number of points per segment, the number of FFT points and the
+        welch scaling ("spectrum" or "density") for the present psd_units.
+        """
         # Depending on the units, perform FFT or PSD
         units = self.psd_units.get()
         
@@ -2071,47 +2650,71 @@ class ATSBoard(BaseInstrument):
             # nfft set equal to nperseg
             nfft = nperseg
             print("More FFT points than points per window, psd_fft_lines set to: ", nperseg) 
+        return nperseg, nfft, scaling
 
-        # Perform PSD/Power Spectrum
-        # psd[0]: frequencies, psd[1]: PSD
-        psd = signal.welch(data[2]*1e-3,
-                            fs=self.sample_rate.get(),  # sample rate
-                            window=convert_window_function(self.window_function.get(), nperseg),  # window function
-                            nperseg=nperseg,  # number of points per segment
-                            noverlap=None,  # set to nperseg//2
-                            nfft=nfft,  # number of points for the FFT
-                            detrend='constant',
-                            return_onesided=True,  # Return only positive frequencies
-                            scaling=scaling,  # units: spectrum or density
-                            axis=- 1)
+
+    def _psd_output(self, freqs, psd):
+        """
+        Converts the psd (in V**2/Hz or V**2) to psd_units and keeps only
+        the frequencies between psd_start_freq and psd_end_freq.
+        """
+        units = self.psd_units.get()
         # Display PSD only between psd_start_freq and psd_end_freq
-        xfbegin = np.searchsorted(psd[0], self.psd_start_freq.get())  # detect first frequency >= psd_start_freq  
-        xfend = np.searchsorted(psd[0], self.psd_end_freq.get(), side="right")  # detect first frequency <= psd_end_freq
+        xfbegin = np.searchsorted(freqs, self.psd_start_freq.get())  # detect first frequency >= psd_start_freq  
+        xfend = np.searchsorted(freqs, self.psd_end_freq.get(), side="right")  # detect first frequency <= psd_end_freq
         # PSD in V**2/Hz
         if units == "V/sqrt(Hz)":
             # Take the square root if units are V/sqrt(Hz)
-            return [psd[0][xfbegin:xfend], np.sqrt(psd[1][xfbegin:xfend])]
+            return [freqs[xfbegin:xfend], np.sqrt(psd[xfbegin:xfend])]
         elif units=="V":
-            return [psd[0][xfbegin:xfend], np.sqrt(psd[1][xfbegin:xfend])]
+            return [freqs[xfbegin:xfend], np.sqrt(psd[xfbegin:xfend])]
         elif units=="dBV":
-            return [psd[0][xfbegin:xfend], 10*np.log10(np.sqrt(psd[1][xfbegin:xfend]))]
+            return [freqs[xfbegin:xfend], 10*np.log10(np.sqrt(psd[xfbegin:xfend]))]
         
-        return [psd[0][xfbegin:xfend], psd[1][xfbegin:xfend]]
+        return [freqs[xfbegin:xfend], psd[xfbegin:xfend]]
 
 
     def _psd_getdev(self):
         """
-        Records a single continuous acquisition on one channel with continuous_read (on current_channel)
-        PSD/FFT is computed by calling make_psd (if units are FFT units, make_fft is caller instead)
+        Records psd_averages gapless continuous acquisitions of samples_per_record on one channel (current_channel).
+        The PSD/Power Spectrum is accumulated as the DMA buffers arrive (see WelchAccumulator),
+        with the same segments and units as make_psd, so the memory used does not depend on psd_averages.
 
         Output:
             - psd (List[Array]): first element is frequency axis, second element is psd 
         """
         # Acquire signal on current_channel
         self.active_channels.set([self.current_channel.get()])
-        data = self.continuous_read.get()
-        # Perform psd
-        return self.make_psd(data)
+        if self.trigger_mode.get()!="Continuous":
+            self.trigger_mode.set("Continuous")
+            self._initialized = False
+        if not self._initialized:
+            self._async_trig()
+        nperseg, nfft, scaling = self._psd_params()
+        scale, offset = self.get_scale_offset()
+        # mV to V
+        accumulator = WelchAccumulator(self.sample_rate.get(), nperseg, nfft,
+                                       window=convert_window_function(self.window_function.get(), nperseg),
+                                       scaling=scaling, scale=scale*1e-3, offset=offset*1e-3)
+        buffersToAcquire = self._TRIGbuffersPerRecord * self.psd_averages.get()
+        buffer_count = self.buffer_count.get()
+        samplesPerBuffer = self._TRIGsamplesPerBuffer
+        sample_type = self.board_info["Sample_type"]  # output data type
+        timeout = self.timeout.get()  # timeout
+
+        try:
+            buffersCompleted = 0
+            while buffersCompleted < buffersToAcquire:
+                buffer = self.buffers[buffersCompleted % buffer_count]
+                self._board.waitAsyncBufferComplete(buffer.addr, timeout_ms=timeout)
+                accumulator.add(np.frombuffer(buffer.buffer, dtype=sample_type)[:samplesPerBuffer])
+                buffersCompleted += 1
+                self._board.postAsyncBuffer(buffer.addr, buffer.size_bytes)
+        finally:
+            self._board.abortAsyncRead()
+            self._initialized = False
+
+        return self._psd_output(*accumulator.result())
 
 
     def smooth_curve(self, data, sliding_mean_points):
@@ -2137,50 +2740,31 @@ class ATSBoard(BaseInstrument):
 
     def detection_threshold(self, data, trigger_level_descend, trigger_level_ascend):
         """
-        Detects all the times at which a signal goes above trigger_level_ascend or below triger_level_descend           
+        Detects all the times at which a signal goes below triger_level_descend after having been above trigger_level_ascend
+        and vice versa (hysteresis, see detect_thresholds).
         
         Input:
             - data (Array): 2D array of size (2, samples_per_record)
-            - trigger_level_descend (float): Value for which to trigger if previous value is above and current value is below  
-            - trigger_level_ascend (float): Value for which to trigger if previous value is below and current value is above
+            - trigger_level_descend (float): Value for which to trigger if signal was high and current value is below  
+            - trigger_level_ascend (float): Value for which to trigger if signal was low and current value is above
 
         
         Ouput:
             - triggers [Array, Array]: List of times at which trigger_level_descend was triggered, List of times at which trigger_level_ascend was triggered 
         """        
-        trigger_descend = data[1] > trigger_level_descend  # True if value of signal is above trigger_level_descend, False otherwise 
-        trigger_ascend = data[1] < trigger_level_ascend  # True if value of signal is below trigger_level_ascend, False otherwise
-        
-        has_trigger_descend = trigger_descend[:-1] > trigger_descend[1:]  # True if signal is above trigger_level_descend at time t and below at time t+dt  
-        has_trigger_ascend = trigger_ascend[:-1] > trigger_ascend[1:]  # True if signal is below trigger_level_ascend at time t and above at time t+dt 
-        
-        triggers_index_descend = np.nonzero(has_trigger_descend)  # get indices at which trigger_level_descend was triggered
-        triggers_index_ascend = np.nonzero(has_trigger_ascend)  # get indices at which trigger_level_ascend was triggered
-        
-        return [data[0][triggers_index_descend], data[0][triggers_index_ascend]]  # times at which triggers took place
-        # trigger_descend = data[1] > trigger_level_descend  # True if value of signal is above trigger_level_descend, False otherwise 
-        # trigger_ascend = data[1] > trigger_level_ascend  # True if value of signal is above trigger_level_ascend, False otherwise
-        # n = len(trigger_descend)
-        # yth = np.zeros(n)
-        # for i in range(1, n):
-        #     if yth[i-1]:
-        #         yth[i] = trigger_descend[i]
-        #     else:
-        #         yth[i] = trigger_ascend[i]
-
-        # has_trigger = yth[:-1] != yth[1:]  # True if signal is above trigger_level_descend at time t and below at time t+dt  
-        
-        # triggers_index = np.nonzero(has_trigger)  # get indices at which trigger_level_descend was triggered
-        
-        # return data[0][triggers_index] # times at which triggers took place  
+        descend, ascend, ndescend, nascend = detect_thresholds(data[1], data[0], trigger_level_descend, trigger_level_ascend)
+        return [descend[0, :ndescend[0]], ascend[0, :nascend[0]]]  # times at which triggers took place
 
 
-    def get_data_threshold(self, n, max_length_threshold, detected_threshold_descend, detected_threshold_ascend):
-        returned_data_sample_number = [i*np.ones(max_length_detected_threshold) for i in range(n)]
-        returned_data_threshold_descend = [np.concatenate((detected_threshold_descend[i], -1*np.ones(max_length_threshold-len(detected_threshold_descend[i]))), axis=0) for i in range(n)]
-        returned_data_threshold_ascend = [np.concatenate((detected_threshold_ascend[i], -1*np.ones(max_length_threshold-len(detected_threshold_ascend[i]))), axis=0) for i in range(n)]
-        
-        return [returned_data_sample_number, returned_data_threshold_descend, returned_data_threshold_ascend]
+    def get_data_threshold(self, detected_threshold_descend, detected_threshold_ascend):
+        """
+        Takes the padded 2D arrays (nbwindows, max detections) of detect_thresholds and returns
+        them as columns (like get_data): acquisition number, descend times, ascend times.
+        The missing detections are -1.
+        """
+        n, width = detected_threshold_descend.shape
+        returned_data_sample_number = np.repeat(np.arange(n, dtype=float), width)
+        return [returned_data_sample_number, detected_threshold_descend.ravel(), detected_threshold_ascend.ravel()]
 
 
     def _rabi_getdev(self):
@@ -2189,39 +2773,27 @@ class ATSBoard(BaseInstrument):
         For each signal, smooth the curve using a sliding mean and detect the trigger_level_descend and trigger_level_ascend.
         If you don't want to smooth the curve, set sliding_mean_points to 0
 
+        All the windows are processed together (see detect_thresholds), rabi_chunk_rows at a time.
+
         Output:
-            - detected threshold List(Array): List of 2*nbwindows Array. 
-                                              Index 2*n contains times at which trigger_level_descend was triggered for acquisition number n
-                                              Index 2*n+1 contains times at which trigger_level_ascend was triggered for acquisition number n
+            - detected threshold List(Array): 3 columns: acquisition number, times at which trigger_level_descend
+                                              was triggered and times at which trigger_level_ascend was triggered.
+                                              Every acquisition has the same number of rows, the missing detections are -1.
         """
         # Acquisition
         data = self.fetch_all.get()
-        # Detecting the thresholds
-        detected_threshold_descend = []
-        detected_threshold_ascend = []
         nbwindows = self.nbwindows.get()
         nbsamples = self.samples_per_record.get()
-        new_data = [np.reshape(data[1], (nbwindows, nbsamples)),
-                    np.reshape(data[2], (nbwindows, nbsamples))]
-        trigger_level_descend = self.trigger_level_descend.get()
-        trigger_level_ascend = self.trigger_level_ascend.get()
-        nbpoints_sliding_mean = self.sliding_mean_points.get()
-        max_length_detected_threshold = 0
-
-        for i in range(0, n):
-            # For each signal acquired
-            # Detect the thresholds on the smoothed curve
-            thresholds = self.detection_threshold(self.smooth_curve([new_data[1][i], data[2][i]],
-                                                                     nbpoints_sliding_mean),
-                                                  trigger_level_descend,
-                                                  trigger_level_ascend)
-            max_length_detected_threshold = max(max_length_detected_threshold,
-                                                max(len(detected_threshold[0]),
-                                                    len(detected_threshold[1])))
-            detected_threshold_descend.append(thresholds[0])
-            detected_threshold_ascend.append(thresholds[1])
-
-        return get_data_threshold(n, detected_threshold_ascend, detected_threshold_descend)
+        times = data[1][:nbsamples]
+        signals = np.reshape(data[2], (nbwindows, nbsamples))
+        chunk_rows = self.rabi_chunk_rows.get()
+        # Detecting the thresholds on the smoothed curves
+        descend, ascend, ndescend, nascend = detect_thresholds(signals, times,
+                                                               self.trigger_level_descend.get(),
+                                                               self.trigger_level_ascend.get(),
+                                                               sliding_mean_points=self.sliding_mean_points.get(),
+                                                               chunk_rows=chunk_rows if chunk_rows > 0 else None)
+        return self.get_data_threshold(descend, ascend)
 
 
     def _create_devs(self):
@@ -2245,6 +2817,8 @@ class ATSBoard(BaseInstrument):
                                                                                "kaiser",
                                                                                "flattop",
                                                                                "uniform"])
+        self.psd_averages = MemoryDevice(1, min=1, autoinit=True, doc=
+            "Number of gapless records of samples_per_record averaged by psd (the memory used does not depend on it).")
         self.psd_units = MemoryDevice("V**2/Hz", autoinit=True, choices=["V",
                                                                          "dBV",
                                                                          "V**2",
@@ -2397,6 +2971,8 @@ class ATSBoard(BaseInstrument):
             "Level to detect for ascending signal when calling rabi device")
         self.sliding_mean_points = MemoryDevice(0, autoinit=True, get_has_check=True, doc=
             "Number of points used to smooth the signal before detecting the trigger_level_ascend and trigger_level_descend in rabi")
+        self.rabi_chunk_rows = MemoryDevice(0, min=0, autoinit=True, doc=
+            "Number of acquisitions processed at once by rabi (to limit the memory used). 0 means all of them.")
 
         self._devwrap("readval", autoinit=False)
         self._devwrap("readval_all", autoinit=False)
@@ -35,14 +35,29 @@ from ..instruments_base import (visaInstrument, visaInstrumentAsync, visaAutoLoa
 # It is needed to prevent cyclic import problems:
 #   logical and load_instruments use function in instruments_registry which
 #   import this module.
-def _populate_instruments():
+def _populate_instruments(lazy=None):
+    """ lazy: when True, the instruments modules are imported only when needed
+              (see config.load_instruments). The default (None) uses the
+              lazy_instruments entry of the configuration file.
+    """
     global logical, _loaded
     # logical is excluded from config.load_instruments because it needs to be loaded
     # first. Other devices depend on it.
     from . import logical
 
+    if lazy is None:
+        lazy = _config.pyHegel_conf.lazy_instruments
     # Now load all other instruments.*
-    _loaded = _config.load_instruments(exclude=['logical'])
+    _loaded = {}
+    _loaded.update(_config.load_instruments(exclude=['logical'], lazy=lazy))
+
+
+# Used (python >= 3.7) to import the lazy modules on first access
+def __getattr__(name):
+    return _registry.load_lazy_name(name)
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(_registry._lazy_names.keys()))
 
 
 # This space will be filled up by config.load_instruments
@@ -35,7 +35,8 @@ from ..instruments_base import visaInstrument, visaInstrumentAsync,\
                             decode_float64, decode_float64_avg, decode_float64_meanstd,\
                             decode_uint16_bin, _decode_block_base, _decode_block_auto, decode_float64_2col,\
                             decode_complex128, sleep, locked_calling, visa_wrap, _encode_block,\
-                            ChoiceSimple, _retry_wait, Block_Codec, ChoiceSimpleMap, ProxyMethod
+                            ChoiceSimple, _retry_wait, Block_Codec, ChoiceSimpleMap, ProxyMethod,\
+                            Block_Direct
 from ..instruments_registry import register_instrument, register_usb_name, register_idn_alias
 
 from ..comp2to3 import fb
@@ -58,6 +59,9 @@ class agilent_rf_33522A(visaInstrument):
     New code should use the unumbered devices (numbered device are there for compatibility.)
     The devices
     """
+    # SCPI compound commands are accepted (see visaInstrument.batch_get and batch_set)
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     def init(self, full=False):
         # This should depend on the endian type of the machine. Here we assume intel which is LSB.
         self.write('FORMat:BORDer SWAPped') # This is LSB
@@ -384,6 +388,8 @@ class agilent_PowerMeter(visaInstrumentAsync):
              to compensate for the circuit used. It also depends on the frequency.
              You can read this correction value with freq_offset
     """
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     # As of (firmware A1.01.07) the relative value cannot be read.
     # The instrument has 4 display position (top upper, top lower, ...)
     #  1=upper window upper meas, 2=lower upper, 3=upper lower, 4=lower lower
@@ -487,6 +493,8 @@ class agilent_rf_PSG(visaInstrument):
     Available methods:
         phase_sync
     """
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     @locked_calling
     def _current_config(self, dev_obj=None, options={}):
         # TODO Get the proper config
@@ -517,8 +525,6 @@ class agilent_rf_PSG(visaInstrument):
         self.oscillator_source = scpiDevice(getstr=':ROSCillator:SOURce?', str_type=str)
         self.rf_en = scpiDevice(':OUTPut', str_type=bool)
         self.ampl = scpiDevice(':POWer', str_type=float, doc='unit depends on device ampl_unit', setget=True)
-        self.ampl_unit = scpiDevice(':UNIT:POWer', choices=ChoiceStrings('DBM', 'DBUV', 'DBUVEMF', 'V', 'VEMF', 'DB'),
-                                    doc='Note that EMF are 2x above the base unit (power arriving at infinite impedance load)')
         # unit:volt:type affects volt scale like power:alc:search:ref:level, which are not user changeable
         self.ampl_offset_db = scpiDevice(':POWer:OFFset', str_type=float, min=-200, max=+200)
         self.ampl_reference_dbm = scpiDevice(':POWer:REFerence', str_type=float, doc='This value is always in dBm')
@@ -528,6 +534,10 @@ class agilent_rf_PSG(visaInstrument):
         self.ampl_protection = scpiDevice(':POWer:PROTection', str_type=bool, doc='When enabled, sets the attenuation to maximum when performing a power search. Could decrease the life of the attenuator.')
         self.ampl_start = scpiDevice(':POWer:STARt', str_type=float, doc='unit depends on device ampl_unit', setget=True)
         self.ampl_stop = scpiDevice(':POWer:STOP', str_type=float, doc='unit depends on device ampl_unit', setget=True)
+        # changing the unit changes the values of the amplitude devices
+        self.ampl_unit = scpiDevice(':UNIT:POWer', choices=ChoiceStrings('DBM', 'DBUV', 'DBUVEMF', 'V', 'VEMF', 'DB'),
+                                    cache_invalidate=[self.ampl, self.ampl_start, self.ampl_stop],
+                                    doc='Note that EMF are 2x above the base unit (power arriving at infinite impedance load)')
         # TODO handle the search stuff for when alc is off
         self.alc_en = scpiDevice(':POWer:ALC', str_type=bool)
         self.alc_source = scpiDevice(':POWer:ALC:SOURce', choices=ChoiceStrings('INTernal', 'DIODe'))
@@ -696,6 +706,8 @@ class agilent_multi_34410A(visaInstrumentAsync):
     Set it first.
 
     """
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     #def _async_trigger_helper(self):
     #    if hasattr(self, 'init_resets_ptp'):
     #        if self.init_resets_ptp.get():
@@ -1425,7 +1437,7 @@ class infiniiVision_3000(visaInstrumentAsync):
          #  and one of them (often in the 70's) would hang (as seen with io monitor).
          # The above observation were with either NI or Keysight visa lib and with the
          #   DSO-X 3014T,MY61500174,07.50.2021102830
-        self.data = scpiDevice(getstr=':waveform:DATA?', raw=True, str_type=decode_uint16_bin, autoinit=False, chunk_size=1024*1024)
+        self.data = scpiDevice(getstr=':waveform:DATA?', raw=True, str_type=Block_Direct(decode_uint16_bin, '<u2'), autoinit=False, chunk_size=1024*1024)
           # also read :WAVeform:PREamble?, which provides, format(byte,word,ascii),
           #  type (Normal, peak, average, HRes), #points, #avg, xincr, xorg, xref, yincr, yorg, yref
           #  xconv = xorg+x*xincr, yconv= (y-yref)*yincr + yorg
@@ -3549,7 +3561,7 @@ class agilent_FieldFox(agilent_PNAL):
         self.calib_en = scpiDevice('SENSe:CORRection:STATe', str_type=bool)
         # needed by PNAL fetch
         class sweep_type_C(object):
-            def getcache(self):
+            def getcache(self, local=False, max_age=None):
                 return 'linear'
             choices = ChoiceStrings('LINear', 'LOGarithmic', 'POWer', 'CW', 'SEGMent', 'PHASe')
         self.sweep_type = sweep_type_C()
@@ -3862,6 +3874,8 @@ class agilent_power_supply_E363x(visaInstrument):
     Changing the output level can take a while depending on connected load impedance.
     Output off means the volt level becomes 0, the current level is 0.05. It is not a relay.
     """
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     @locked_calling
     def _current_config(self, dev_obj=None, options={}):
         orig_ch = self.current_ch.getcache()
@@ -33,6 +33,8 @@ import ctypes
 import os
 import time
 import gc
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from ctypes import c_long, c_int, c_uint, c_uint64, c_ubyte, POINTER, byref, create_string_buffer, Structure, Array, pointer
 
@@ -138,6 +140,289 @@ class PostProcess(object):
             opts += self.chain.current_config()
         return opts
 
+class NumpyPostProcess(PostProcess):
+    """ Base class for post processing done with numpy in python threads.
+        The data given with new_data_array is cut in chunks of chunk_size samples
+        (per channel) that are processed in a pool of nthreads threads as soon
+        as new_data reports them ready. The partial results are combined
+        in the calling thread (check_in_progress, check_is_done and complete).
+        All the arrays given between reset and complete are accumulated.
+        The data array can be (Nch, N) or (N,) for a single channel.
+        To test, just feed arrays:
+            p = HistogramPP()
+            p.init(1000)
+            p.reset()
+            p.new_data_array(np.random.randint(0, 256, 1000).astype(np.uint8))
+            hist = p.complete()
+        Subclasses need to define _process_chunk and _merge, and possibly
+        _init_results, _usable_length, _align, _result and the overlap attribute
+        (the number of samples after a chunk that it also needs).
+    """
+    overlap = 0
+    def __init__(self, chunk_size=2**20, nthreads=None):
+        if nthreads is None:
+            nthreads = cpu_count()
+        self.chunk_size = int(chunk_size)
+        self.nthreads = nthreads
+        self.chain = None
+        self._pool = None
+        self._jobs = []
+        self._data = None
+        self._n = 0
+        self._submitted = 0
+        self._done = 0
+        self._stop = False
+    def init(self, Nsamples, Nch=1, chain=None):
+        """ Keeps the previous chain when chain is None """
+        if chain is None:
+            chain = self.chain
+        super(NumpyPostProcess, self).init(Nsamples, Nch, chain)
+        if self._pool is None:
+            self._pool = ThreadPool(self.nthreads)
+    def stop(self):
+        self._stop = True
+        self._collect(wait=True)
+        self._stop = False
+        super(NumpyPostProcess, self).stop()
+    def reset(self):
+        self._collect(wait=True)
+        self._data = None
+        self._n = 0
+        self._submitted = 0
+        self._done = 0
+        self.n_arrays = 0
+        self._init_results()
+        super(NumpyPostProcess, self).reset()
+    def _init_results(self):
+        pass
+    def _usable_length(self, n):
+        """ number of samples of an array of length n that are processed """
+        return n
+    def _align(self, stop):
+        """ returns a valid end of chunk <= stop """
+        return stop
+    def new_data_array(self, data, sample_count_ready=None):
+        """ sample_count_ready of None means all the data is ready """
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape((1, -1))
+        # finish (and merge) the jobs of the previous array before restarting the counts
+        self._collect(wait=True)
+        self._data = data
+        self._n = self._usable_length(data.shape[1])
+        self._submitted = 0
+        self._done = 0
+        self.n_arrays += 1
+        if self.chain:
+            self.chain.new_data_array(data, 0)
+        if sample_count_ready is None:
+            sample_count_ready = data.shape[1]
+        self.new_data(sample_count_ready)
+    def new_data(self, sample_count_ready):
+        data = self._data
+        if data is not None:
+            full = data.shape[1]
+            ready = min(sample_count_ready, full)
+            while self._submitted < self._n:
+                start = self._submitted
+                stop = self._align(min(start + self.chunk_size, self._n, ready))
+                if stop <= start or (stop + self.overlap > ready and ready < full):
+                    break
+                self._jobs.append(self._pool.apply_async(self._run_chunk, (data, start, stop)))
+                self._submitted = stop
+        if self.chain:
+            self.chain.new_data(sample_count_ready)
+    def _run_chunk(self, data, start, stop):
+        if self._stop:
+            return None
+        return self._process_chunk(data, start, stop), stop-start
+    def _collect(self, wait=False):
+        jobs = self._jobs
+        while jobs and (wait or jobs[0].ready()):
+            ret = jobs.pop(0).get()
+            if ret is not None and not self._stop:
+                self._merge(ret[0])
+                self._done += ret[1]
+    def check_in_progress(self):
+        self._collect()
+        return self._done
+    def check_is_done(self):
+        self._collect()
+        done = not self._jobs and self._submitted == self._n
+        if self.chain:
+            done = done and self.chain.check_is_done()
+        return done
+    def complete(self):
+        """ Waits for the calculations and returns the result.
+            With a chain, it returns a list of the results of all the chain elements.
+        """
+        self._collect(wait=True)
+        result = self._result()
+        if self.Nch == 1:
+            result = result[0]
+        if self.chain:
+            rest = self.chain.complete()
+            if not (isinstance(self.chain, NumpyPostProcess) and self.chain.chain):
+                rest = [rest]
+            return [result] + rest
+        return result
+    def release(self):
+        self._collect(wait=True)
+        self._data = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        super(NumpyPostProcess, self).release()
+    def current_config(self):
+        opts = ['%s(chunk_size=%i, nthreads=%i)'%(self.__class__.__name__, self.chunk_size, self.nthreads)]
+        return opts + super(NumpyPostProcess, self).current_config()
+
+class HistogramPP(NumpyPostProcess):
+    """ Histogram of the raw values of each channel, using bincount.
+        The result is an array (Nch, nbins) of counts, where the bin i is for
+        the raw value bin_values[i]:
+            8 bit data (uint8): 256 bins for 0 to 255
+            16 bit data (int16): 65536 bins for -32768 to 32767
+            10 bit data (uint16): 2**bits bins starting at 0 (bits defaults to 16)
+    """
+    def __init__(self, bits=None, **kwargs):
+        self.bits = bits
+        self.bin_values = None
+        super(HistogramPP, self).__init__(**kwargs)
+    def new_data_array(self, data, sample_count_ready=None):
+        dtype = np.asarray(data).dtype
+        if dtype == np.uint8:
+            nbins, start = 2**8, 0
+        elif dtype == np.int16:
+            nbins, start = 2**16, -2**15
+        elif dtype == np.uint16:
+            nbins, start = 2**(16 if self.bits is None else self.bits), 0
+        else:
+            raise ValueError('Unsupported data type for HistogramPP: %s'%dtype)
+        if self.bin_values is None or len(self.bin_values) != nbins or self.bin_values[0] != start:
+            self.bin_values = np.arange(start, start+nbins)
+            self._hist = np.zeros((self.Nch, nbins), dtype=np.int64)
+        super(HistogramPP, self).new_data_array(data, sample_count_ready)
+    def _init_results(self):
+        self.bin_values = None
+    def _process_chunk(self, data, start, stop):
+        nbins = len(self.bin_values)
+        ret = []
+        for d in data[:, start:stop]:
+            if d.dtype == np.int16:
+                d = d.view(np.uint16) ^ 0x8000
+            ret.append(np.bincount(d, minlength=nbins)[:nbins])
+        return ret
+    def _merge(self, partial):
+        for h, p in zip(self._hist, partial):
+            h += p
+    def _result(self):
+        if self.bin_values is None:
+            return np.zeros((self.Nch, 0), dtype=np.int64)
+        return self._hist
+
+class MeanVarPP(NumpyPostProcess):
+    """ Running mean and variance (with ddof, like np.var) of each channel,
+        combined across chunks and arrays (Chan et al. parallel algorithm).
+        The result is an array (Nch, 2) of [mean, variance] in raw units.
+    """
+    def __init__(self, ddof=0, **kwargs):
+        self.ddof = ddof
+        super(MeanVarPP, self).__init__(**kwargs)
+    def _init_results(self):
+        self._count = 0
+        self._mean = np.zeros(self.Nch)
+        self._m2 = np.zeros(self.Nch)
+    def _process_chunk(self, data, start, stop):
+        d = data[:, start:stop]
+        mean = d.mean(axis=1, dtype=np.float64)
+        m2 = np.array([np.square(c - m).sum() for c, m in zip(d, mean)])
+        return stop-start, mean, m2
+    def _merge(self, partial):
+        nb, mean_b, m2_b = partial
+        na = self._count
+        n = na + nb
+        delta = mean_b - self._mean
+        self._mean += delta*(nb/n)
+        self._m2 += m2_b + delta**2*(na*nb/n)
+        self._count = n
+    def _result(self):
+        n = self._count
+        var = self._m2/(n - self.ddof) if n > self.ddof else self._m2*np.nan
+        return np.array([self._mean, var]).T
+
+class BlockAveragePP(NumpyPostProcess):
+    """ Trace where each point is the average of block_size consecutive samples
+        (the incomplete last block is dropped). It is also averaged over all the arrays.
+        The result is an array (Nch, N//block_size).
+    """
+    def __init__(self, block_size, **kwargs):
+        self.block_size = int(block_size)
+        super(BlockAveragePP, self).__init__(**kwargs)
+        self.chunk_size = max(self.chunk_size - self.chunk_size%self.block_size, self.block_size)
+    def _init_results(self):
+        self._sum = None
+    def _usable_length(self, n):
+        return n - n%self.block_size
+    def _align(self, stop):
+        return stop - stop%self.block_size
+    def new_data_array(self, data, sample_count_ready=None):
+        data = np.asarray(data)
+        nblocks = data.shape[-1]//self.block_size
+        if self._sum is None:
+            self._sum = np.zeros((self.Nch, nblocks))
+        elif self._sum.shape[1] != nblocks:
+            raise ValueError('All the arrays need to have the same length for BlockAveragePP')
+        super(BlockAveragePP, self).new_data_array(data, sample_count_ready)
+    def _process_chunk(self, data, start, stop):
+        b = self.block_size
+        d = data[:, start:stop]
+        return start//b, d.reshape((d.shape[0], -1, b)).mean(axis=2, dtype=np.float64)
+    def _merge(self, partial):
+        i, avg = partial
+        self._sum[:, i:i+avg.shape[1]] += avg
+    def _result(self):
+        if self._sum is None:
+            return np.zeros((self.Nch, 0))
+        return self._sum/max(self.n_arrays, 1)
+
+class AutocorrelationPP(NumpyPostProcess):
+    """ Autocorrelation of each channel for lags 0 to nlags-1, calculated with FFTs:
+            acf[k] = mean_i((x[i]-offset)*(x[i+k]-offset))
+        where the mean is over all the available pairs in all the arrays.
+        offset is subtracted from the raw data first (like the data_offset of the channel
+        or the mean obtained with MeanVarPP).
+        The result is an array (Nch, nlags).
+    """
+    def __init__(self, nlags, offset=0., **kwargs):
+        self.nlags = int(nlags)
+        self.offset = offset
+        super(AutocorrelationPP, self).__init__(**kwargs)
+        self.overlap = self.nlags - 1
+    def _init_results(self):
+        self._sum = np.zeros((self.Nch, self.nlags))
+        self._pairs = np.zeros(self.nlags)
+    def new_data_array(self, data, sample_count_ready=None):
+        n = np.asarray(data).shape[-1]
+        self._pairs += np.maximum(n - np.arange(self.nlags), 0)
+        super(AutocorrelationPP, self).new_data_array(data, sample_count_ready)
+    def _process_chunk(self, data, start, stop):
+        n = data.shape[1]
+        a = data[:, start:stop] - float(self.offset)
+        y = data[:, start:min(stop + self.nlags - 1, n)] - float(self.offset)
+        nfft = 2**int(np.ceil(np.log2(a.shape[1] + y.shape[1])))
+        corr = np.fft.irfft(np.conj(np.fft.rfft(a, nfft, axis=1))*np.fft.rfft(y, nfft, axis=1), nfft, axis=1)
+        nl = min(self.nlags, y.shape[1])
+        ret = np.zeros((data.shape[0], self.nlags))
+        ret[:, :nl] = corr[:, :nl]
+        return ret
+    def _merge(self, partial):
+        self._sum += partial
+    def _result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sum/self._pairs
+
 def pp(o, align=20, base='', nmax=None):
     """ prints a ctypes structure (or a dictionnary from ppdict) recursivelly """
     fmt = '%%-%is %%s'%align
@@ -202,6 +487,27 @@ def ppdict(o, nmax=None):
 
 GiS = 2.**30
 
+def conv_scale_into(data, out, offset, resolution, chunk_size=2**22, pool=None):
+    """ Computes out = (data-offset)*resolution in place in out (1D arrays),
+        by chunks of chunk_size samples (which limits the temporary memory).
+        When a ThreadPool is given in pool, the chunks are shared among its threads.
+    """
+    n = len(data)
+    if len(out) != n:
+        raise ValueError('out does not have the same length as data')
+    def conv(start):
+        stop = min(start+chunk_size, n)
+        o = out[start:stop]
+        np.subtract(data[start:stop], offset, out=o, casting='unsafe')
+        o *= resolution
+    starts = range(0, n, chunk_size)
+    if pool is None or len(starts) < 2:
+        for start in starts:
+            conv(start)
+    else:
+        pool.map(conv, starts)
+    return out
+
 def get_memory():
     try:
         import psutil
@@ -259,6 +565,8 @@ class guzik_adp7104(BaseInstrument):
         board_index = 0 # needs to be <c_n_avail_analyzer
         self._board_index = board_index
         self._gsa_data_arg = None
+        self._fetch_out = None
+        self._conv_pool = None
         serial_no = create_string_buffer(SDK.GSA_READ_CH_ID_LENGTH)
         pxi_addr = create_string_buffer(SDK.GSA_READ_CH_ID_LENGTH)
         brd_arg = SDK.GSA_BRD_LIST_ARG(version=SDK.GSA_SDK_VERSION)
@@ -327,6 +635,7 @@ class guzik_adp7104(BaseInstrument):
         self._gsa_data_res_tf = None
         self._gsa_data_res_ts = None
         # free previous data memory
+        self._fetch_out = None
         self.fetch.setcache(None)
         # Finally make sure memory is released.
         # Note that at least for numpy 1.16.5, python 2.7.16, ctypes 1.1.0
@@ -586,10 +895,46 @@ class guzik_adp7104(BaseInstrument):
     def conv_scale(data, res):
         return (data-res.common.data_offset)*(res.common.ampl_resolution*1e-3)
 
-    def _fetch_getdev(self, raw=True):
+    def _conv_volts(self, data, out=None, dtype=np.float64, reuse_out=False):
+        Nch = self._gsa_Nch
+        res_arr = self._gsa_data_res_arr
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise ValueError(self.perror('dtype needs to be a floating point type'))
+        if out is None and reuse_out:
+            out = self._fetch_out
+            if out is not None and (out.shape != data.shape or out.dtype != dtype):
+                out = None
+        if out is None:
+            self._fetch_out = None # release the old one first
+            out = np.empty(data.shape, dtype)
+            if reuse_out:
+                self._fetch_out = out
+        elif out.shape != data.shape or out.dtype.kind != 'f':
+            raise ValueError(self.perror('out needs to be a floating point array of shape %s'%(data.shape,)))
+        if self._conv_pool is None:
+            self._conv_pool = ThreadPool(cpu_count())
+        data_2d = data if Nch>1 else data.reshape((1, -1))
+        out_2d = out if Nch>1 else out.reshape((1, -1))
+        for i in range(Nch):
+            conv_scale_into(data_2d[i], out_2d[i], res_arr[i].common.data_offset,
+                            res_arr[i].common.ampl_resolution*1e-3, pool=self._conv_pool)
+        return out
+
+    def _fetch_getdev(self, raw=True, post_process=None, out=None, dtype=np.float64, reuse_out=False):
         """
         options:
             raw: when True (default) it will return the integer. When False, converts to volts.
+            post_process: a PostProcess object (like HistogramPP, MeanVarPP, BlockAveragePP
+                          or AutocorrelationPP, possibly chained). When given, it is fed the raw
+                          data and its result (from complete) is returned instead of the data.
+            The following are for raw=False. The conversion is done in place, by chunks
+            shared among threads, so only the output array is needed.
+            dtype: the dtype of the converted result: np.float64 (default) or np.float32
+                   (which uses half the memory).
+            out: an array (of the same shape as the raw data) to use for the result.
+            reuse_out: when True, the same output array is kept and reused for the next
+                       fetch with reuse_out (so a result is overwritten by the next one).
             bin (see get documentation)
         """
         SDK = self._gsasdk
@@ -600,11 +945,14 @@ class guzik_adp7104(BaseInstrument):
         if SDK.GSA_Data_Multi(arg, Nch, res_arr) == SDK.GSA_FALSE:
             raise RuntimeError(self.perror('Had a problem reading data.'))
         data = self._gsa_data
+        if post_process is not None:
+            data_2d = data if Nch>1 else data.reshape((1, -1))
+            post_process.init(data_2d.shape[1], Nch)
+            post_process.reset()
+            post_process.new_data_array(data_2d, data_2d.shape[1])
+            return post_process.complete()
         if not raw:
-            if Nch == 1:
-                data = self.conv_scale(data, res_arr[0])
-            else:
-                data = np.array([self.conv_scale(data[i], res_arr[i]) for i in range(Nch)])
+            data = self._conv_volts(data, out, dtype, reuse_out)
         return data
 
     def __del__(self):
@@ -613,6 +961,9 @@ class guzik_adp7104(BaseInstrument):
 
     def close(self):
         self._destroy_op()
+        if getattr(self, '_conv_pool', None) is not None:
+            self._conv_pool.close()
+            self._conv_pool = None
         SDK = self._gsasdk
         SDK.GSA_SysDone(self._gsa_sys_cfg)
 
@@ -32,7 +32,7 @@ from ..instruments_base import visaInstrumentAsync, visaInstrument,\
                             ChoiceBase, _general_check, _fromstr_helper, _tostr_helper,\
                             ChoiceStrings, ChoiceMultiple, ChoiceMultipleDep, Dict_SubDevice,\
                             KeyError_Choices, _decode_block_base, make_choice_list,\
-                            sleep, locked_calling, np_frombuffer
+                            sleep, locked_calling, np_frombuffer, np_tobytes
 from ..instruments_registry import register_instrument
 
 from ..types import StructureImproved
@@ -467,13 +467,20 @@ class waveformdata(object):
         self.return_only_header = return_only_header
     def __call__(self, inputstr):
         ds =inputstr.split(',', 1) # strip DESC, TEXT, TIME, DAT1, DAT2, ALL
-        fullblock = _decode_block_base(ds[1])
+        return self._decode(_decode_block_base(ds[1]))
+    def direct_read(self, instr, question, chunk_size=None):
+        # read_block skips the DESC, TEXT ... prefix and reads the block without copies.
+        # The data arrays are then views of the block.
+        return self._decode(instr.ask_block(question, np.uint8, chunk_size=chunk_size))
+    def _decode(self, fullblock):
         header = WAVEDESC.from_buffer_copy(fullblock)
         if self.return_only_header:
             return header
         ptr = header.WAVE_DESCRIPTOR
         w = header.USER_TEXT
         usertext = fullblock[ptr:ptr+w]
+        if isinstance(usertext, np.ndarray):
+            usertext = np_tobytes(usertext)
         ptr += w
         w = header.RES_DESC1
         if header.RES_DESC1 or header.RES_ARRAY1 or header.RES_ARRAY2 or header.RES_ARRAY3:
@@ -493,13 +500,13 @@ class waveformdata(object):
         w = header.WAVE_ARRAY_2
         data2 = fullblock[ptr:ptr+w]
         data_type = [np.int8, np.int16][header.COMM_TYPE]
-        if data1:
+        if len(data1):
             data1 = np_frombuffer(data1, data_type)
-        if data2:
+        if len(data2):
             data2 = np_frombuffer(data1, data_type)
-        if trigtime:
+        if len(trigtime):
             trigtime = np_frombuffer(trigtime, [('trig_time', np.float64), ('time_offset', np.float64)])
-        if ristime:
+        if len(ristime):
             ristime = np_frombuffer(ristime, np.float64)
         return waveformdataType(header, data1, data2, trigtime, ristime, usertext)
     def tostr(self, val):
@@ -45,7 +45,7 @@ def _asDevice(dev):
 class _dummy_delay_Dev(object):
     def __init__(self, log_device_proxy):
         self.log_device = log_device_proxy
-    def getcache(self):
+    def getcache(self, local=False, max_age=None):
         return self.log_device.async_delay
 
 class _LogicalInstrument(BaseInstrument):
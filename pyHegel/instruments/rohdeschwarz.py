@@ -39,7 +39,8 @@ from ..instruments_base import visaInstrument, visaInstrumentAsync,\
                             ChoiceStrings, ChoiceDevDep, ChoiceDev, ChoiceDevSwitch, ChoiceIndex,\
                             ChoiceSimpleMap, decode_float32, decode_int8, decode_int16, _decode_block_base,\
                             decode_float64, quoted_string, _fromstr_helper, ProxyMethod, _encode_block,\
-                            locked_calling, quoted_list, quoted_dict, decode_complex128, Block_Codec
+                            locked_calling, quoted_list, quoted_dict, decode_complex128, Block_Codec,\
+                            Block_Direct
 from ..instruments_registry import register_instrument, register_usb_name, register_idn_alias
 
 from ..comp2to3 import string_bytes_types, string_upper
@@ -68,6 +69,9 @@ class rs_sgma(visaInstrument):
     implemented requires to call apply_settings. This is done automatically for those (except
     for _raw and _request) versions. For other instruction it might be required.
     """
+    # SCPI compound commands are accepted (see visaInstrument.batch_get and batch_set)
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
     def __init__(self, visa_addr, othergenset_func=None, override_extension=False, **kwargs):
         self._override_extension = override_extension
         if othergenset_func is None:
@@ -906,8 +910,8 @@ class rs_rto_scope(visaInstrumentAsync):
         self.waveform_data_header = ChannelWaveform(getstr='CHANnel{ch}:WAVeform{wf}:DATA:HEADer?',
                 choices=ChoiceMultiple(['x_start', 'x_stop', 'n_sample', 'n_sample_per_interval'],
                 [float, float, int, int]), autoinit=False)
-        self.waveform_data = ChannelWaveform(getstr='CHANnel{ch}:WAVeform{wf}:DATA?', str_type=ProxyMethod(self._decode_waveform_data),
-                autoinit=False, raw=True, chunk_size=1000*1024)
+        self.waveform_data = ChannelWaveform(getstr='CHANnel{ch}:WAVeform{wf}:DATA?', str_type=Block_Direct(ProxyMethod(self._decode_waveform_data),
+                ProxyMethod(self._waveform_data_dtype)), autoinit=False, raw=True, chunk_size=1000*1024)
         # changing en/current seems to modify current for all channels
         #  wai is needed so that a subsequent read obtains the new current channel.
         #  The graphical switch loading probably takes some time so you could process for example
@@ -1087,6 +1091,10 @@ class rs_rto_scope(visaInstrumentAsync):
         # This needs to be last to complete creation
         super(rs_rto_scope, self)._create_devs()
 
+    def _waveform_data_dtype(self):
+        # used by waveform_data to read binary data directly into an array.
+        form, bitp = self.set_format()
+        return dict(int8=np.int8, int16='<i2', real='<f4').get(form, None)
     def _decode_waveform_data(self, fromstr):
         form, bitp = self.set_format()
         termination = '\n'
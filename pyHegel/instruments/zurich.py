@@ -38,6 +38,10 @@
 from __future__ import absolute_import, print_function, division
 
 import numpy as np
+import re
+import threading
+import time
+import weakref
 #import zhinst.ziPython as zi
 #import zhinst.utils as ziu
 zi = None
@@ -310,6 +314,204 @@ class ziDev(scpiDevice):
 #  zoomFFT/settling/time
 #  zoomFFT/window  (new in 13.10)
 
+#######################################################
+##    Demodulator streaming
+#######################################################
+
+class _DemodRing(object):
+    """
+    Ring buffer of the (timestamp, x, y) samples of one demodulator.
+    It keeps statistics:
+        overflow: number of samples dropped because the buffer was full
+        gaps:     number of discontinuities seen in the timestamps
+        missing:  estimated number of samples missing in those gaps
+    The time between samples (dt in clock ticks) is obtained from the first data
+    (or can be given).
+    """
+    def __init__(self, capacity, dt=None):
+        self.capacity = capacity = int(capacity)
+        self.ts = np.zeros(capacity, np.uint64)
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.start = 0
+        self.count = 0
+        self.overflow = 0
+        self.gaps = 0
+        self.missing = 0
+        self.total = 0
+        self.last_ts = None
+        self.dt = dt
+    def append(self, ts, x, y):
+        ts = np.asarray(ts, np.uint64)
+        n = len(ts)
+        if n == 0:
+            return
+        if self.last_ts is None:
+            diffs = np.diff(ts.astype(np.int64))
+        else:
+            diffs = np.diff(np.concatenate(([self.last_ts], ts)).astype(np.int64))
+        if self.dt is None and len(diffs):
+            self.dt = np.median(diffs)
+        if self.dt:
+            big = diffs[diffs > 1.5*self.dt]
+            self.gaps += len(big)
+            self.missing += int(np.round(big/self.dt - 1).sum())
+        self.last_ts = ts[-1]
+        self.total += n
+        cap = self.capacity
+        if n > cap:
+            self.overflow += n - cap
+            ts, x, y = ts[-cap:], x[-cap:], y[-cap:]
+            n = cap
+        drop = self.count + n - cap
+        if drop > 0:
+            self.overflow += drop
+            self.start = (self.start + drop) % cap
+            self.count -= drop
+        idx = (self.start + self.count + np.arange(n)) % cap
+        self.ts[idx] = ts
+        self.x[idx] = x
+        self.y[idx] = y
+        self.count += n
+    def _ordered(self, arr):
+        stop = self.start + self.count
+        if stop <= self.capacity:
+            return arr[self.start:stop]
+        return np.concatenate((arr[self.start:], arr[:stop-self.capacity]))
+    def timestamps(self):
+        return self._ordered(self.ts)
+    def take(self, indices):
+        """ returns ts, x, y for the indices (in the ordered buffer) """
+        idx = (self.start + np.asarray(indices)) % self.capacity
+        return self.ts[idx], self.x[idx], self.y[idx]
+    def discard(self, n):
+        """ removes the n oldest samples """
+        n = int(min(n, self.count))
+        self.start = (self.start + n) % self.capacity
+        self.count -= n
+    def clear(self):
+        self.discard(self.count)
+
+class DemodStreamer(object):
+    """
+    Reads the subscribed demodulator samples (with the read/pollEvent of the instrument)
+    in a background thread and dispatches them in one ring buffer (_DemodRing) per channel.
+    get_block returns blocks aligned in time: only the timestamps present for all the
+    channels are returned (the others are dropped and counted in unaligned).
+    """
+    _path_re = re.compile(r'/demods/(\d+)/sample$')
+    def __init__(self, instr, channels, capacity=2**20, poll_timeout_ms=50):
+        # a proxy so the thread does not keep the instrument alive
+        self.instr = weakref.proxy(instr)
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.poll_timeout_ms = poll_timeout_ms
+        self.rings = {ch:_DemodRing(capacity) for ch in self.channels}
+        self.unaligned = {ch:0 for ch in self.channels}
+        self._lock = threading.Lock()
+        self._new_data = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = None
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='DemodStreamer')
+        self._thread.daemon = True
+        self._thread.start()
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        self._thread = None
+        # the instrument can be deleted (and stop the streamer) from the thread itself
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                data = self.instr.read(self.poll_timeout_ms)
+                if data:
+                    self.add_poll_data(data)
+        except ReferenceError:
+            # the instrument was deleted
+            self._stop.set()
+            with self._lock:
+                self._new_data.notify_all()
+        except Exception as exc:
+            self._error = exc
+            with self._lock:
+                self._new_data.notify_all()
+    def add_poll_data(self, data):
+        """ Dispatches the result of a pollEvent (dict of path: sample dict or list of them) """
+        with self._lock:
+            for path, val in data.items():
+                m = self._path_re.search(path.lower())
+                if m is None:
+                    continue
+                ch = int(m.group(1))
+                if ch not in self.rings:
+                    continue
+                if isinstance(val, dict):
+                    val = [val]
+                for v in val:
+                    self.rings[ch].append(v['timestamp'], v['x'], v['y'])
+            self._new_data.notify_all()
+    def _aligned_timestamps(self):
+        common = None
+        for ch in self.channels:
+            ts = self.rings[ch].timestamps()
+            common = ts if common is None else np.intersect1d(common, ts, assume_unique=True)
+        return common
+    def get_block(self, n=None, timeout=10.):
+        """
+        Returns (timestamps, {ch:(x, y)}) for n samples aligned in time (the oldest ones available).
+        When n is None, returns all the aligned samples available now.
+        It waits up to timeout s for n samples (raising a RuntimeError otherwise).
+        The returned samples (and the unaligned ones before them) are removed from the buffers.
+        """
+        to = time.time()
+        with self._lock:
+            while True:
+                if self._error is not None:
+                    raise RuntimeError('Demod streaming stopped by an error: %r'%self._error)
+                common = self._aligned_timestamps()
+                if n is None or len(common) >= n:
+                    break
+                remaining = timeout - (time.time() - to)
+                if remaining <= 0:
+                    raise RuntimeError('Timeout waiting for %i demod samples (only %i available)'%(n, len(common)))
+                if not self.is_running():
+                    raise RuntimeError('Demod streaming is not running (only %i samples available)'%len(common))
+                self._new_data.wait(min(remaining, 1.))
+            if n is not None:
+                common = common[:n]
+            ret = {}
+            for ch in self.channels:
+                ring = self.rings[ch]
+                ts = ring.timestamps()
+                if len(common):
+                    idx = np.searchsorted(ts, common)
+                    t, x, y = ring.take(idx)
+                    used = int(idx[-1]) + 1
+                    self.unaligned[ch] += used - len(common)
+                    ring.discard(used)
+                else:
+                    x = y = np.zeros(0)
+                ret[ch] = (x, y)
+            return common, ret
+    def stats(self):
+        """ Returns a dict (per channel) of the buffer statistics """
+        with self._lock:
+            return {ch:dict(available=r.count, total=r.total, overflow=r.overflow, gaps=r.gaps,
+                            missing=r.missing, unaligned=self.unaligned[ch], dt_ticks=r.dt)
+                    for ch, r in self.rings.items()}
+    def clear(self):
+        with self._lock:
+            for r in self.rings.values():
+                r.clear()
+
+
 #######################################################
 ##    Zurich Instruments UHF (600 MHz, 1.8 GS/s lock-in amplifier)
 #######################################################
@@ -382,8 +584,15 @@ class zurich_UHF(BaseInstrument):
         # since 22.08 sweep requires first setting the device
         self._zi_sweep.set('device', zi_dev)
         self._current_mode = 'lia'
+        self._demod_streamer = None
         super(zurich_UHF, self).__init__()
         self._async_select()
+    def __del__(self):
+        # only stop the poll thread: the instrument is being destroyed.
+        streamer = self.__dict__.get('_demod_streamer')
+        if streamer is not None:
+            streamer.stop()
+        super(zurich_UHF, self).__del__()
     def _tc_to_enbw_3dB(self, tc=None, order=None, enbw=True):
         """
         When enbw=True, uses the formula for the equivalent noise bandwidth
@@ -605,6 +814,47 @@ class zurich_UHF(BaseInstrument):
         #   it seems to repeat pollEvent as long as duration is not finished
         #   so the duration can be rounded up by timeout if no data is available.
         return self._zi_daq.pollEvent(timeout_ms)
+    def stream_start(self, ch=None, capacity=2**20, poll_timeout_ms=50):
+        """
+        Starts the continuous streaming of the demodulators ch (a list, or None for
+        all the enabled ones). The samples are read in a background thread
+        (by polls of poll_timeout_ms, between which the instrument lock is released)
+        into ring buffers of capacity samples per channel.
+        Get the data with the stream_data device and the state with stream_stats.
+        Stop with stream_stop.
+        Do not use read (or poll anything else) while streaming.
+        """
+        self.stream_stop()
+        channels = self._fetch_ch_helper(ch)
+        streamer = DemodStreamer(self, channels, capacity, poll_timeout_ms)
+        for c in channels:
+            self._subscribe('/{dev}/demods/%i/sample'%c)
+        self.flush()
+        self._demod_streamer = streamer
+        streamer.start()
+    def stream_stop(self):
+        """ Stops the streaming started by stream_start. The data not read is lost. """
+        streamer = self._demod_streamer
+        if streamer is None:
+            return
+        self._demod_streamer = None
+        streamer.stop()
+        for c in streamer.channels:
+            self._unsubscribe('/{dev}/demods/%i/sample'%c)
+    def stream_stats(self):
+        """
+        Returns, per streamed channel, a dict with
+            available: samples in the ring buffer
+            total:     samples received since the start
+            overflow:  samples dropped because the ring buffer was full (read faster or increase capacity)
+            gaps:      number of discontinuities in the timestamps (samples lost before reaching the computer)
+            missing:   estimated number of samples lost in those gaps
+            unaligned: samples dropped by stream_data because the other channels did not have that timestamp
+            dt_ticks:  the time between samples in clock ticks
+        """
+        if self._demod_streamer is None:
+            raise RuntimeError('Streaming is not started. Use stream_start.')
+        return self._demod_streamer.stats()
     @locked_calling
     def write(self, command, val=None, src='main', t=None, sync=True):
         """
@@ -922,6 +1172,35 @@ class zurich_UHF(BaseInstrument):
         if ret.shape[0]==1:
             ret=ret[0]
         return ret
+    def _stream_data_getformat(self, **kwarg):
+        streamer = self._demod_streamer
+        channels = streamer.channels if streamer is not None else []
+        multi = ['timestamp']
+        for c in channels:
+            multi += ['ch%i_x'%c, 'ch%i_y'%c]
+        fmt = self.stream_data._format
+        fmt.update(multi=multi)
+        return BaseDevice.getformat(self.stream_data, **kwarg)
+    def _stream_data_getdev(self, n=None, timeout=10., raw_timestamp=False):
+        """
+           Returns the next n samples (all the available ones when n is None) of the demodulators
+           streamed by stream_start, aligned in time, as an array:
+               timestamp, ch_x, ch_y, ... (for all the streamed channels)
+           The timestamps are in s unless raw_timestamp is True (then in clock ticks).
+           It waits up to timeout s for the n samples.
+           See stream_stats for the lost samples.
+        """
+        streamer = self._demod_streamer
+        if streamer is None:
+            raise RuntimeError(self.perror('Streaming is not started. Use stream_start.'))
+        ts, data = streamer.get_block(n, timeout)
+        if raw_timestamp:
+            ret = [ts.astype(float)]
+        else:
+            ret = [self.timestamp_to_s(ts.astype(float))]
+        for c in streamer.channels:
+            ret += list(data[c])
+        return np.array(ret)
     def _create_devs(self):
         system_options = self.ask('/{dev}/features/options', settings_only=False)[0].split('\n')
         if system_options[-1] == '' and len(system_options) > 1:
@@ -1091,6 +1370,7 @@ class zurich_UHF(BaseInstrument):
 #  sweep/remainingtime
 
         self._devwrap('fetch', autoinit=False, trig=True)
+        self._devwrap('stream_data', autoinit=False)
         self.readval = ReadvalDev(self.fetch)
         self.alias = self.readval
 
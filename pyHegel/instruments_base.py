@@ -25,14 +25,18 @@ from __future__ import absolute_import, print_function, division
 
 import numpy as np
 import string
+import bisect
 import functools
 import ctypes
 import hashlib
 import os
+import re
 import signal
 import sys
 import time
+import warnings
 import threading
+import traceback
 import weakref
 from collections import OrderedDict  # this is a subclass of dict
 from .qt_wrap import processEvents_managed, sleep
@@ -44,10 +48,16 @@ from . import types as _types
 from .types import dict_improved
 from .comp2to3 import is_py2, string_bytes_types, thread_error, get_ident, string_upper,\
                         write_unicode_byte, fu, fb, make_str, get_terminal_size
+if is_py2:
+    import Queue as queue
+else:
+    import queue
+
 if is_py2:
     translate_del_lower = lambda s: s.translate(None, string.ascii_lowercase)
 else:
-    translate_del_lower = lambda s: s.translate(s.maketrans('', '', string.ascii_lowercase))
+    _del_lower_table = str.maketrans('', '', string.ascii_lowercase)
+    translate_del_lower = lambda s: s.translate(_del_lower_table)
 
 try:
     np_frombuffer = np.frombuffer
@@ -365,8 +375,13 @@ def _writevec(file_obj, vals_list, pre_str=''):
     to a string use repr.
     The columns in the file are separated by tabs.
     pre_str is prepended to every line. Can use '#' when adding comments.
+    For a binary container (container.ContainerWriter), the data lines
+    (no pre_str) are saved in binary.
     """
     vals_list = _writevec_flatten_list(vals_list)
+    if not pre_str and hasattr(file_obj, 'write_row'):
+        file_obj.write_row(vals_list)
+        return
     strs_list = list(map(_repr_or_string_unicode, vals_list))
     file_obj.write(fu(pre_str)+fu(u'\t'.join(strs_list))+u'\n')
 
@@ -395,7 +410,25 @@ def _replace_ext(filename, newext=None):
     return root+newext
 
 
+def _write_dev_container(val, container, format, first):
+    headers = None
+    if first:
+        headers = ['#'+h.replace('\n', '\\n').replace('\r', '\\r')+'\n' for h in _get_conf_header(format) or []]
+        extra_conf = format['extra_conf']
+        if extra_conf:
+            headers.extend(extra_conf.splitlines(True))
+        multi = format['multi']
+        if isinstance(multi, tuple):
+            headers.append('#'+'\t'.join(multi)+'\n')
+    container.write_array(format['base_hdr_name'], val, headers, format['append'], format['bin'])
+    format['obj']._last_filename = container.name
+
 def _write_dev(val, filename, format=format, first=False):
+    container = format.get('container', None)
+    if container is not None:
+        # the main file is a binary container, the data goes in it.
+        _write_dev_container(val, container, format, first)
+        return
     append = format['append']
     bin = format['bin']
     dev = format['obj']
@@ -494,6 +527,132 @@ def _retry_wait(func, timeout, delay=0.01, progress_base='Wait', progress_timed=
     return ret
 
 
+#######################################################
+##    Timing statistics
+#######################################################
+
+# Upper edges (in s) of the latency histogram bins. There is an extra bin for longer times.
+timing_bins = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1., 10.]
+
+class _TimingEntry(object):
+    __slots__ = ['count', 'total', 'min', 'max', 'nbytes', 'hist']
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = 0.
+        self.nbytes = 0
+        self.hist = [0]*(len(timing_bins)+1)
+    def add(self, dt, nbytes=0):
+        self.count += 1
+        self.total += dt
+        if self.min is None or dt < self.min:
+            self.min = dt
+        if dt > self.max:
+            self.max = dt
+        self.nbytes += nbytes
+        self.hist[bisect.bisect_left(timing_bins, dt)] += 1
+    def as_dict(self):
+        return dict(count=self.count, total=self.total, min=self.min, max=self.max,
+                    mean=self.total/self.count if self.count else None,
+                    nbytes=self.nbytes, hist=list(self.hist))
+
+def _timing_name(obj):
+    # read the header cache directly: getcache would count in the cache stats.
+    try:
+        if isinstance(obj, BaseDevice):
+            return obj.instr.header._cache+'.'+obj.name
+        elif isinstance(obj, BaseInstrument) and obj.header._cache is not None:
+            return obj.header._cache
+    except Exception:
+        pass
+    return getattr(obj, '_timing_name', obj.__class__.__name__)
+
+class TimingStats(object):
+    """
+    Collects the number of calls, the time taken (total, min, max and an histogram
+    with the edges in timing_bins) and the number of bytes transferred of operations
+    on devices (get, set, decode, file_write) and instruments (read, write, ask,
+    rw_wait (the wait between visa operations) and lock_wait).
+    It is disabled by default (set enabled to True). When disabled, the only cost is
+    checking the enabled attribute.
+    The module instance timing_stats is used by pyHegel.
+    The statistics are kept per object (objects with the same name are kept
+    separate), under a key that does not change for the life of the object.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._data = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._next_key = 0
+    def add(self, obj, op, dt, nbytes=0):
+        with self._lock:
+            try:
+                key, ops = self._data[obj]
+            except KeyError:
+                key, ops = self._data[obj] = (self._next_key, {})
+                self._next_key += 1
+            try:
+                entry = ops[op]
+            except KeyError:
+                entry = ops[op] = _TimingEntry()
+            entry.add(dt, nbytes)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def key(self, obj):
+        """
+        Returns the key of obj used in snapshot (None if obj has no statistics).
+        obj can also be a weakref.proxy (like the instr attribute of devices).
+        """
+        with self._lock:
+            try:
+                return self._data[obj][0]
+            except KeyError:
+                return None
+            except TypeError:
+                # a proxy cannot be weak referenced, but it compares equal to its object.
+                for o, (key, ops) in self._data.items():
+                    if o == obj:
+                        return key
+                return None
+    def snapshot(self):
+        """
+        Returns a dictionnary of (key, operation): stats_dict
+        where key identifies the object (see the key method) and stats_dict contains
+        name (the name of the object, for display), count, total, min, max, mean, nbytes and hist.
+        """
+        with self._lock:
+            items = [(obj, key, op, entry.as_dict()) for obj, (key, ops) in self._data.items() for op, entry in ops.items()]
+        ret = {}
+        for obj, key, op, st in items:
+            st['name'] = _timing_name(obj)
+            ret[(key, op)] = st
+        return ret
+
+def timing_diff(after, before):
+    """
+    Returns the difference of two TimingStats snapshots.
+    The min and max are the ones from after (they are over the full period).
+    """
+    ret = {}
+    for k, st in after.items():
+        prev = before.get(k)
+        if prev is None:
+            ret[k] = st
+            continue
+        count = st['count'] - prev['count']
+        if count == 0:
+            continue
+        total = st['total'] - prev['total']
+        ret[k] = dict(name=st['name'], count=count, total=total, min=st['min'], max=st['max'],
+                      mean=total/count, nbytes=st['nbytes'] - prev['nbytes'],
+                      hist=[a-b for a, b in zip(st['hist'], prev['hist'])])
+    return ret
+
+timing_stats = TimingStats()
+
+
 class Lock_Extra(object):
     def acquire(self):
         return False
@@ -520,6 +679,16 @@ class Lock_Instruments(threading._RLock):
         func = lambda : super(Lock_Instruments, self).acquire(blocking=0)
         return _retry_wait(func, timeout, delay=0.001)
     def acquire(self):
+        if timing_stats.enabled:
+            # only the contended acquires (that need to wait) are recorded.
+            if super(Lock_Instruments, self).acquire(blocking=0):
+                return True
+            to = time.time()
+            ret = wait_on_event(self.acquire_timeout)
+            owner = getattr(self, '_timing_owner', None)
+            if owner is not None and owner() is not None:
+                timing_stats.add(owner(), 'lock_wait', time.time()-to)
+            return ret
         return wait_on_event(self.acquire_timeout)
     __enter__ = acquire
     def is_owned(self):
@@ -675,6 +844,38 @@ class FastEvent(_base_event):
             self._cond = FastCondition(threading.Lock())
             self._flag = False
 
+if not is_py2:
+    class SlicedEvent(threading.Event):
+        """
+        Same as threading.Event, but in the main thread wait blocks for at most
+        slice_time s at a time and processes the gui events in between, so the gui
+        stays responsive and CTRL-C is handled (on windows a timed lock acquire
+        cannot be interrupted). Other threads block for the full timeout.
+        """
+        slice_time = 0.02
+        def wait(self, timeout=None):
+            if threading.current_thread() is not threading.main_thread():
+                return super(SlicedEvent, self).wait(timeout)
+            if timeout is not None:
+                endtime = time.time() + timeout
+            while True:
+                if timeout is None:
+                    wait_time = self.slice_time
+                else:
+                    wait_time = max(0., min(endtime - time.time(), self.slice_time))
+                with _sleep_signal_context_manager():
+                    if super(SlicedEvent, self).wait(wait_time):
+                        return True
+                if timeout is not None and time.time() >= endtime:
+                    return False
+                processEvents_managed(max_time_ms = 20)
+
+# An event whose wait reacts as soon as it is set.
+# On python 3, Event.wait blocks on a condition variable (no polling, so no delay).
+# SlicedEvent keeps the gui alive when the wait is in the main thread.
+# On python 2, Event.wait polls with increasing delays (up to 50 ms), so use FastEvent there.
+_cond_event = FastEvent if is_py2 else SlicedEvent
+
 # modified 2023-09-18 to also match python 3.11
 class FastCondition(_base_cond):
     def wait(self, timeout=None, balancing=True): # Newer version of threading have added balencing
@@ -758,10 +959,9 @@ class FastCondition(_base_cond):
 #Enable basic async for any device (like sr830) by allowing a delay before performing mesurement
 #Allow to chain one device on completion of another one.
 
-class asyncThread(threading.Thread):
-    def __init__(self, operations, lock_instrument, lock_extra, init_ops, detect=None, delay=0., trig=None, cleanup=None):
-        super(asyncThread, self).__init__()
-        self.daemon = True
+class _asyncTaskBase(object):
+    # The common part of asyncThread and asyncJob
+    def _async_init(self, operations, lock_instrument, lock_extra, init_ops, detect=None, delay=0., trig=None, cleanup=None):
         self.__stop = False
         self._async_delay = delay
         self._async_trig = trig
@@ -818,12 +1018,71 @@ class asyncThread(threading.Thread):
         #print('Thread finished in ', time.time()-t0)
     def cancel(self):
         self.__stop = True
+
+class asyncThread(_asyncTaskBase, threading.Thread):
+    def __init__(self, operations, lock_instrument, lock_extra, init_ops, detect=None, delay=0., trig=None, cleanup=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._async_init(operations, lock_instrument, lock_extra, init_ops, detect, delay, trig, cleanup)
     def wait(self, timeout=None):
         # we use a the context manager because join uses sleep.
         with _sleep_signal_context_manager():
             self.join(timeout)
         return not self.is_alive()
 
+class asyncJob(_asyncTaskBase):
+    """
+    Same as asyncThread, but instead of running in a new thread, start sends
+    it to a persistent worker thread (_AsyncWorker).
+    """
+    def __init__(self, worker, operations, lock_instrument, lock_extra, init_ops, detect=None, delay=0., trig=None, cleanup=None):
+        self._async_init(operations, lock_instrument, lock_extra, init_ops, detect, delay, trig, cleanup)
+        self._worker = worker
+        self._done = _cond_event()
+        self._started = False
+    def start(self):
+        if self._started:
+            raise RuntimeError('asyncJob can only be started once')
+        self._started = True
+        self._worker.submit(self)
+    def _execute(self):
+        try:
+            self.run()
+        except Exception:
+            # same as an exception in a thread.
+            print('Exception in async job of %s:'%self._worker.name, file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self._done.set()
+    def is_alive(self):
+        return self._started and not self._done.is_set()
+    def wait(self, timeout=None):
+        with _sleep_signal_context_manager():
+            self._done.wait(timeout)
+        return self._done.is_set()
+
+class _AsyncWorker(threading.Thread):
+    """
+    Long lived thread that runs the asyncJob it receives (in order).
+    """
+    def __init__(self, name='async worker'):
+        super(_AsyncWorker, self).__init__(name=name)
+        self.daemon = True
+        self._jobs = queue.Queue()
+        self.start()
+    def submit(self, job):
+        self._jobs.put(job)
+    def stop(self):
+        self._jobs.put(None)
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            job._execute()
+            # don't keep a reference to the job (and its instrument)
+            job = None
+
 
 # For proper KeyboardInterrupt handling, the docheck function should
 # be internally protected with _sleep_signal_context_manager
@@ -928,7 +1187,8 @@ class BaseDevice(object):
     def __init__(self, autoinit=True, doc='', setget=False, allow_kw_as_dict=False,
                   allow_missing_dict=False, allow_val_as_first_dict=False, get_has_check=False,
                   min=None, max=None, choices=None, multi=False, graph=True,
-                  trig=False, redir_async=None, setget_delay=None):
+                  trig=False, redir_async=None, setget_delay=None, cache_max_age=None,
+                  cache_invalidate=None):
         # instr and name updated by instrument's _create_devs
         # doc is inserted before the above doc
         # autoinit can be False, True or a number.
@@ -949,11 +1209,25 @@ class BaseDevice(object):
         # setget_delay is an minimum wait time between a set and a following get of a values.
         #   some device take time to update, and enabling setget would return the wrong values
         #   without an added delay.
+        # cache_max_age is the age (in s) after which getcache will redo a get instead
+        #   of returning the cache. None uses the instrument cache_max_age
+        #   (which is only used for autoinit devices).
+        #   It can be changed later with the cache_max_age attribute.
+        # cache_invalidate is a list of devices whose cache become invalid
+        #   after a set of this device (their next getcache will redo a get
+        #   if they are autoinit or have a max age.)
+        #   The devices that depend on this one (see _cache_depends) are
+        #   added to it when the instrument is created.
         self.instr = None
         self.name = 'foo'
         # Use thread local data to keep the last_filename and a version of cache
         self._local_data = threading.local()
         self._cache = None
+        self._cache_time = None
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self.cache_max_age = cache_max_age
+        self._cache_invalidate = list(cache_invalidate) if cache_invalidate is not None else []
         self._set_delayed_cache = None
         self._check_cache = {}
         self._autoinit = autoinit
@@ -1022,28 +1296,57 @@ class BaseDevice(object):
     #    get should return the same thing set uses
     @locked_calling_dev
     def set(self, *val, **kwarg):
+        to = timing_stats.enabled and time.time()
+        val, kwarg, set_kwarg = self._set_check(val, kwarg)
+        if not CHECKING():
+            self._set_delayed_cache = None  # used in logical devices
+            self._setdev(val, **set_kwarg)
+        # only change cache after succesfull _setdev
+        self._set_done(val, kwarg, to)
+    def _set_check(self, val, kwarg):
+        """
+        Checks the values (val is the tuple of positional arguments) and options of a set
+        (for set and visaInstrument.batch_set).
+        Returns (val, kwarg, set_kwarg) to use for the set.
+        """
         if not CHECKING():
             # So when checking, self.check will be seen as in a check instead
             # of a set.
             self._check_cache['in_set'] = True
         self.check(*val, **kwarg)
         if self._check_cache:
-            val = self._check_cache['val']
-            kwarg = self._check_cache['kwarg']
-            set_kwarg = self._check_cache['set_kwarg']
-        else:
-            val = val[0]
-            set_kwarg = kwarg
-        if not CHECKING():
-            self._set_delayed_cache = None  # used in logical devices
-            self._setdev(val, **set_kwarg)
+            return self._check_cache['val'], self._check_cache['kwarg'], self._check_cache['set_kwarg']
+        return val[0], kwarg, kwarg
+    def _set_done(self, val, kwarg, to, shared=1, got=False):
+        """
+        Bookkeeping done by set (and visaInstrument.batch_set) after writing to the instrument:
+        does the setget read back (unless got is True, then val is the value already
+        read back), updates the cache, invalidates the related devices and
+        updates the timing stats (see _get_done for to and shared).
+        """
+        if not CHECKING() and not got:
             self._local_data.last_set_time = time.time()
             if self._setget:
                 val = self.get(**kwarg)
             elif self._set_delayed_cache is not None:
                 val = self._set_delayed_cache
-        # only change cache after succesfull _setdev
         self.setcache(val)
+        if not CHECKING():
+            self._invalidate_related()
+        if to:
+            timing_stats.add(self, 'set', (time.time()-to)/shared)
+    def _invalidate_related(self):
+        for dev in self._cache_invalidate:
+            dev.invalidate_cache()
+    def _cache_depends(self):
+        """
+        Returns the list of devices whose set can change the value of this one
+        (here the device of a ChoiceDevDep choices). The instrument adds this device
+        to their cache_invalidate list.
+        """
+        if isinstance(self.choices, ChoiceDevDep):
+            return [self.choices.dev]
+        return []
     @locked_calling_dev
     def set_ret_cache(self, *val, **kwarg):
         self.set(*val, **kwarg)
@@ -1054,17 +1357,9 @@ class BaseDevice(object):
     def get(self, **kwarg):
         if self._getdev_p is None:
             raise NotImplementedError(self.perror('This device does not handle _getdev'))
+        to = timing_stats.enabled and time.time()
         if not CHECKING() or self._get_has_check:
-            if self._setget_delay is not None:
-                last = getattr(self._local_data, 'last_set_time', 0)
-                extra_wait = self._setget_delay - (time.time() - last)
-                if extra_wait > 0:
-                    wait(extra_wait)
-            self._last_filename = None
-            format = self.getformat(**kwarg)
-            kwarg.pop('graph', None) #now remove graph from parameters (was needed by getformat)
-            kwarg.pop('bin', None) #same for bin
-            kwarg.pop('extra_conf', None)
+            format = self._get_start(kwarg)
             to_finish = False
             if kwarg.get('filename', False) and not format['file']:
                 #we did not ask for a filename but got one.
@@ -1082,15 +1377,52 @@ class BaseDevice(object):
                 else:
                     ret = self.getcache()
             if to_finish:
+                tw = to and time.time()
                 _write_dev(ret, filename, format=format)
+                if tw:
+                    timing_stats.add(self, 'file_write', time.time()-tw)
                 if format['bin']:
                     ret = None
         else:
             ret = self.getcache()
-        self.setcache(ret)
+        self._get_done(ret, to)
         return ret
+    def _get_start(self, kwarg):
+        """
+        Bookkeeping done by get (and visaInstrument.batch_get) before reading the instrument:
+        waits for setget_delay and obtains the format. The format only options
+        are removed from kwarg (which is modified). Returns the format.
+        """
+        if self._setget_delay is not None:
+            last = getattr(self._local_data, 'last_set_time', 0)
+            extra_wait = self._setget_delay - (time.time() - last)
+            if extra_wait > 0:
+                wait(extra_wait)
+        self._last_filename = None
+        format = self.getformat(**kwarg)
+        kwarg.pop('graph', None) #now remove graph from parameters (was needed by getformat)
+        kwarg.pop('bin', None) #same for bin
+        kwarg.pop('extra_conf', None)
+        return format
+    def _get_done(self, ret, to, shared=1):
+        """
+        Bookkeeping done by get (and visaInstrument.batch_get) after reading the instrument:
+        updates the cache and the timing stats (to is the start time or False when
+        not timing, shared is the number of devices read by the same request).
+        """
+        self.setcache(ret)
+        if to:
+            timing_stats.add(self, 'get', (time.time()-to)/shared)
+    def _get_cache_max_age(self, max_age=None):
+        if max_age is not None:
+            return max_age
+        if self.cache_max_age is not None:
+            return self.cache_max_age
+        if self._autoinit:
+            return getattr(self.instr, 'cache_max_age', None)
+        return None
     #@locked_calling_dev
-    def getcache(self, local=False):
+    def getcache(self, local=False, max_age=None):
         """
         With local=True, returns thread local _cache. If it does not exist yet,
             returns None. Use this for the data from a last fetch if another
@@ -1102,6 +1434,10 @@ class BaseDevice(object):
             and you want the last one. However if another thread is changing values,
             or the user changed the values on the instrument maually (using the front panel),
             than you better do get instead of getcache to really get the up to date value.
+        max_age: when the cache is older than this (in s) a get is done instead.
+            When None, the device cache_max_age is used, or, for autoinit devices,
+            the instrument cache_max_age. A None age never expires.
+            See also cache_stats.
         """
         if local:
             try:
@@ -1110,14 +1446,47 @@ class BaseDevice(object):
                 return None
         # local is False
         with self.instr._lock_instrument: # only local data, so don't need _lock_extra
-            if self._cache is None and self._autoinit and not CHECKING():
+            if CHECKING():
+                return self._cache
+            refresh = self._cache is None and self._autoinit
+            if not refresh and self._cache is not None and self._getdev_p is not None:
+                max_age = self._get_cache_max_age(max_age)
+                if max_age is not None:
+                    refresh = self._cache_time is None or time.time() - self._cache_time > max_age
+            if refresh:
+                self._cache_misses += 1
                 # This can fail, but getcache should not care for
                 #InvalidAutoArgument exceptions
                 try:
                     return self.get()
                 except InvalidAutoArgument:
                     self._cache = None
+            elif self._cache is None:
+                self._cache_misses += 1
+            else:
+                self._cache_hits += 1
             return self._cache
+    def invalidate_cache(self):
+        """
+        Marks the cache as invalid. The next getcache will do a get
+        if the device is autoinit or has a max age (otherwise the cache is cleared).
+        """
+        with self.instr._lock_instrument: # only local data, so don't need _lock_extra
+            self._cache_time = None
+            if self._get_cache_max_age() is None:
+                self._cache = None
+    def cache_stats(self, reset=False):
+        """
+        Returns a dictionnary with the number of cache hits and misses of getcache,
+        and the age in s of the cache (None if it was never set).
+        With reset=True, the counters are restarted.
+        """
+        ct = self._cache_time
+        ret = dict(hits=self._cache_hits, misses=self._cache_misses,
+                   age=None if ct is None else time.time() - ct)
+        if reset:
+            self._cache_hits = self._cache_misses = 0
+        return ret
     def _do_redir_async(self):
         obj = self
         # go through all redirections
@@ -1145,11 +1514,14 @@ class BaseDevice(object):
         return ret
     #@locked_calling_dev
     def setcache(self, val, nolock=False):
+        now = time.time()
         if nolock == True:
             self._cache = val
+            self._cache_time = now
         else:
             with self.instr._lock_instrument: # only local data, so don't need _lock_extra
                 self._cache = val
+                self._cache_time = now
         self._local_data.cache = val # thread local, requires no lock
     def __call__(self, val=None):
         raise SyntaxError("""Do NOT call a device directly, like instr.dev().
@@ -1411,11 +1783,18 @@ class BaseInstrument(object):
     # add _quiet_delete here in case we call __del__ before __init__ because of problem in subclass
     _quiet_delete = False
     _quiet_load = True
+    # When True, the async operations are run by a persistent worker thread (per instrument)
+    # instead of a new thread for every async get.
+    _async_use_worker = True
+    # Default max age (in s) of the cache of the autoinit devices (see BaseDevice.getcache).
+    # None means the cache never expires. Devices can override it with their own cache_max_age.
+    cache_max_age = None
     def __init__(self, quiet_delete=False, quiet_load=True):
         self._quiet_load = quiet_load
         self._quiet_delete = quiet_delete
         self.header_val = None
         self._lock_instrument = Lock_Instruments()
+        self._lock_instrument._timing_owner = weakref.ref(self)
         if not hasattr(self, '_lock_extra'):
             # don't overwrite what is assigned in subclasses
             self._lock_extra = Lock_Extra()
@@ -1432,13 +1811,22 @@ class BaseInstrument(object):
         self.init(full=True)
         self._quiet_load = False
     def __del__(self):
+        worker = self.__dict__.get('_async_worker')
+        if worker is not None:
+            worker.stop()
         if not (self._quiet_delete or self._quiet_load):
             print('Destroying '+repr(self))
     def __setattr__(self, attrname, value):
         #print('Settiung attr', attrname)
-        if hasattr(self, "_protect_device_assignments") and self._protect_device_assignments and \
-            hasattr(self, attrname) and isinstance(getattr(self, attrname), BaseDevice):
-            raise RuntimeError('You are not allowed to change a device by using assignment; use set(dev, val) instead of dev=val.')
+        # Look directly in the dictionaries: hasattr would go through __getattr__ (and perror)
+        # for every new attribute which is slow (this is called for every device creation).
+        d = self.__dict__
+        if d.get('_protect_device_assignments', False):
+            old = d.get(attrname, None)
+            if old is None:
+                old = getattr(type(self), attrname, None)
+            if isinstance(old, BaseDevice):
+                raise RuntimeError('You are not allowed to change a device by using assignment; use set(dev, val) instead of dev=val.')
         super(BaseInstrument, self).__setattr__(attrname, value)
     def _async_select(self, devs):
         """ It receives a list of devices to help decide how to wait.
@@ -1507,6 +1895,12 @@ class BaseInstrument(object):
             d.async_wait_start = 0.
             d.async_wait = 0.
         return d
+    def _get_async_worker(self):
+        worker = self.__dict__.get('_async_worker')
+        if worker is None or not worker.is_alive():
+            worker = _AsyncWorker(name='async worker of %s'%self.__class__.__name__)
+            self._async_worker = worker
+        return worker
     def _under_async_setup(self, task):
         self._async_running_task = task
     def _under_async(self):
@@ -1535,7 +1929,11 @@ class BaseInstrument(object):
                 data.async_select_list = []
                 data.async_list_init = [(self._async_select, (data.async_select_list, ), {})]
                 delay = self.async_delay.getcache()
-                data.async_task = asyncThread(data.async_list, self._lock_instrument, self._lock_extra, data.async_list_init, delay=delay)
+                if self._async_use_worker:
+                    data.async_task = asyncJob(self._get_async_worker(), data.async_list,
+                                               self._lock_instrument, self._lock_extra, data.async_list_init, delay=delay)
+                else:
+                    data.async_task = asyncThread(data.async_list, self._lock_instrument, self._lock_extra, data.async_list_init, delay=delay)
                 data.async_list_init.append((self._under_async_setup, (data.async_task,), {}))
                 data.async_level = 0
             if trig:
@@ -1574,19 +1972,16 @@ class BaseInstrument(object):
     def find_global_name(self):
         return _find_global_name(self)
     @classmethod
+    def _devwrap_funcs(cls, name):
+        """ returns the (setdev, getdev, checkdev, getformat) methods of the class
+            for the device name (_name_setdev ...). The missing ones are None.
+        """
+        return tuple([getattr(cls, '_'+name+'_'+f, None) for f in ('setdev', 'getdev', 'checkdev', 'getformat')])
+    @classmethod
     def _cls_devwrap(cls, name):
         # Only use this if the class will be using only one instance
         # Otherwise multiple instances will collide (reuse same wrapper)
-        setdev = getdev = checkdev = getformat = None
-        for s in dir(cls):
-            if s == '_'+name+'_setdev':
-                setdev = getattr(cls, s)
-            if s == '_'+name+'_getdev':
-                getdev = getattr(cls, s)
-            if s == '_'+name+'_checkdev':
-                checkdev = getattr(cls, s)
-            if s == '_'+name+'_getformat':
-                getformat = getattr(cls, s)
+        setdev, getdev, checkdev, getformat = cls._devwrap_funcs(name)
         wd = cls_wrapDevice(setdev, getdev, checkdev, getformat)
         setattr(cls, name, wd)
     def _getdev_para_checked(self, *val):
@@ -1600,23 +1995,35 @@ class BaseInstrument(object):
         """
         get_para_checked(*val)
     def _devwrap(self, name, **extrak):
-        setdev = getdev = checkdev = getformat = None
-        cls = type(self)
-        for s in dir(self):
-            if s == '_'+name+'_setdev':
-                setdev = getattr(cls, s)
-            if s == '_'+name+'_getdev':
-                getdev = getattr(cls, s)
-            if s == '_'+name+'_checkdev':
-                checkdev = getattr(cls, s)
-            if s == '_'+name+'_getformat':
-                getformat = getattr(cls, s)
+        setdev, getdev, checkdev, getformat = self._devwrap_funcs(name)
         wd = cls_wrapDevice(setdev, getdev, checkdev, getformat, **extrak)
         setattr(self, name, wd)
+    @classmethod
+    def _class_devs_names(cls):
+        """ returns the names of the devices that are class attributes (the result is cached). """
+        try:
+            return cls.__dict__['_class_devs_names_cache']
+        except KeyError:
+            pass
+        names = set()
+        for c in cls.__mro__:
+            for k, v in c.__dict__.items():
+                if isinstance(v, BaseDevice):
+                    names.add(k)
+        # Do not use setattr, it would be inherited by subclasses.
+        type.__setattr__(cls, '_class_devs_names_cache', names)
+        return names
     def devs_iter(self):
-        for devname in dir(self):
+        """ iterates over (name, device) for all the devices of the instrument (sorted by name).
+            Only the devices that are attributes of the instance or its class are found
+            (not the ones returned by properties).
+        """
+        names = set([k for k, v in self.__dict__.items() if isinstance(v, BaseDevice)])
+        names.update(self._class_devs_names())
+        names.discard('alias')
+        for devname in sorted(names):
             obj = getattr(self, devname)
-            if devname != 'alias' and isinstance(obj, BaseDevice):
+            if isinstance(obj, BaseDevice):
                 yield devname, obj
     def _create_devs_helper(self, once=False):
         """
@@ -1633,16 +2040,22 @@ class BaseInstrument(object):
             conf = ProxyMethod(self._current_config)
         else:
             conf = None
-        for devname, obj in self.devs_iter():
+        devs = list(self.devs_iter())
+        proxy = weakref.proxy(self)
+        for devname, obj in devs:
             if once and obj.instr is not None:
                 continue
-            obj.instr = weakref.proxy(self)
+            obj.instr = proxy
             obj.name = devname
             if conf and not obj._format['header']:
                 obj._format['header'] = conf
-        for devname, obj in self.devs_iter():
+        for devname, obj in devs:
             # some device depend on others. So finish all initialization before delayed_init
             obj._delayed_init()
+        for devname, obj in devs:
+            for dep in obj._cache_depends():
+                if dep is not obj and not any(d is obj for d in dep._cache_invalidate):
+                    dep._cache_invalidate.append(obj)
     def _create_devs(self):
         # devices need to be created here (not at class level)
         # because we want each instrument instance to use its own
@@ -1738,6 +2151,21 @@ class BaseInstrument(object):
         if self.alias is None:
             raise TypeError(self.perror('This instrument does not have an alias for call'))
         return self.alias()
+    def cache_stats(self, reset=False):
+        """
+        Returns a dictionnary of device name: cache statistics (see BaseDevice.cache_stats)
+        for the devices that have used getcache. The 'total' entry sums the hits and misses.
+        """
+        ret = {}
+        hits = misses = 0
+        for devname, obj in self.devs_iter():
+            st = obj.cache_stats(reset=reset)
+            if st['hits'] or st['misses']:
+                ret[devname] = st
+                hits += st['hits']
+                misses += st['misses']
+        ret['total'] = dict(hits=hits, misses=misses)
+        return ret
     @locked_calling
     def force_get(self):
         """
@@ -1916,6 +2344,22 @@ def _get_dev_min_max(instr, ask_str, str_type=float, ask='both'):
 ##    SCPI device
 #######################################################
 
+# cache of setstr: True if it contains {val}
+# The same strings are used by every instance of an instrument class.
+_setstr_has_val_cache = {}
+
+def _setstr_has_val(setstr):
+    try:
+        return _setstr_has_val_cache[setstr]
+    except KeyError:
+        pass
+    val_present = False
+    for txt, name, spec, conv in string.Formatter().parse(setstr):
+        if name == 'val':
+            val_present = True
+    _setstr_has_val_cache[setstr] = val_present
+    return val_present
+
 class scpiDevice(BaseDevice):
     _autoset_val_str = ' {val}'
     def __init__(self,setstr=None, getstr=None, raw=False, chunk_size=None, autoinit=True, autoget=True, get_cached_init=None,
@@ -1995,13 +2439,10 @@ class scpiDevice(BaseDevice):
         BaseDevice.__init__(self, doc=doc, autoinit=autoinit, choices=choices, get_has_check=True, **kwarg)
         self._setdev_p = setstr
         if setstr is not None:
-            fmtr = string.Formatter()
-            val_present = False
-            for txt, name, spec, conv in fmtr.parse(setstr):
-                if name == 'val':
-                    val_present = True
-                    autoget = False
-            if not val_present:
+            val_present = _setstr_has_val(setstr)
+            if val_present:
+                autoget = False
+            else:
                 self._setdev_p = setstr + self._autoset_val_str
         self._getdev_cache = False
         if getstr is None:
@@ -2028,6 +2469,18 @@ class scpiDevice(BaseDevice):
         self._write_func = write_func
         self._ask_func = ask_func
 
+    def _cache_depends(self):
+        """
+        Returns the list of devices whose set can change the value of this one:
+        the devices used as options (like a channel selection) and the devices
+        of ChoiceDevDep used for the choices, the str_type or the option limits.
+        """
+        ret = super(scpiDevice, self)._cache_depends()
+        ret.extend(dev for dev in self._options.values() if isinstance(dev, BaseDevice))
+        for ch in [self.type] + list(self._options_lim.values()):
+            if isinstance(ch, ChoiceDevDep):
+                ret.append(ch.dev)
+        return ret
     def _delayed_init(self):
         """ This is called after self.instr is set """
         auto_min_max = self._auto_min_max
@@ -2099,14 +2552,14 @@ class scpiDevice(BaseDevice):
         opt.update(extradict)
         return opt
     @locked_calling_dev
-    def getcache(self, local=False):
+    def getcache(self, local=False, max_age=None):
         if local:
             return super(scpiDevice, self).getcache(local=True)
         #we need to check if we still are using the same options
         curr_cache = self._get_option_values()
         if self._option_cache != curr_cache:
             self.setcache(None)
-        return super(scpiDevice, self).getcache()
+        return super(scpiDevice, self).getcache(max_age=max_age)
     def _check_option(self, option, val):
         """
         Checks the option with value val
@@ -2217,8 +2670,57 @@ class scpiDevice(BaseDevice):
             ask = self.instr.ask
         else:
             ask = self._ask_func
+        if self._raw and self._ask_func is None and not self._ask_write_opt:
+            direct_read = getattr(self.type, 'direct_read', None)
+            if direct_read is not None:
+                ret = direct_read(self.instr, command, chunk_size=self._chunk_size)
+                if ret is not NotImplemented:
+                    return ret
         ret = ask(command, raw=self._raw, chunk_size=self._chunk_size, **self._ask_write_opt)
+        if timing_stats.enabled:
+            to = time.time()
+            nbytes = len(ret) if isinstance(ret, string_bytes_types) else 0
+            ret = self._fromstr(ret)
+            timing_stats.add(self, 'decode', time.time()-to, nbytes)
+            return ret
         return self._fromstr(ret)
+    def _batch_get_command(self, **kwarg):
+        """
+        Returns the query string to use in a batched get (see visaInstrument.batch_get)
+        or None if this device needs a normal get.
+        """
+        # options_apply selects the option (like a channel) on the instrument before
+        # the command, which can't be done within a batch.
+        if (type(self)._getdev is not scpiDevice._getdev or type(self).get is not BaseDevice.get or
+                self._options_apply or
+                self._getdev_cache or self._raw or self._ask_func is not None or self._ask_write_opt or
+                self._chunk_size is not None or not isinstance(self._getdev_p, string_bytes_types)):
+            return None
+        if any(k in kwarg for k in ['filename', 'graph', 'bin', 'extra_conf']):
+            return None
+        try:
+            options = self._combine_options(**kwarg)
+        except (InvalidArgument, InvalidAutoArgument):
+            # let the normal get produce the error
+            return None
+        command = self._getdev_p.format(**options)
+        self._getdev_last_full_cmd = command
+        return command
+    def _batch_set_command(self, val, **kwarg):
+        """
+        Checks val (like set does) and returns (command, checked_val, get_kwarg)
+        to use in a batched set (see visaInstrument.batch_set)
+        or None if this device needs a normal set.
+        """
+        # see _batch_get_command for options_apply
+        if (type(self)._setdev is not scpiDevice._setdev or type(self).set is not BaseDevice.set or
+                self._options_apply or self._extra_set_func or self._extra_set_after_func or self._write_func is not None or
+                self._ask_write_opt or not isinstance(self._setdev_p, string_bytes_types)):
+            return None
+        val, kwarg, set_kwarg = self._set_check((val,), kwarg)
+        options = self._check_cache['options']
+        command = self._setdev_p.format(val=self._tostr(val), **options)
+        return command, val, kwarg
     def _checkdev(self, val, **kwarg):
         options = self._combine_options(**kwarg)
         # all kwarg have been tested
@@ -2292,28 +2794,37 @@ def _decode_block_header(s):
         nbytes = -1 # nh=0 is used for unknown length or lengths that require more than 9 digits.
     return slice(2+nh, None), nbytes, 2+nh
 
-def _decode_block_base(s, skip=None):
+def _decode_block_range(s, skip=None):
+    """
+    Same as _decode_block_base but returns the start and stop index of the data
+    within s (so the data can be used without a copy).
+    """
     sl, nb, nh = _decode_block_header(s)
-    block = s[sl]
-    lb = len(block)
+    start = nh
+    ls = len(s)
+    lb = ls - start
     if nb != -1:
         if lb < nb :
             raise IndexError('Missing data for decoding. Got %i, expected %i'%(lb, nb))
         elif lb > nb :
-            if lb-nb == 1 and (s[-1] in b'\r\n'):
-                return block[:-1]
+            if lb-nb == 1 and (s[-1:] in (b'\r', b'\n')):
+                return start, ls-1
             elif lb-nb == 2 and s[-2:] == b'\r\n':
-                return block[:-2]
-            raise IndexError('Extra data in for decoding. Got %i ("%s ..."), expected %i'%(lb, block[nb:nb+10], nb))
+                return start, ls-2
+            raise IndexError('Extra data in for decoding. Got %i ("%s ..."), expected %i'%(lb, s[start+nb:start+nb+10], nb))
     elif skip:
         if isinstance(skip, string_bytes_types):
-            if block.endswith(skip):
-                return block[:-len(skip)]
+            if s.endswith(skip):
+                return start, ls-len(skip)
             else:
                 raise RuntimeError('Data is not terminated by requested skip string.')
         else:
-            return block[:-skip]
-    return block
+            return start, ls-skip
+    return start, ls
+
+def _decode_block_base(s, skip=None):
+    start, stop = _decode_block_range(s, skip)
+    return s[start:stop]
 
 def _encode_block_base(s):
     """
@@ -2329,6 +2840,257 @@ def _encode_block_base(s):
         header = b'#%i'%N_as_string_len + fb(N_as_string)
     return header+s
 
+# Values decoded as NaN by decode_ascii_block. 9.91e37 is the scpi not a number.
+ascii_nan_values = (9.91e37,)
+_ascii_pow10 = 10.**np.arange(23)
+
+def _ascii_fixed_layout(first):
+    """
+    Analyses the first token (bytes) of fixed width data like '+1.2345E-03'.
+    Returns None if the format is not handled or a dictionnary
+    of the columns: sign, mant (list), dot, e, exp_sign, exp (list) and nfrac
+    """
+    w = len(first)
+    up = first.upper()
+    e = up.find(b'E')
+    mant_end = e if e >= 0 else w
+    i = 0
+    sign = None
+    if first[0:1] in (b'+', b'-', b' '):
+        sign = 0
+        i = 1
+    dot = first.find(b'.', i, mant_end)
+    mant = [j for j in range(i, mant_end) if j != dot]
+    # 15 digits always fit exactly in a float64
+    if len(mant) == 0 or len(mant) > 15:
+        return None
+    nfrac = mant_end - dot - 1 if dot >= 0 else 0
+    exp_sign = None
+    exp = []
+    if e >= 0:
+        k = e + 1
+        if first[k:k+1] in (b'+', b'-'):
+            exp_sign = k
+            k += 1
+        exp = list(range(k, w))
+        if len(exp) == 0 or len(exp) > 3:
+            return None
+    return dict(sign=sign, mant=mant, dot=dot if dot >= 0 else None, e=e if e >= 0 else None,
+                exp_sign=exp_sign, exp=exp, nfrac=nfrac)
+
+def _ascii_fixed_probe(c, sep_code):
+    """
+    Cheap check of the layout of c (the uint8 array of the data) for _decode_ascii_fixed.
+    Returns None when the data is not in fixed width format (it only looks at
+    the first token and at a few separators) or (n, w, layout).
+    """
+    nc = len(c)
+    seps = np.flatnonzero(c[:65] == sep_code)
+    w = int(seps[0]) if len(seps) else nc
+    if w == 0 or w > 64 or (nc+1) % (w+1):
+        return None
+    n = (nc+1)//(w+1)
+    if n > 1:
+        # check a few separators (the first ones, the middle and the last) before the full check
+        sample = np.unique(np.r_[np.arange(min(n-1, 8)), (n-1)//2, n-2])*(w+1) + w
+        if not (c[sample] == sep_code).all():
+            return None
+    lay = _ascii_fixed_layout(np_tobytes(c[:w]))
+    if lay is None:
+        return None
+    return n, w, lay
+
+def _decode_ascii_fixed(c, sep_code, probe, out, chunk_size=65536):
+    """
+    Fast decoder for fixed width tokens (the same format for every values, like instruments
+    usually produce). c is the uint8 array of the data and probe is the result
+    of _ascii_fixed_probe.
+    It fills out and returns True, or returns False if the data is not in a handled format.
+    The conversion is exact (rows that can't be converted exactly with a
+    single multiplication or division are converted by numpy string conversion).
+    """
+    n, w, lay = probe
+    if n > 1 and not (c[w::w+1] == sep_code).all():
+        return False
+    rows_all = np.lib.stride_tricks.as_strided(c, shape=(n, w), strides=(w+1, 1))
+    mant = lay['mant']
+    u48 = np.uint8(48)
+    for i in range(0, n, chunk_size):
+        rows = rows_all[i:i+chunk_size]
+        res = out[i:i+chunk_size]
+        # validate the chunk
+        for j in mant + lay['exp']:
+            if (rows[:, j] - u48 > 9).any():
+                return False
+        if lay['dot'] is not None and not (rows[:, lay['dot']] == 46).all():
+            return False
+        if lay['e'] is not None and not ((rows[:, lay['e']] | np.uint8(32)) == 101).all(): # e or E
+            return False
+        m = rows[:, mant[0]] - np.float64(48)
+        for j in mant[1:]:
+            m *= 10
+            m += rows[:, j]
+            m -= 48
+        e10 = np.full(len(rows), -lay['nfrac'], dtype=np.int32)
+        if lay['exp']:
+            ex = np.zeros(len(rows), dtype=np.int32)
+            for j in lay['exp']:
+                ex *= 10
+                ex += rows[:, j]
+                ex -= 48
+            if lay['exp_sign'] is not None:
+                es = rows[:, lay['exp_sign']]
+                neg = es == 45 # -
+                if not (neg | (es == 43)).all():
+                    return False
+                ex[neg] *= -1
+            e10 += ex
+        ae = np.abs(e10)
+        # a single operation with an exact power of 10 gives a correctly rounded result
+        np.divide(m, _ascii_pow10[np.minimum(ae, 22)], out=res)
+        pos = np.flatnonzero(e10 > 0)
+        if len(pos):
+            res[pos] = m[pos] * _ascii_pow10[np.minimum(ae[pos], 22)]
+        if lay['sign'] is not None:
+            sc = rows[:, 0]
+            neg = sc == 45
+            if not (neg | (sc == 43) | (sc == 32)).all():
+                return False
+            res[neg] *= -1
+        slow = np.flatnonzero(ae > 22)
+        if len(slow):
+            res[slow] = rows[slow].copy().view('S%i'%w).ravel().astype(np.float64)
+    return True
+
+_ascii_white_re = re.compile(br'\s')
+
+def _decode_ascii_tokens(tokens, out):
+    """ Converts the list of tokens into out. Invalid tokens become NaN. """
+    try:
+        out[:] = np.array(tokens).astype(np.float64)
+    except ValueError:
+        for j, tok in enumerate(tokens):
+            try:
+                out[j] = float(tok)
+            except ValueError:
+                out[j] = np.nan
+
+def _ascii_fromstring(b, sep):
+    """ Converts b with the C parser of np.fromstring (in text mode).
+        Returns None if it can't convert all of b.
+    """
+    with warnings.catch_warnings():
+        # fromstring complains about unmatched data (a DeprecationWarning or
+        # a ValueError depending on the numpy version)
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(b, np.float64, sep=sep)
+        except (ValueError, DeprecationWarning):
+            return None
+
+def _decode_ascii_chunks(b, sep, out, dtype, nan_values, chunk_size=65536):
+    """
+    Decodes b (the stripped bytes of the data) in chunks of about chunk_size values.
+    Every chunk is converted by the C parser of np.fromstring (in text mode) directly
+    into out (or into a new array of dtype when out is None). The whole data
+    is tried at once first since it is faster. The chunks it can't fully convert
+    are split into tokens and converted one by one (invalid ones and
+    the nan_values become NaN). Returns the array.
+    """
+    vals = _ascii_fromstring(b, sep)
+    if vals is not None:
+        for v in nan_values:
+            vals[vals == v] = np.nan
+        if out is None:
+            return vals.astype(dtype, copy=False)
+        if len(vals) != len(out):
+            raise ValueError('out has the wrong length (%i instead of %i)'%(len(out), len(vals)))
+        out[:] = vals
+        return out
+    white_sep = sep.strip() == ''
+    sep_b = fb(sep)
+    chunk_bytes = chunk_size*16
+    nb = len(b)
+    parts = []
+    n = 0
+    start = 0
+    while start < nb:
+        if white_sep:
+            m = _ascii_white_re.search(b, start+chunk_bytes)
+            end = m.start() if m else nb
+        else:
+            end = b.find(sep_b, start+chunk_bytes)
+            if end < 0:
+                end = nb
+        chunk = b[start:end]
+        start = end + (1 if white_sep else len(sep_b))
+        vals = _ascii_fromstring(chunk, sep)
+        if vals is None:
+            tokens = chunk.split() if white_sep else chunk.split(sep_b)
+            vals = np.empty(len(tokens), np.float64)
+            _decode_ascii_tokens(tokens, vals)
+        for v in nan_values:
+            vals[vals == v] = np.nan
+        k = len(vals)
+        if out is not None:
+            if n + k > len(out):
+                total = len(b.split()) if white_sep else b.count(sep_b) + 1
+                raise ValueError('out has the wrong length (%i instead of %i)'%(len(out), total))
+            out[n:n+k] = vals
+        else:
+            parts.append(vals)
+        n += k
+    if out is None:
+        return np.concatenate(parts).astype(dtype, copy=False)
+    if n != len(out):
+        raise ValueError('out has the wrong length (%i instead of %i)'%(len(out), n))
+    return out
+
+def decode_ascii_block(s, dtype=np.float64, sep=',', out=None, nan_values=None, chunk_size=65536):
+    """
+    Decodes a string of ascii numbers separated by sep (surrounding whitespace
+    are ignored. Use sep=' ' for only whitespace separated values).
+    Data in fixed width format (like +1.23456E-03,-2.34560E+01) is decoded by a fast
+    vectorized decoder, the rest by the numpy C parser. When some tokens are invalid,
+    the data is redone in chunks of chunk_size values and only the chunks containing
+    them are converted token by token.
+    Invalid tokens, and the values in nan_values (default is ascii_nan_values,
+    which contains the scpi 9.91e37 not a number value) are returned as NaN.
+    out: a preallocated array (of the correct length) to fill. It is returned.
+    dtype: the type of the returned array (when out is not given). It needs
+           to be a float type.
+    """
+    if nan_values is None:
+        nan_values = ascii_nan_values
+    b = fb(s).strip()
+    white_sep = sep.strip() == ''
+    if not white_sep:
+        sep_b = fb(sep)
+        if b.endswith(sep_b):
+            b = b[:-len(sep_b)].rstrip()
+    if len(b) == 0:
+        return np.zeros(0, dtype) if out is None else out[:0]
+    done = False
+    if not white_sep and len(sep_b) == 1:
+        c = np_frombuffer(b, np.uint8)
+        probe = _ascii_fixed_probe(c, ord(sep_b))
+        if probe is not None:
+            n = probe[0]
+            if out is None:
+                out = np.empty(n, dtype)
+            elif len(out) != n:
+                raise ValueError('out has the wrong length (%i instead of %i)'%(len(out), n))
+            res = out if out.dtype == np.float64 else np.empty(n, np.float64)
+            done = _decode_ascii_fixed(c, ord(sep_b), probe, res, chunk_size)
+            if done:
+                for v in nan_values:
+                    res[res == v] = np.nan
+                if res is not out:
+                    out[:] = res
+    if not done:
+        out = _decode_ascii_chunks(b, sep, out, dtype, nan_values, chunk_size)
+    return out
+
 def _decode_block(s, t='<f8', sep=None, skip=None):
     """
         sep can be None for binaray encoding or ',' for ascii csv encoding
@@ -2338,9 +3100,18 @@ def _decode_block(s, t='<f8', sep=None, skip=None):
              then you can enter the termination string you want removed from
              the end, or an integer of the number of character to remove from the end.
     """
+    if sep is None:
+        # avoid the copy of slicing s.
+        start, stop = _decode_block_range(s, skip=skip)
+        itemsize = np.dtype(t).itemsize
+        if (stop-start) % itemsize:
+            raise ValueError('Block size (%i) is not a multiple of the element size (%i)'%(stop-start, itemsize))
+        return np_frombuffer(s, t, count=(stop-start)//itemsize, offset=start)
     block = _decode_block_base(s, skip=skip)
-    if sep is None or len(block) == 0:
+    if len(block) == 0:
         return np_frombuffer(block, t)
+    if np.dtype(t).kind == 'f':
+        return decode_ascii_block(block, t, sep=sep)
     return np.fromstring(make_str(block), t, sep=sep)
 
 def _encode_block(v, sep=None):
@@ -2365,14 +3136,34 @@ def _decode_block_auto(s, t='<f8', skip=None):
     return _decode_block(s, t, sep=sep, skip=skip)
 
 class Block_Codec(object):
-    def __init__(self, dtype='<f8', sep=None, skip=None, single_not_array=False, empty=None):
+    def __init__(self, dtype='<f8', sep=None, skip=None, single_not_array=False, empty=None,
+                 direct_read=False, reuse_buffer=False):
+        """
+        direct_read: when True, and for binary blocks (sep=None), scpiDevice with raw=True
+                     will read the data directly into an array (see visaInstrument.read_block).
+        reuse_buffer: when True (with direct_read), the same array is reused between reads
+                      (when it is large enough). The values from a previous read are then
+                      overwritten, so make a copy of them if you need to keep them.
+        """
         self._dtype = dtype
         self._sep = sep
         self._skip = skip
         self._single_not_array = single_not_array
         self._empty = empty
+        self._direct_read = direct_read
+        self._reuse_buffer = reuse_buffer
+        self._buffer = None
+    def direct_read(self, instr, question, chunk_size=None):
+        if not self._direct_read or self._sep is not None or not hasattr(instr, 'ask_block'):
+            return NotImplemented
+        ret = instr.ask_block(question, self._dtype, out=self._buffer, chunk_size=chunk_size)
+        if self._reuse_buffer and ret.base is not self._buffer:
+            self._buffer = ret
+        return self._finish(ret)
     def __call__(self, input_str):
         ret = _decode_block(input_str, self._dtype, self._sep, self._skip)
+        return self._finish(ret)
+    def _finish(self, ret):
         empty = self._empty
         if empty is not None and len(ret) == 0:
             ret = np.append(ret, empty)
@@ -2393,6 +3184,38 @@ class Block_Codec(object):
             array = array.astype(self._dtype)
         return _encode_block(array, self._sep)
 
+class Block_Direct(object):
+    """
+    Wraps a block decoding function (for a scpiDevice str_type with raw=True) so
+    that the data is read directly into an array of type dtype (see visaInstrument.read_block)
+    instead of going through the decoding function.
+    dtype can also be a function returning the type to use, or None when
+    the decoding function needs to be used (for example, for ascii data).
+    reuse_buffer: see Block_Codec.
+    """
+    def __init__(self, func, dtype, reuse_buffer=False):
+        self._func = func
+        self._dtype = dtype
+        self._reuse_buffer = reuse_buffer
+        self._buffer = None
+    def __call__(self, input_str):
+        return self._func(input_str)
+    def direct_read(self, instr, question, chunk_size=None):
+        dtype = self._dtype
+        if not isinstance(dtype, (string_bytes_types, type, np.dtype)) and dtype is not None:
+            dtype = dtype()
+        if dtype is None or not hasattr(instr, 'ask_block'):
+            return NotImplemented
+        buf = self._buffer
+        if buf is not None and buf.dtype != np.dtype(dtype):
+            buf = None
+        ret = instr.ask_block(question, dtype, out=buf, chunk_size=chunk_size)
+        if self._reuse_buffer and ret.base is not buf:
+            self._buffer = ret
+        return ret
+    def tostr(self, val):
+        return self._func.tostr(val)
+
 class Block_Codec_Raw(object):
     def __init__(self, dtype='<f8', sep=None):
         self._dtype = dtype
@@ -3259,11 +4082,13 @@ class Dict_SubDevice(BaseDevice):
             for k, v in zip(self._sub_key, val):
                 vals[k] = v
         self._subdevice.setcache(vals)
-    def getcache(self, local=False):
+    def invalidate_cache(self):
+        self._subdevice.invalidate_cache()
+    def getcache(self, local=False, max_age=None):
         if local:
             vals = self._subdevice.getcache(local=True)
         else:
-            vals = self._subdevice.getcache()
+            vals = self._subdevice.getcache(max_age=max_age)
         if vals is None:
             ret = None
         else:
@@ -3653,6 +4478,8 @@ class visaInstrument(BaseInstrument):
         delta = (last_time+wait_time) - cur_time
         if delta >0:
             sleep(delta)
+            if timing_stats.enabled:
+                timing_stats.add(self, 'rw_wait', time.time()-cur_time)
     @locked_calling
     def read(self, raw=False, encoding=None, count=None, chunk_size=None):
         return self.read_unlocked(raw=raw, count=count, chunk_size=chunk_size)
@@ -3667,6 +4494,7 @@ class visaInstrument(BaseInstrument):
         """
         if CHECKING():
             return ''
+        to = timing_stats.enabled and time.time()
         if count:
             ret = self.visa.read_raw_n_all(count, chunk_size=chunk_size)
         elif raw:
@@ -3674,17 +4502,22 @@ class visaInstrument(BaseInstrument):
         else:
             ret = self.visa.read(encoding=encoding, chunk_size=chunk_size)
         self._last_rw_time.read_time = time.time()
+        if to:
+            timing_stats.add(self, 'read', self._last_rw_time.read_time-to, len(ret))
         self._keep_alive_update()
         return ret
     @locked_calling
     def write(self, val, termination='default', encoding=None):
         self._do_wr_wait()
+        to = timing_stats.enabled and time.time()
         if not CHECKING():
             self.visa.write(val, termination=termination, encoding=encoding)
         else:
             if not isinstance(val, string_bytes_types):
                 raise ValueError(self.perror('The write val is not a string.'))
         self._last_rw_time.write_time = time.time()
+        if to:
+            timing_stats.add(self, 'write', self._last_rw_time.write_time-to, len(val))
         self._keep_alive_update()
     @locked_calling
     def ask(self, question, raw=False, encoding=None, chunk_size=None):
@@ -3695,10 +4528,200 @@ class visaInstrument(BaseInstrument):
         base read strips newlines from the end always.
         """
         # we prevent CTRL-C from breaking between write and read using context manager
+        to = timing_stats.enabled and time.time()
         with _delayed_signal_context_manager():
             self.write(question, encoding=encoding)
             ret = self.read(raw=raw, encoding=encoding, chunk_size=chunk_size)
+        if to:
+            timing_stats.add(self, 'ask', time.time()-to, len(question)+len(ret))
+        return ret
+    @locked_calling
+    def read_block(self, dtype=np.uint8, out=None, chunk_size=None):
+        """
+        Reads a scpi binary block (#niiiivvvvvv, see _decode_block_header) directly into
+        a numpy array of type dtype. The data is transferred without intermediate copies
+        (when the visa library allows it).
+        Anything before the # is skipped (some instruments add a prefix) and the termination
+        after the block is read and discarded.
+        out: a C contiguous array to reuse (its dtype is then used instead of dtype).
+             When it is large enough, the returned array is a view of its beginning.
+             Otherwise a new array is returned.
+        chunk_size: the maximum size of a single visa read.
+        Unknown length blocks (#0) are read normally (the last termination is removed).
+        """
+        if out is not None:
+            dtype = out.dtype
+        dtype = np.dtype(dtype)
+        if CHECKING():
+            return np.zeros(0, dtype)
+        to = timing_stats.enabled and time.time()
+        visa = self.visa
+        head = bytearray(10)
+        # find the start of the block
+        for i in range(1024):
+            visa.read_raw_n_all_into(head, count=1)
+            if head[0:1] == b'#':
+                break
+        else:
+            raise IndexError(self.perror('Could not find the start of the block (#)'))
+        visa.read_raw_n_all_into(head, count=1)
+        nh = int(head[0:1])
+        if nh == 0:
+            data = self.read_unlocked(raw=True, chunk_size=chunk_size)
+            # remove the termination
+            term = visa.read_termination or b''
+            if not isinstance(term, bytes):
+                term = term.encode('latin1')
+            skip = term if term and data.endswith(term) else None
+            return _decode_block(b'#0'+data, dtype, skip=skip)
+        visa.read_raw_n_all_into(head, count=nh)
+        nbytes = int(head[:nh])
+        n, rem = divmod(nbytes, dtype.itemsize)
+        if rem:
+            raise ValueError(self.perror('Block size (%i) is not a multiple of the element size (%i)'%(nbytes, dtype.itemsize)))
+        if out is not None and out.flags.c_contiguous and out.size >= n:
+            ret = out.reshape(-1)[:n]
+        else:
+            ret = np.empty(n, dtype)
+        end = False
+        if n:
+            end = visa.read_raw_n_all_into(ret.view(np.uint8), chunk_size=chunk_size)
+        if not end:
+            # read the termination
+            visa.read_raw()
+        self._last_rw_time.read_time = time.time()
+        if to:
+            timing_stats.add(self, 'read', self._last_rw_time.read_time-to, nbytes)
+        self._keep_alive_update()
+        return ret
+    @locked_calling
+    def ask_block(self, question, dtype=np.uint8, out=None, chunk_size=None):
+        """
+        Does write then read_block (see read_block for the options).
+        """
+        to = timing_stats.enabled and time.time()
+        with _delayed_signal_context_manager():
+            self.write(question)
+            ret = self.read_block(dtype, out=out, chunk_size=chunk_size)
+        if to:
+            timing_stats.add(self, 'ask', time.time()-to, len(question)+ret.nbytes)
         return ret
+    # When False, sweep and record don't batch the gets and sets of this instrument
+    # (see batch_get and batch_set). It can be changed per instrument.
+    batch_en = True
+    # String used by batch_get to join many queries in a single request.
+    # None disables the batching. For SCPI instruments use ';:' (the ':' restarts
+    # at the root of the command tree). The answers need to be separated by ';'.
+    _batch_get_sep = None
+    @locked_calling
+    def batch_get(self, devs):
+        """
+        Gets the values of many devices of this instrument, in order.
+        devs is a list of devices or of (device, options_dict).
+        The consecutive scpiDevice that allow it are read with a single request (the queries
+        are joined with _batch_get_sep, the answer is split on ';' and converted with each
+        device _fromstr).
+        The other devices, or all of them if the answer can't be split properly, use a normal get.
+        Returns the list of values (and updates the caches).
+        """
+        devs = [d if isinstance(d, tuple) else (d, {}) for d in devs]
+        vals = [None]*len(devs)
+        sep = self._batch_get_sep
+        cmds = [None]*len(devs)
+        if sep is not None and not CHECKING():
+            for j, (dev, kwarg) in enumerate(devs):
+                if isinstance(dev, scpiDevice) and dev.instr == self:
+                    cmds[j] = dev._batch_get_command(**kwarg)
+        def do_ask(batch):
+            if len(batch) > 1:
+                to = timing_stats.enabled and time.time()
+                for j in batch:
+                    dev, kwarg = devs[j]
+                    dev._get_start(kwarg.copy())
+                parts = self.ask(sep.join([cmds[j] for j in batch])).split(';')
+                conv = None
+                if len(parts) == len(batch):
+                    try:
+                        conv = [devs[j][0]._fromstr(part.strip()) for j, part in zip(batch, parts)]
+                    except Exception:
+                        conv = None
+                if conv is not None:
+                    for j, v in zip(batch, conv):
+                        devs[j][0]._get_done(v, to, len(batch))
+                        vals[j] = v
+                    return
+            for j in batch:
+                dev, kwarg = devs[j]
+                vals[j] = dev.get(**kwarg)
+        batch = []
+        for j, cmd in enumerate(cmds):
+            if cmd is not None:
+                batch.append(j)
+                continue
+            if batch:
+                do_ask(batch)
+                batch = []
+            dev, kwarg = devs[j]
+            vals[j] = dev.get(**kwarg)
+        if batch:
+            do_ask(batch)
+        return vals
+    # String used by batch_set to join many set commands in a single write.
+    # None disables the batching. For SCPI instruments use ';:'
+    _batch_set_sep = None
+    @locked_calling
+    def batch_set(self, dev_vals):
+        """
+        Sets many devices of this instrument, in order.
+        dev_vals is a list of (device, value) or (device, value, options_dict).
+        All the scpiDevice that allow it have their values checked first (nothing
+        is written if one of them fails), then the consecutive ones are set with a single
+        write (the commands are joined with _batch_set_sep). The devices with setget
+        are then read back (with batch_get) and the caches, related devices and
+        timing stats are updated like set does.
+        The other devices are set normally, between those writes.
+        Returns the list of values in the caches (like set_ret_cache).
+        """
+        dev_vals = [dv if len(dv) > 2 else (dv[0], dv[1], {}) for dv in dev_vals]
+        vals = [None]*len(dev_vals)
+        sep = self._batch_set_sep
+        prepared = [None]*len(dev_vals)
+        if sep is not None and not CHECKING():
+            for j, (dev, val, kwarg) in enumerate(dev_vals):
+                if isinstance(dev, scpiDevice) and dev.instr == self:
+                    prepared[j] = dev._batch_set_command(val, **kwarg)
+        def do_write(batch):
+            if len(batch) == 1:
+                j = batch[0][0]
+                dev, val, kwarg = dev_vals[j]
+                vals[j] = dev.set_ret_cache(val, **kwarg)
+                return
+            to = timing_stats.enabled and time.time()
+            for j, dev, cmd, val, kwarg in batch:
+                dev._set_delayed_cache = None
+            self.write(sep.join([cmd for j, dev, cmd, val, kwarg in batch]))
+            now = time.time()
+            setget = [(dev, kwarg) for j, dev, cmd, val, kwarg in batch if dev._setget]
+            for dev, kwarg in setget:
+                dev._local_data.last_set_time = now
+            got = iter(self.batch_get(setget))
+            for j, dev, cmd, val, kwarg in batch:
+                if dev._setget:
+                    val = next(got)
+                dev._set_done(val, kwarg, to, len(batch), got=dev._setget)
+                vals[j] = dev.getcache()
+        batch = []
+        for j, ((dev, val, kwarg), ret) in enumerate(zip(dev_vals, prepared)):
+            if ret is not None:
+                batch.append((j, dev) + ret)
+                continue
+            if batch:
+                do_write(batch)
+                batch = []
+            vals[j] = dev.set_ret_cache(val, **kwarg)
+        if batch:
+            do_write(batch)
+        return vals
     def idn(self):
         return self.ask('*idn?')
     def idn_usb(self):
@@ -3823,6 +4846,10 @@ class visaInstrument(BaseInstrument):
 #    device status so it can still find out if the device is requesting service.
 
 class visaInstrumentAsync(visaInstrument):
+    # When polling the status byte, the delay between polls starts at
+    # _async_poll_delay_min and doubles after every poll up to _async_poll_delay_max.
+    _async_poll_delay_min = 0.001
+    _async_poll_delay_max = 0.05
     def __init__(self, visa_addr, poll=False, **kwarg):
         # poll can be True (for always polling) 'not_gpib' for polling for lan and usb but
         # use the regular technique for gpib
@@ -3833,6 +4860,10 @@ class visaInstrumentAsync(visaInstrument):
         self._async_last_status_time = 0
         self._async_last_esr = 0
         self._async_do_cleanup = False
+        self._async_poll_delay = self._async_poll_delay_min
+        self._async_trig_time = 0.
+        self._async_last_completion = None
+        self._async_completion = _TimingEntry()
         super(visaInstrumentAsync, self).__init__(visa_addr, **kwarg)
         self._async_mode = 'srq'
         if CHECKING():
@@ -3855,7 +4886,7 @@ class visaInstrumentAsync(visaInstrument):
             # This is a problem when using more than one visaInstrumentAsync
             # To avoid that problem, I use a handler in that case.
             self._RQS_status = 0  #-1: no handler, 0 not ready, other is status byte
-            self._RQS_done = FastEvent()  #starts in clear state
+            self._RQS_done = _cond_event()  #starts in clear state
             self._proxy_handler = ProxyMethod(self._RQS_handler)
             # _handler_userval is the ctype object representing the user value (0 here)
             # It is needed for uninstall
@@ -3928,6 +4959,44 @@ class visaInstrumentAsync(visaInstrument):
             self._async_last_esr = self._get_esr()
             return True
         return False
+    def _async_poll_wait(self, max_time):
+        """
+        Polls the status byte (_async_detect_poll_func) for at most max_time s.
+        The delay between polls increases exponentially (see _async_poll_delay_min/max)
+        so a short acquisition is detected quickly without hammering the bus
+        during a long one. The delay is reset by _async_trig_cleanup.
+        """
+        end_time = time.time() + max_time
+        while True:
+            if self._async_detect_poll_func():
+                return True
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+            sleep(min(self._async_poll_delay, remaining))
+            self._async_poll_delay = min(self._async_poll_delay*2, self._async_poll_delay_max)
+    def _async_record_completion(self):
+        dt = self._async_last_status_time - self._async_trig_time
+        self._async_last_completion = dt
+        self._async_completion.add(dt)
+        if timing_stats.enabled:
+            timing_stats.add(self, 'srq_complete', dt)
+    def async_completion_stats(self, reset=False):
+        """
+        Returns a dictionnary with the statistics (count, total, min, max, mean in s, and
+        the last one) of the time between the trigger (the end of _async_trig_cleanup)
+        and the detection of the completion (srq or status byte) of this instrument.
+        The resolution is the polling delay when polling (see _async_poll_delay_max).
+        This is useful to adjust async_delay or async_wait and beforewait in sweeps.
+        reset: when True, the statistics are cleared (after being returned).
+        """
+        ret = self._async_completion.as_dict()
+        del ret['nbytes']
+        ret['last'] = self._async_last_completion
+        if reset:
+            self._async_completion = _TimingEntry()
+            self._async_last_completion = None
+        return ret
     def _async_detect(self, max_time=.5): # 0.5 s max by default
         """
         handles _async_mode of 'wait' (only wait delay), 'srq' (only detects srq)
@@ -3944,7 +5013,7 @@ class visaInstrumentAsync(visaInstrument):
             if not super(visaInstrumentAsync, self)._async_detect(max_time):
                 return False
         if self._async_polling:
-            if _retry_wait(self._async_detect_poll_func, max_time, delay=0.05):
+            if self._async_poll_wait(max_time):
                 ret = True
         elif self._RQS_status == -1:
             # On National Instrument (NI) visa
@@ -3968,6 +5037,8 @@ class visaInstrumentAsync(visaInstrument):
                 self._async_last_esr = self._get_esr()
                 self._RQS_done.clear() # so that we can detect the next SRQ if needed without  _doing async_trig (_async_trig_cleanup)
                 ret = True
+        if ret:
+            self._async_record_completion()
         return ret
     def _async_cleanup_after(self):
         super(visaInstrumentAsync, self)._async_cleanup_after()
@@ -4024,6 +5095,8 @@ class visaInstrumentAsync(visaInstrument):
                 print('Unread(%i) event queue!'%n)
         self._async_last_status = 0
         self._async_last_esr = 0
+        self._async_poll_delay = self._async_poll_delay_min
+        self._async_trig_time = time.time()
     @locked_calling
     def _async_trig(self):
         super(visaInstrumentAsync, self)._async_trig()
@@ -27,10 +27,16 @@ For visa devices that respond to IDN or are USB tmc devices, it allows to build
 a database of information for them.
 
 Non-Visa instruments can register idn, but they will not be used.
+
+It also handles the lazy loading of the instruments modules (see
+scan_module and add_lazy_module).
 """
 
 from __future__ import absolute_import, print_function, division
 
+import ast
+import sys
+import threading
 from collections import defaultdict
 
 from .comp2to3 import string_bytes_types
@@ -47,12 +53,17 @@ _instruments_ids_rev = defaultdict(list)
 _instruments_usb = {}
 _instruments_add = {}
 _instruments_usb_names = {}
+_lazy_modules = {} # name: (fullname, filename) of modules not loaded yet
+_lazy_names = {} # instruments attribute name: module name
+_lazy_lock = threading.RLock()
 
 def clean_instruments():
     from . import instruments
     for name in _instruments_add:
         delattr(instruments, name)
     _instruments_add.clear()
+    _lazy_modules.clear()
+    _lazy_names.clear()
 
 def _add_to_instruments(some_object, name=None):
     from . import instruments
@@ -67,13 +78,25 @@ def _add_to_instruments(some_object, name=None):
             name, _instruments_add[name], some_object))
     else:
         # not installed yet
-        if hasattr(instruments, name):
+        # Don't use hasattr, it would trigger the lazy loading (instruments.__getattr__)
+        # An already present some_object is a module imported directly (import sets the attribute)
+        if instruments.__dict__.get(name, some_object) is not some_object:
             raise RuntimeError('There is already an attribute "%s" within the instruments package'%(name))
     setattr(instruments, name, some_object)
     _instruments_add[name] = some_object
     return name
 
 
+def _lazy_lookup(table, key):
+    ret = table[key]
+    if isinstance(ret, LazyInstrument):
+        ret.load()
+        ret = table[key]
+        if isinstance(ret, LazyInstrument):
+            raise RuntimeError('Loading module "%s" did not register %s'%(ret.module_name, ret.class_name))
+    return ret
+
+
 def find_instr(manuf=None, product=None, firmware_version=None):
     """
     look for a matching instrument to the manuf, product, firmware_version
@@ -88,19 +111,19 @@ def find_instr(manuf=None, product=None, firmware_version=None):
         key = (manuf, product, firmware_version)
     keybase = key
     try:
-        return _instruments_ids[key]
+        return _lazy_lookup(_instruments_ids, key)
     except KeyError:
         pass
     # try a simpler key
     key = key[:2]+(None,)
     try:
-        return _instruments_ids[key]
+        return _lazy_lookup(_instruments_ids, key)
     except KeyError:
         pass
     # try the simplest key
     key = (key[0], None, None)
     try:
-        return _instruments_ids[key]
+        return _lazy_lookup(_instruments_ids, key)
     except KeyError:
         raise KeyError(keybase)
 
@@ -116,13 +139,13 @@ def find_usb(vendor_id, product_id=None):
         key = (vendor_id, product_id)
     keybase = key
     try:
-        return _instruments_usb[key]
+        return _lazy_lookup(_instruments_usb, key)
     except KeyError:
         pass
     # try a simpler key
     key = (key[0], None)
     try:
-        return _instruments_usb[key]
+        return _lazy_lookup(_instruments_usb, key)
     except KeyError:
         raise KeyError(keybase)
 
@@ -242,7 +265,7 @@ def register_instrument(manuf=None, product=None, firmware_version=None, usb_ven
                 raise ValueError("product can't contain ',' for %s"%instr_class)
             key = (manuf, product, firmware_version)
             do_append = True
-            if key in _instruments_ids:
+            if key in _instruments_ids and not isinstance(_instruments_ids[key], LazyInstrument):
                 if _instruments_ids[key] is not instr_class:
                     if not quiet:
                         print(' Warning: Registering %s with %s to override %s'%(
@@ -261,7 +284,7 @@ def register_instrument(manuf=None, product=None, firmware_version=None, usb_ven
             if pid is not None and (pid<0 or pid>0xffff):
                 raise ValueError('Out of range product id for %s'%instr_class)
             key = (vid, pid)
-            if key in _instruments_usb:
+            if key in _instruments_usb and not isinstance(_instruments_usb[key], LazyInstrument):
                 if not quiet and _instruments_usb[key] is not instr_class:
                     print(' Warning: Registering usb %s with %s to override %s'%(
                             tuple(hex(k) for k in key), instr_class, _instruments_usb[key]))
@@ -307,3 +330,168 @@ def add_to_instruments(name=None):
         some_object = name
         _add_to_instruments(some_object)
         return some_object
+
+
+####################################################################
+# Lazy loading of instruments modules
+
+class LazyInstrument(object):
+    """
+    Placeholder for an instrument class (class_name) of the module module_name
+    that is not loaded yet. It is used in the find_instr/find_usb database
+    which replace it by the real class (by loading the module) when it is found.
+    """
+    def __init__(self, module_name, class_name):
+        self.module_name = module_name
+        self.class_name = class_name
+    def load(self):
+        load_lazy_module(self.module_name)
+    def __repr__(self):
+        return '<LazyInstrument %s.%s>'%(self.module_name, self.class_name)
+
+_registry_funcs = ['register_instrument', 'add_to_instruments', '_add_to_instruments',
+                   'register_idn_alias', 'register_usb_name']
+
+def _literal_call_args(call):
+    args = [ast.literal_eval(a) for a in call.args]
+    kwargs = dict([(k.arg, ast.literal_eval(k.value)) for k in call.keywords])
+    if None in kwargs:
+        # **kwarg
+        raise ValueError('Not a literal call')
+    return args, kwargs
+
+def scan_module(filename):
+    """
+    Finds, without importing it, what the module in filename adds to the
+    instruments package and registers. It returns a dictionnary with:
+       names: the list of names added to the instruments package
+       calls: the list of registration made, (func_name, args, kwargs, class_name),
+              where func_name is register_instrument, register_idn_alias or register_usb_name
+              and class_name is the name of the registered class (or None).
+       lazy: False if some registrations could not be understood (the module
+             needs to be imported to know them).
+    Only the uses of the registration functions as decorators of module level classes
+    and functions (with literal arguments) and the module level calls
+    of register_idn_alias/register_usb_name (with literal arguments) are understood.
+    Every other use of those functions makes the module not lazy.
+    """
+    with open(filename, 'rb') as f:
+        tree = ast.parse(f.read(), filename)
+    names = []
+    calls = []
+    handled = set()
+    def is_func(node, names=_registry_funcs):
+        return isinstance(node, ast.Name) and node.id in names
+    try:
+        for stmt in tree.body:
+            if isinstance(stmt, (ast.ClassDef, ast.FunctionDef)):
+                # decorators are applied from the bottom up
+                for deco in reversed(stmt.decorator_list):
+                    if is_func(deco, ['add_to_instruments']):
+                        names.append(stmt.name)
+                    elif isinstance(deco, ast.Call) and is_func(deco.func, ['add_to_instruments']):
+                        args, kwargs = _literal_call_args(deco)
+                        names.append(kwargs.get('name', args[0] if args else None) or stmt.name)
+                    elif isinstance(deco, ast.Call) and is_func(deco.func, ['register_instrument']):
+                        args, kwargs = _literal_call_args(deco)
+                        if not kwargs.get('skip_add', False):
+                            names.append(stmt.name)
+                        calls.append(('register_instrument', args, kwargs, stmt.name))
+                    else:
+                        continue
+                    handled.add(id(deco.func if isinstance(deco, ast.Call) else deco))
+            elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) and \
+                    is_func(stmt.value.func, ['register_idn_alias', 'register_usb_name']):
+                args, kwargs = _literal_call_args(stmt.value)
+                calls.append((stmt.value.func.id, args, kwargs, None))
+                handled.add(id(stmt.value.func))
+    except (ValueError, SyntaxError, IndexError):
+        # a non literal argument
+        return dict(names=names, calls=calls, lazy=False)
+    lazy = True
+    for node in ast.walk(tree):
+        if (is_func(node) and id(node) not in handled) or \
+           (isinstance(node, ast.Attribute) and node.attr in _registry_funcs):
+            lazy = False
+            break
+    # remove duplicates, keeping the order
+    names = [n for i, n in enumerate(names) if n not in names[:i]]
+    return dict(names=names, calls=calls, lazy=lazy)
+
+def registration_keys(info):
+    """ returns the set of database keys used by the scan_module result info.
+        (used to find conflicts between modules)
+    """
+    keys = set([('name', n) for n in info['names']])
+    for func, args, kwargs, class_name in info['calls']:
+        if func == 'register_instrument':
+            reg = _get_register_args(*args, **kwargs)
+            if reg['manuf'] is not None:
+                keys.add(('idn', reg['manuf'], reg['product'], reg['firmware_version']))
+            if reg['usb_vendor_product'] is not None:
+                keys.add(('usb',)+tuple(reg['usb_vendor_product']))
+    return keys
+
+def _get_register_args(manuf=None, product=None, firmware_version=None, usb_vendor_product=None, **kwargs):
+    return dict(manuf=manuf, product=product, firmware_version=firmware_version, usb_vendor_product=usb_vendor_product)
+
+def add_lazy_module(name, fullname, filename, info):
+    """
+    Registers the instruments (from the scan_module result info) of module name
+    without importing it. It is imported (by load_lazy_module) on the first access
+    to one of its names in the instruments package or when find_instr/find_usb
+    selects one of its instruments.
+    """
+    from . import instruments
+    with _lazy_lock:
+        _lazy_modules[name] = (fullname, filename)
+        for n in info['names'] + [name]:
+            if n in instruments.__dict__:
+                raise RuntimeError('There is already an attribute "%s" within the instruments package'%(n))
+            _lazy_names[n] = name
+        for func, args, kwargs, class_name in info['calls']:
+            if func == 'register_instrument':
+                kwargs = dict(kwargs, skip_add=True)
+                register_instrument(*args, **kwargs)(LazyInstrument(name, class_name))
+            elif func == 'register_idn_alias':
+                register_idn_alias(*args, **kwargs)
+            else:
+                register_usb_name(*args, **kwargs)
+
+def load_lazy_module(name):
+    """ Imports the lazy module name (see add_lazy_module). Does nothing if it is already loaded. """
+    from . import instruments
+    from .config import load_source
+    with _lazy_lock:
+        if name not in _lazy_modules:
+            return
+        fullname, filename = _lazy_modules[name]
+        module = sys.modules.get(fullname)
+        if module is None:
+            module = load_source(fullname, filename)
+        del _lazy_modules[name]
+        for n, mod_name in list(_lazy_names.items()):
+            if mod_name == name:
+                del _lazy_names[n]
+        _add_to_instruments(module, name)
+        instruments._loaded[fullname] = filename
+
+def load_lazy_name(name):
+    """ Loads the module providing name and returns the instruments package attribute name.
+        Raises AttributeError if name is unknown.
+    """
+    from . import instruments
+    try:
+        module_name = _lazy_names[name]
+    except KeyError:
+        raise AttributeError("module 'pyHegel.instruments' has no attribute '%s'"%name)
+    load_lazy_module(module_name)
+    try:
+        return instruments.__dict__[name]
+    except KeyError:
+        raise AttributeError("module 'pyHegel.instruments' has no attribute '%s' (not created by module %s)"%(name, module_name))
+
+def load_all_lazy():
+    """ Loads all the modules that are still lazy. """
+    for name in list(_lazy_modules.keys()):
+        load_lazy_module(name)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Timing benchmarks of some pyHegel internals.
+    To use, in pyHegel environment:
+        run -i benchmarks
+        bench_batch_get() # or change some of the options
+        bench_batch_set()
+        bench_ascii_decode()
+        bench_async()
+        bench_srq()
+        bench_startup()
+        bench_construction()
+        bench_pipeline()
+        bench_container()
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import subprocess
+import sys
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from pyHegel import instruments_base
+from pyHegel.comp2to3 import is_py2
+from pyHegel.tests.fake_visa import FakeSrqSession, fake_resource_manager, fake_srq_instrument
+
+if is_py2:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+
+class _ReuseTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakeScpiServer(object):
+    """
+    A local tcp (raw socket) server answering SCPI like queries.
+    Every request (line) waits latency s before being answered.
+    Queries can be joined with ';' (a leading ':' is ignored) and
+    the answers are then joined with ';'.
+    values is a dict of query (upper case): answer string.
+    Use the address attribute to connect (TCPIP::127.0.0.1::port::SOCKET).
+    """
+    def __init__(self, values=None, latency=0.005):
+        if values is None:
+            values = {}
+        values.setdefault('*IDN?', 'pyHegel,FakeScpi,0,1.0')
+        self.values = values
+        self.latency = latency
+        self.requests = 0
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    server.requests += 1
+                    time.sleep(server.latency)
+                    queries = [q.strip().lstrip(':').upper() for q in line.decode('ascii').split(';')]
+                    answers = [server.values.get(q, '0') for q in queries if q.endswith('?')]
+                    if answers:
+                        self.wfile.write((';'.join(answers)+'\n').encode('ascii'))
+        self._server = _ReuseTCPServer(('127.0.0.1', 0), Handler)
+        self.port = self._server.server_address[1]
+        self.address = 'TCPIP::127.0.0.1::%i::SOCKET'%self.port
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class fake_scpi_instrument(instruments_base.visaInstrument):
+    """ Instrument with ndevs float devices meas0, meas1, ... (queries MEAS0?, MEAS1?, ...)
+        and ndevs float devices out0, out1, ... (writes OUT0 val, OUT1 val, ...)
+    """
+    _batch_get_sep = ';:'
+    _batch_set_sep = ';:'
+    def __init__(self, visa_addr, ndevs=5, **kwarg):
+        self._ndevs = ndevs
+        super(fake_scpi_instrument, self).__init__(visa_addr, skip_id_test=True, **kwarg)
+        self.visa.read_termination = '\n'
+        self.visa.write_termination = '\n'
+    def _create_devs(self):
+        for i in range(self._ndevs):
+            setattr(self, 'meas%i'%i, instruments_base.scpiDevice(getstr='MEAS%i?'%i, str_type=float))
+            setattr(self, 'out%i'%i, instruments_base.scpiDevice('OUT%i'%i, str_type=float, min=-10, max=10, autoinit=False))
+        super(fake_scpi_instrument, self)._create_devs()
+
+
+def bench_batch_get(ndevs=5, latency=0.005, n=50):
+    """
+    Compares n reads of ndevs devices of the same instrument done with
+    one get per device to the batched read used by sweep (batch_get).
+    latency is the time the fake server takes to answer every request.
+    """
+    server = FakeScpiServer({'MEAS%i?'%i: '%.6e'%(i*1.5) for i in range(ndevs)}, latency=latency)
+    try:
+        instr = fake_scpi_instrument(server.address, ndevs=ndevs)
+        devs = [getattr(instr, 'meas%i'%i) for i in range(ndevs)]
+        to = time.time()
+        for i in range(n):
+            single = [d.get() for d in devs]
+        t_single = (time.time()-to)/n
+        to = time.time()
+        for i in range(n):
+            batched = instr.batch_get(devs)
+        t_batch = (time.time()-to)/n
+        print('values single: %r'%single)
+        print('values batch:  %r'%batched)
+        print('%i devices, latency %.1f ms: single gets %.2f ms, batch_get %.2f ms (%.1fx)'%(
+                ndevs, latency*1e3, t_single*1e3, t_batch*1e3, t_single/t_batch))
+    finally:
+        server.close()
+    return t_single, t_batch
+
+
+def bench_batch_set(ndevs=5, latency=0.005, n=50):
+    """
+    Compares n writes of ndevs devices of the same instrument done with
+    one set per device to the batched write used by sweep (batch_set).
+    latency is the time the fake server takes to handle every request.
+    A query is added after each loop to wait for all the writes to be handled.
+    """
+    server = FakeScpiServer(latency=latency)
+    try:
+        instr = fake_scpi_instrument(server.address, ndevs=ndevs)
+        devs = [getattr(instr, 'out%i'%i) for i in range(ndevs)]
+        req_start = server.requests
+        to = time.time()
+        for i in range(n):
+            for j, d in enumerate(devs):
+                d.set(i*0.1+j)
+            instr.idn()
+        t_single = (time.time()-to)/n
+        req_single = server.requests - req_start
+        to = time.time()
+        for i in range(n):
+            instr.batch_set([(d, i*0.1+j) for j, d in enumerate(devs)])
+            instr.idn()
+        t_batch = (time.time()-to)/n
+        req_batch = server.requests - req_single - req_start
+        print('caches: %r'%[d.getcache() for d in devs])
+        print('%i devices, latency %.1f ms: single sets %.2f ms (%i requests), batch_set %.2f ms (%i requests)'%(
+                ndevs, latency*1e3, t_single*1e3, req_single, t_batch*1e3, req_batch))
+    finally:
+        server.close()
+    return t_single, t_batch
+
+
+def bench_ascii_decode(n=500000, fmts=['%+.9E', '%.6g'], repeat=5):
+    """
+    Compares the ascii block decoder (decode_ascii_block, used by _decode_block with sep)
+    to np.fromstring for n random values written with the formats in fmts.
+    The first format is fixed width (the fast path), the second is not.
+    """
+    data = np.random.randn(n)*1e-3
+    ret = []
+    for fmt in fmts:
+        s = ','.join([fmt%v for v in data])
+        to = time.time()
+        for i in range(repeat):
+            v_new = instruments_base.decode_ascii_block(s)
+        t_new = (time.time()-to)/repeat
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            to = time.time()
+            for i in range(repeat):
+                v_old = np.fromstring(s, np.float64, sep=',')
+            t_old = (time.time()-to)/repeat
+        print('%i values "%s": fromstring %.1f ms, decode_ascii_block %.1f ms (%.1fx), same result: %s'%(
+                n, fmt, t_old*1e3, t_new*1e3, t_old/t_new, np.array_equal(v_old, v_new)))
+        ret.append((t_old, t_new))
+    return ret
+
+
+class fake_async_instrument(instruments_base.BaseInstrument):
+    """ Instrument with a memory device (value) to time the async machinery. """
+    def _create_devs(self):
+        self.value = instruments_base.MemoryDevice(0.)
+        super(fake_async_instrument, self)._create_devs()
+
+
+def bench_async(n=500, ninstr=3):
+    """
+    Times the per point overhead of the async gets (async_st 0 to 3 as used by
+    sweep/record) of ninstr instruments, with the persistent worker threads
+    (the default) and with a new thread for every point (_async_use_worker=False).
+    """
+    instrs = [fake_async_instrument() for i in range(ninstr)]
+    devs = [instr.value for instr in instrs]
+    ret = []
+    for use_worker in [False, True]:
+        for instr in instrs:
+            instr._async_use_worker = use_worker
+        to = time.time()
+        for i in range(n):
+            for st in range(3):
+                for d in devs:
+                    d.getasync(st)
+            for d in devs:
+                d.getasync(3)
+        dt = (time.time()-to)/n
+        print('%i instruments, %s: %.1f us per point'%(
+                ninstr, 'worker' if use_worker else 'new threads', dt*1e6))
+        ret.append(dt)
+    print('speedup: %.1fx'%(ret[0]/ret[1]))
+    return ret
+
+
+def bench_srq(n=20, meas_time=0.02):
+    """
+    Times n run_and_wait of instruments using a FakeSrqSession that requests service
+    meas_time s after the trigger, for the 3 srq detection methods
+    (polling, handler and event queue).
+    Shows the latency between the srq and its detection.
+    """
+    ret = {}
+    for name, opts in [('polling', dict(poll=True)), ('handler', dict(agilent=True)), ('queue', dict(agilent=False))]:
+        instr = fake_srq_instrument.create(meas_time=meas_time, **opts)
+        instr._async_mode = 'srq'
+        latency = []
+        for i in range(n):
+            instr.run_and_wait()
+            latency.append(time.time() - instr.visa.complete_time)
+        stats = instr.async_completion_stats()
+        print('%-8s: completion %.2f ms (expected %.2f), mean latency after srq %.2f ms (max %.2f)'%(
+                name, stats['mean']*1e3, meas_time*1e3, np.mean(latency)*1e3, np.max(latency)*1e3))
+        ret[name] = stats
+    return ret
+
+
+_startup_code = """
+import sys, time
+to = time.time()
+from pyHegel import instruments
+t_base = time.time() - to
+instruments._populate_instruments(lazy=%r)
+print(t_base, time.time() - to, len(sys.modules))
+"""
+
+def bench_startup(repeat=3):
+    """
+    Times (in new python processes) the import of the instruments package followed
+    by _populate_instruments, with and without lazy loading of the instruments modules.
+    The first lazy run also creates the index cache if needed.
+    """
+    ret = {}
+    for lazy in [False, True]:
+        times = []
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', _startup_code%lazy])
+            t_base, t_total, nmods = out.decode().split()[-3:]
+            times.append(float(t_total))
+        ret[lazy] = min(times)
+        print('lazy=%-5s: %.2f s (base import %.2f s), %s modules loaded'%(lazy, ret[lazy], float(t_base), nmods))
+    print('speedup: %.1fx'%(ret[False]/ret[True]))
+    return ret
+
+
+def bench_construction(drivers=['agilent_PNAL', 'agilent_multi_34410A', 'keithley_2450_smu', 'sr830_lia', 'lakeshore_370'],
+                       n=20, values=None):
+    """
+    Times the creation of the instruments drivers (names from the instruments module)
+    on a fake visa session (FakeSrqSession, with values as answers)
+    so it only measures the python side of the construction (mostly _create_devs).
+    Drivers that can't be created with the fake session are reported and skipped.
+    """
+    from pyHegel import instruments
+    ret = {}
+    with fake_resource_manager(session_class=FakeSrqSession, values=values):
+        for name in drivers:
+            cls = getattr(instruments, name)
+            try:
+                instr = cls('GPIB0::1::INSTR', skip_id_test=True, no_visa_lock=True)
+            except Exception as exc:
+                print('%-25s: skipped (%s: %s)'%(name, exc.__class__.__name__, exc))
+                continue
+            ndevs = len(list(instr.devs_iter()))
+            del instr
+            to = time.time()
+            for i in range(n):
+                instr = cls('GPIB0::1::INSTR', skip_id_test=True, no_visa_lock=True)
+                del instr
+            dt = (time.time()-to)/n
+            print('%-25s: %.2f ms (%i devices)'%(name, dt*1e3, ndevs))
+            ret[name] = dt
+    return ret
+
+
+class fake_array_instrument(instruments_base.BaseInstrument):
+    """
+    The arr device returns (in a reused buffer) npts values after waiting meas_time s.
+    The x device is a memory device that can be swept.
+    """
+    def __init__(self, npts=10000, meas_time=0.005):
+        self._buf = np.zeros(npts)
+        self._meas_time = meas_time
+        super(fake_array_instrument, self).__init__()
+    def _arr_getdev(self):
+        time.sleep(self._meas_time)
+        self._buf[:] = self.x.getcache()
+        return self._buf
+    def _create_devs(self):
+        self.x = instruments_base.MemoryDevice(0.)
+        self._devwrap('arr')
+        super(fake_array_instrument, self)._create_devs()
+
+
+def bench_pipeline(npts=50, arr_npts=5000, meas_time=0.005, beforewait=0.02, path=None):
+    """
+    Times a sweep saving a large array at every point (the per point files),
+    without and with the pipelined mode (sweep.pipeline).
+    The files are created in path (a temporary directory by default, which is removed).
+    """
+    import shutil
+    import tempfile
+    from pyHegel import commands
+    instr = fake_array_instrument(arr_npts, meas_time)
+    tmpdir = path
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+    ret = []
+    try:
+        for pipeline in [False, True]:
+            to = time.time()
+            commands.sweep(instr.x, 0, 1, npts, filename=tmpdir+'/pipeline_%s.txt'%pipeline, out=instr.arr,
+                           graph=False, progress=False, beforewait=beforewait, pipeline=pipeline)
+            dt = (time.time()-to)/npts
+            print('pipeline=%-5s: %.2f ms per point'%(pipeline, dt*1e3))
+            ret.append(dt)
+    finally:
+        if path is None:
+            shutil.rmtree(tmpdir)
+    print('speedup: %.1fx'%(ret[0]/ret[1]))
+    return ret
+
+
+def bench_container(npts=100, arr_npts=4000, path=None):
+    """
+    Times a sweep saving an array of arr_npts values at every point in text files
+    (one per point) and in a binary container (.phc), and the time to read back the arrays.
+    The files are created in path (a temporary directory by default, which is removed).
+    """
+    import glob
+    import shutil
+    import tempfile
+    from pyHegel import commands, util
+    instr = fake_array_instrument(arr_npts, 0.)
+    tmpdir = path
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+    ret = {}
+    try:
+        for ext in ['.txt', '.phc']:
+            filename = tmpdir+'/container'+ext
+            to = time.time()
+            commands.sweep(instr.x, 0, 1, npts, filename=filename, out=instr.arr,
+                           graph=False, progress=False, beforewait=0)
+            dt = (time.time()-to)/npts
+            to = time.time()
+            if ext == '.txt':
+                util.readfile(tmpdir+'/container_*_arr_*.txt')
+            else:
+                util.readfile(filename, opts=dict(dataset=instr.arr.getfullname()))
+            dtr = time.time()-to
+            nfiles = len(glob.glob(tmpdir+'/container*'+ext))
+            print('%s: %.2f ms per point, read %.3f s, %i files'%(ext, dt*1e3, dtr, nfiles))
+            ret[ext] = dt, dtr
+    finally:
+        if path is None:
+            shutil.rmtree(tmpdir)
+    print('speedup: write %.1fx, read %.1fx'%(ret['.txt'][0]/ret['.phc'][0], ret['.txt'][1]/ret['.phc'][1]))
+    return ret
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Fake visa session and resource manager, shared by the tests and the benchmarks.
+    Visa instruments created within fake_resource_manager use a FakeSession
+    (or the session_class given) instead of a real visa connection.
+    fake_srq_instrument is an instrument on a FakeSrqSession, which requests
+    service when an acquisition completes.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import collections
+import threading
+import time
+
+from pyHegel import instruments_base
+from pyHegel.comp2to3 import is_py2
+
+if is_py2:
+    import Queue as queue
+else:
+    import queue
+
+
+class FakeSession(object):
+    """
+    A fake visa session of a 488.2 instrument.
+    values is a dict of query (upper case): answer string. Other queries return '0'.
+    Commands can be joined with ';' (every query then produces its own answer).
+    gpib selects the result of is_gpib.
+    """
+    def __init__(self, resource_manager, gpib=True, values=None):
+        self.resource_manager = resource_manager
+        self.gpib = gpib
+        if values is None:
+            values = {}
+        values.setdefault('*IDN?', 'pyHegel,FakeSession,0,1.0')
+        self.values = values
+        self.timeout = 3000
+        self._lock = threading.Lock()
+        self._stb = 0
+        self._esr = 0
+        self._answers = []
+    def is_gpib(self):
+        return self.gpib
+    def is_usb(self):
+        return False
+    def is_serial(self):
+        return False
+    def is_tcpip(self):
+        return False
+    def clear(self):
+        pass
+    def close(self):
+        pass
+    def _command(self, cmd):
+        """ handles one command (upper case). Returns the answer for a query, None otherwise. """
+        if cmd == '*CLS':
+            with self._lock:
+                self._stb = self._esr = 0
+        elif cmd == '*ESR?':
+            with self._lock:
+                esr = self._esr
+                self._esr = 0
+                self._stb &= ~0x60
+            return '%i'%esr
+        elif cmd.endswith('?'):
+            return self.values.get(cmd, '0')
+    def write(self, val, termination=None, encoding=None):
+        for cmd in val.upper().split(';'):
+            ans = self._command(cmd.strip())
+            if ans is not None:
+                self._answers.append(ans)
+    def read(self, encoding=None, chunk_size=None):
+        return self._answers.pop(0)
+    def read_stb(self):
+        with self._lock:
+            stb = self._stb
+            self._stb &= ~0x40 # a serial poll clears the request
+        return stb
+
+
+_resource_info = collections.namedtuple('_resource_info', 'interface_type interface_board_number resource_class resource_name alias')
+
+class FakeResourceManager(object):
+    """ Resource manager opening session_class(self, **session_kwarg) sessions. """
+    def __init__(self, agilent=True, session_class=FakeSession, **session_kwarg):
+        self.agilent = agilent
+        self.session_class = session_class
+        self.session_kwarg = session_kwarg
+    def is_agilent(self):
+        return self.agilent
+    def open_resource(self, visa_addr, **kwarg):
+        return self.session_class(self, **self.session_kwarg)
+    def resource_info(self, visa_addr):
+        intf = instruments_base.visa_wrap.constants.InterfaceType
+        gpib = self.session_kwarg.get('gpib', True)
+        return _resource_info(intf.gpib if gpib else intf.tcpip, 0, 'INSTR', visa_addr, None)
+
+
+class fake_resource_manager(object):
+    """ Context manager to replace the visa resource manager by FakeResourceManager(**kwarg)
+        so that visa instruments created within it use a fake session.
+    """
+    def __init__(self, **kwarg):
+        self.rsrc_mngr = FakeResourceManager(**kwarg)
+    def __enter__(self):
+        self._old = instruments_base.rsrc_mngr
+        instruments_base.rsrc_mngr = self.rsrc_mngr
+        return self.rsrc_mngr
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        instruments_base.rsrc_mngr = self._old
+
+
+class _FakeWaitResponse(object):
+    def __init__(self, timed_out):
+        self.timed_out = timed_out
+
+
+class FakeSrqSession(FakeSession):
+    """
+    A FakeSession that completes an acquisition (INIT;*OPC) meas_time s after
+    it is triggered. It then sets OPC in the event status register and requests
+    service (SRQ). The SRQ is reported through the status byte (read_stb), the
+    installed handler (VI_HNDLR) or the event queue (VI_QUEUE), like a real
+    visa session. complete_time is the time of the last completion.
+    """
+    def __init__(self, resource_manager, meas_time=0.02, **kwarg):
+        super(FakeSrqSession, self).__init__(resource_manager, **kwarg)
+        self.meas_time = meas_time
+        self._handlers = []
+        self._mech = 0
+        self._events = queue.Queue()
+        self.complete_time = None
+    def _command(self, cmd):
+        if cmd == '*OPC':
+            t = threading.Timer(self.meas_time, self._complete)
+            t.daemon = True
+            t.start()
+            return None
+        return super(FakeSrqSession, self)._command(cmd)
+    def _complete(self):
+        cnsts = instruments_base.visa_wrap.constants
+        with self._lock:
+            self._esr |= 0x01
+            self._stb |= 0x60
+            self.complete_time = time.time()
+        if self._mech & cnsts.VI_HNDLR:
+            for handler, userval in self._handlers:
+                handler(self, cnsts.VI_EVENT_SERVICE_REQ, None, userval)
+        if self._mech & cnsts.VI_QUEUE:
+            self._events.put(cnsts.VI_EVENT_SERVICE_REQ)
+    def install_visa_handler(self, event_type, handler, userval):
+        self._handlers.append((handler, userval))
+        return userval
+    def uninstall_visa_handler(self, event_type, handler, userval):
+        self._handlers = [h for h in self._handlers if h[0] is not handler]
+    def enable_event(self, event_type, mechanism):
+        self._mech |= mechanism
+    def disable_event(self, event_type, mechanism):
+        self._mech &= ~mechanism
+    def wait_on_event(self, event_type, timeout_ms, capture_timeout=False):
+        try:
+            self._events.get(timeout=timeout_ms/1000.)
+        except queue.Empty:
+            if capture_timeout:
+                return _FakeWaitResponse(True)
+            raise instruments_base.visa_wrap.VisaIOError(instruments_base.visa_wrap.constants.VI_ERROR_TMO)
+        return _FakeWaitResponse(False)
+
+
+class fake_srq_instrument(instruments_base.visaInstrumentAsync):
+    """ A visaInstrumentAsync (with a readval device) on a FakeSrqSession.
+        Use the create class method.
+    """
+    def _create_devs(self):
+        self.value = instruments_base.MemoryDevice(1.)
+        self.readval = instruments_base.ReadvalDev(self.value)
+        super(fake_srq_instrument, self)._create_devs()
+    @classmethod
+    def create(cls, poll=False, agilent=True, gpib=True, meas_time=0.02):
+        """ poll, agilent and gpib select the detection method used (see visaInstrumentAsync):
+              poll=True: polling of the status byte
+              agilent=True, gpib=True: srq handler
+              agilent=False: visa event queue
+        """
+        with fake_resource_manager(session_class=FakeSrqSession, agilent=agilent, gpib=gpib, meas_time=meas_time):
+            return cls('GPIB0::1::INSTR', poll=poll, skip_id_test=True, no_visa_lock=True)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression tests of the batched gets and sets (visaInstrument.batch_get/batch_set
+and their use in sweeps) and of the cache invalidation on a fake E363x power supply,
+whose devices select their channel with options_apply.
+Run them with pytest.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+from pyHegel import commands, instruments_base
+from pyHegel.instruments.agilent import agilent_power_supply_E363x
+from pyHegel.tests.fake_visa import FakeSession, fake_resource_manager
+
+
+class FakeE363xSession(FakeSession):
+    """
+    A FakeSession that keeps the selected channel (INSTrument:SELect) and
+    the voltage of every channel. All the writes are kept in log.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FakeE363xSession, self).__init__(*args, **kwargs)
+        self.ch = 'P6V'
+        self.volts = dict(P6V=1., P25V=2., N25V=-3.)
+        self.log = []
+    def write(self, val, termination=None, encoding=None):
+        self.log.append(val)
+        answers = []
+        for cmd in val.upper().split(';'):
+            cmd = cmd.strip().lstrip(':')
+            if cmd.startswith('INSTRUMENT:SELECT '):
+                self.ch = cmd.split()[1]
+            elif cmd == 'INSTRUMENT:SELECT?':
+                answers.append(self.ch)
+            elif cmd.startswith('VOLTAGE '):
+                self.volts[self.ch] = float(cmd.split()[1])
+            elif cmd in ('VOLTAGE?', 'MEASURE:VOLTAGE?'):
+                answers.append('%r'%self.volts[self.ch])
+            elif cmd.endswith('?'):
+                answers.append(self.values.get(cmd, '0'))
+        if answers:
+            # a compound query returns a single line
+            self._answers.append(';'.join(answers))
+
+def make_ps():
+    with fake_resource_manager(session_class=FakeE363xSession):
+        return agilent_power_supply_E363x('GPIB0::5::INSTR', skip_id_test=True, no_visa_lock=True)
+
+
+def test_batch_get_channels():
+    ps = make_ps()
+    devs = [(ps.volt_measured, dict(ch=c)) for c in ['P6V', 'P25V', 'N25V']]
+    assert ps.batch_get(devs) == [1., 2., -3.]
+
+
+def test_batch_get_order():
+    ps = make_ps()
+    ps.visa.log = []
+    vals = ps.batch_get([ps.output_track_en, (ps.volt_measured, dict(ch='P25V')), ps.output_en])
+    assert vals[1] == 2.
+    # the channel device is read (with its channel select) between the 2 others
+    log = [l.upper() for l in ps.visa.log]
+    assert log.index('INSTRUMENT:SELECT P25V') > 0
+    assert log[-1].startswith('OUTPUT?') or log[-1].startswith('OUTP?')
+
+
+def test_readall_order():
+    ps = make_ps()
+    ps.visa.log = []
+    devs = [(ps.volt_measured, dict(ch='N25V')), ps.output_en, ps.output_track_en, ps.current_ch]
+    fmt = dict(basename='', append=True, file=False, multi=None)
+    vals = commands._readall(devs, [fmt]*len(devs), 0, noflat=True)
+    assert vals[0] == -3.
+    assert vals[3].upper() == 'N25V'
+    # the devices are read in order, the consecutive ones in a single request
+    assert ps.visa.log[-2:] == ['MEASure:VOLTage?', 'OUTput?;:OUTput:TRACk?;:INSTrument:SELect?']
+
+
+def test_batch_set_channels():
+    ps = make_ps()
+    vals = ps.batch_set([(ps.volt_level, 1.5, dict(ch='P6V')), (ps.volt_level, 2.5, dict(ch='P25V'))])
+    assert vals == [1.5, 2.5]
+    assert ps.visa.volts == dict(P6V=1.5, P25V=2.5, N25V=-3.)
+
+
+def _sweep_log(ps):
+    """ Returns the writes done by the sweep points (after the file headers are read). """
+    log = ps.visa.log
+    return log[len(log) - log[::-1].index('*idn?'):]
+
+def test_sweep_sets_order():
+    ps = make_ps()
+    ps.visa.log = []
+    commands.sweep_multi([ps.output_track_en, ps.output_en, (ps.volt_level, dict(ch='P25V'))],
+                         [[0, 1], [1, 0], [3., 4.]], parallel=True, out=[ps.output_en, ps.output_track_en],
+                         filename=None, graph=False, progress=False, beforewait=0)
+    assert ps.visa.volts == dict(P6V=1., P25V=4., N25V=-3.)
+    # the consecutive sets (and gets) are done in order, in a single request
+    assert _sweep_log(ps) == ['OUTput:TRACk 0;:OUTput 1', 'OUTput?', 'VOLTage 3.0', 'VOLTage?', 'OUTput?;:OUTput:TRACk?',
+                              'OUTput:TRACk 1;:OUTput 0', 'OUTput?', 'VOLTage 4.0', 'VOLTage?', 'OUTput?;:OUTput:TRACk?']
+
+def test_sweep_batch_disabled():
+    ps = make_ps()
+    ps.batch_en = False
+    ps.visa.log = []
+    commands.sweep_multi([ps.output_track_en, ps.output_en], [[0, 1], [1, 0]], parallel=True,
+                         out=[ps.output_en, ps.output_track_en], filename=None, graph=False, progress=False, beforewait=0)
+    assert _sweep_log(ps) == ['OUTput:TRACk 0', 'OUTput 1', 'OUTput?', 'OUTput?', 'OUTput:TRACk?',
+                              'OUTput:TRACk 1', 'OUTput 0', 'OUTput?', 'OUTput?', 'OUTput:TRACk?']
+
+def test_batch_timing():
+    ps = make_ps()
+    stats = instruments_base.timing_stats
+    stats.clear()
+    stats.enabled = True
+    try:
+        ps.batch_get([ps.output_en, ps.output_track_en])
+        ps.batch_set([(ps.output_track_en, True), (ps.output_en, False)])
+        snap = stats.snapshot()
+        for dev in (ps.output_en, ps.output_track_en):
+            assert snap[(stats.key(dev), 'set')]['count'] == 1
+        # output_en has setget
+        assert snap[(stats.key(ps.output_en), 'get')]['count'] == 2
+        assert snap[(stats.key(ps.output_track_en), 'get')]['count'] == 1
+    finally:
+        stats.enabled = False
+        stats.clear()
+
+def test_cache_invalidate_channel():
+    ps = make_ps()
+    # the devices using current_ch as option (or in a ChoiceDevDep) depend on it
+    assert ps.volt_level in ps.current_ch._cache_invalidate
+    assert ps.volt_level.get(ch='P6V') == 1.
+    ps.current_ch.set('P25V')
+    assert ps.volt_level.getcache() == 2.
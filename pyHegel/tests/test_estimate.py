@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression tests of the sweep duration estimator (sweep.estimate) on the
+dummy instrument.
+Run them with pytest.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import pytest
+
+from pyHegel import commands, instruments, instruments_base
+
+
+@pytest.fixture
+def dummy():
+    stats = instruments_base.timing_stats
+    stats.clear()
+    stats.enabled = True
+    try:
+        yield instruments.dummy()
+    finally:
+        stats.enabled = False
+        stats.clear()
+
+def test_timing_key_of_proxy(dummy):
+    stats = instruments_base.timing_stats
+    stats.add(dummy, 'srq_complete', 0.01)
+    proxy = dummy.rand.instr
+    assert stats.key(proxy) == stats.key(dummy)
+    assert stats.key(dummy.volt.instr) is not None
+
+def test_estimate_async(dummy):
+    d = dummy
+    d.rand.get()
+    instruments_base.timing_stats.add(d, 'srq_complete', 0.01)
+    ret = commands.sweep.estimate([d.volt, d.current], [0, 0], [1, 1], [3, 4], out=[d.rand],
+                                  async_en=True, calibrate=False, as_dict=True)
+    assert ret['npts'] == 12
+    entries = [b for b in ret['breakdown'] if b['operation'] == 'async']
+    assert len(entries) == 1
+    assert entries[0]['source'] == 'stats'
+    assert entries[0]['mean'] >= 0.01
+
+def test_estimate_no_set_by_default(dummy, monkeypatch):
+    d = dummy
+    def no_set(*args, **kwargs):
+        raise AssertionError('estimate wrote to the instrument')
+    monkeypatch.setattr(d.volt, 'set', no_set)
+    ret = commands.sweep.estimate(d.volt, 0, 1, 3, out=[d.rand], as_dict=True)
+    sets = [b for b in ret['breakdown'] if b['operation'] == 'set']
+    assert [b['source'] for b in sets] == ['unknown']
+    gets = [b for b in ret['breakdown'] if b['operation'] == 'get']
+    assert [b['source'] for b in gets] == ['calib']
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression tests of the completion detection of visaInstrumentAsync
+(srq handler, visa event queue and status byte polling) and of
+async_completion_stats, on a fake instrument using FakeSrqSession.
+Run them with pytest.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import time
+
+import pytest
+
+from pyHegel import instruments_base
+from pyHegel.tests.fake_visa import fake_srq_instrument
+
+METHODS = [('handler', dict(agilent=True)), ('queue', dict(agilent=False)), ('polling', dict(poll=True))]
+
+
+def _count_calls(obj, name, calls, monkeypatch):
+    """ Replaces the method name of obj by a wrapper that appends name to calls. """
+    func = getattr(obj, name)
+    def wrapper(*args, **kwargs):
+        calls.append(name)
+        return func(*args, **kwargs)
+    monkeypatch.setattr(obj, name, wrapper)
+
+@pytest.mark.parametrize('method, opts', METHODS, ids=[m[0] for m in METHODS])
+def test_completion_detection(method, opts, monkeypatch):
+    meas_time = 0.02
+    instr = fake_srq_instrument.create(meas_time=meas_time, **opts)
+    visa = instr.visa
+    cnsts = instruments_base.visa_wrap.constants
+    assert instr._async_polling == (method == 'polling')
+    assert (instr._RQS_status != -1) == (method == 'handler')
+    calls = []
+    for name in ['wait_on_event', 'enable_event', 'read_stb']:
+        _count_calls(visa, name, calls, monkeypatch)
+    handled = []
+    def counting(handler):
+        def wrapper(*args):
+            handled.append(args)
+            return handler(*args)
+        return wrapper
+    visa._handlers = [(counting(h), u) for h, u in visa._handlers]
+    n = 3
+    for i in range(n):
+        to = time.time()
+        instr.run_and_wait()
+        # it only returns after the completion
+        assert visa.complete_time is not None
+        assert to + meas_time <= visa.complete_time <= time.time()
+    if method == 'handler':
+        assert len(handled) == n
+        assert 'wait_on_event' not in calls
+    elif method == 'queue':
+        # the wait can be done in many slices
+        assert calls.count('wait_on_event') >= n
+        # the service requests were all taken from the queue
+        assert visa._events.empty()
+    else:
+        assert 'wait_on_event' not in calls and 'enable_event' not in calls
+        # the trig cleanup reads the status byte, then at least one poll per run
+        assert calls.count('read_stb') >= 2*n
+    assert not visa._mech & (cnsts.VI_HNDLR | cnsts.VI_QUEUE)
+    stats = instr.async_completion_stats()
+    assert stats['count'] == n
+    assert meas_time*0.9 <= stats['min'] <= stats['mean'] <= stats['max'] < meas_time + 0.5
+    assert stats['last'] is not None
+
+def test_completion_stats_reset():
+    instr = fake_srq_instrument.create(agilent=True, meas_time=0.01)
+    instr.run_and_wait()
+    stats = instr.async_completion_stats(reset=True)
+    assert stats['count'] == 1
+    assert stats['last'] == stats['total']
+    stats = instr.async_completion_stats()
+    assert stats['count'] == 0
+    assert stats['last'] is None
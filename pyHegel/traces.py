@@ -30,6 +30,7 @@ from __future__ import absolute_import, print_function, division
 import time
 import functools
 import sys
+import os
 import gc
 
 from . import qt_wrap  # This is used for reset_pyhegel command
@@ -421,6 +422,233 @@ def _offsetText_helper(self):
     else:
         self.offsetText.xytext = new_xy
 
+
+#########################################################
+# Min/max decimation
+#########################################################
+
+class MinMaxPyramid(object):
+    """
+    Keeps the minimum and maximum of blocks of 2, 4, 8, ... 2**k points of data
+    (along the first axis, so data can be 1D or 2D with one column per curve).
+    This allows to quickly obtain the exact envelope of a very large data set
+    for a display of limited resolution (see envelope), or the exact
+    extremes of any range (see range_minmax).
+    NaN values are ignored (unless all the values of a block are NaN).
+    """
+    def __init__(self, data=None):
+        self.data = None
+        self._levels = [] # list of [mins, maxs, length] for block size 2**(i+1)
+        if data is not None:
+            self.set_data(data)
+    def __len__(self):
+        if self.data is None:
+            return 0
+        return len(self.data)
+    @property
+    def nlevels(self):
+        return len(self._levels)
+    def set_data(self, data):
+        """ Rebuilds the pyramid for a new data set. """
+        self.data = data
+        self._levels = []
+        self._update_levels(0)
+    def extend(self, data):
+        """
+        data should be the same as the previous data with extra points
+        appended at the end (it can be a new array).
+        Only the blocks containing the new points are recalculated.
+        """
+        n_old = len(self)
+        self.data = data
+        self._update_levels(n_old)
+    def _update_levels(self, n_old):
+        prev_mn = prev_mx = self.data
+        prev_n = len(self.data)
+        i = 0
+        # start is the first element of the previous level that changed.
+        start = n_old
+        while prev_n > 1:
+            n = (prev_n+1)//2
+            start = start//2
+            a = 2*start
+            mn = np.fmin(prev_mn[a:prev_n-1:2], prev_mn[a+1:prev_n:2])
+            mx = np.fmax(prev_mx[a:prev_n-1:2], prev_mx[a+1:prev_n:2])
+            if prev_n%2:
+                # the last block is partial
+                mn = np.concatenate((mn, prev_mn[prev_n-1:prev_n]))
+                mx = np.concatenate((mx, prev_mx[prev_n-1:prev_n]))
+            if i >= len(self._levels):
+                self._levels.append([mn[:0], mx[:0], 0])
+            lvl = self._levels[i]
+            buf_mn, buf_mx = lvl[0], lvl[1]
+            if len(buf_mn) < n:
+                # grow by doubling so that extend is cheap on average
+                size = max(n, 2*len(buf_mn))
+                buf_mn = np.empty((size,)+mn.shape[1:], dtype=mn.dtype)
+                buf_mx = np.empty((size,)+mx.shape[1:], dtype=mx.dtype)
+                buf_mn[:start] = lvl[0][:start]
+                buf_mx[:start] = lvl[1][:start]
+            buf_mn[start:n] = mn
+            buf_mx[start:n] = mx
+            self._levels[i] = [buf_mn, buf_mx, n]
+            prev_mn, prev_mx, prev_n = buf_mn, buf_mx, n
+            i += 1
+        del self._levels[i:]
+    def level(self, k):
+        """ returns the mins and maxs arrays for blocks of 2**k points. """
+        if k == 0:
+            return self.data, self.data
+        mn, mx, n = self._levels[k-1]
+        return mn[:n], mx[:n]
+    def range_minmax(self, start, stop):
+        """ returns the exact min and max of data[start:stop] """
+        mn = mx = None
+        nlevels = self.nlevels
+        while start < stop:
+            k = 0
+            while k < nlevels and start % (2**(k+1)) == 0 and start + 2**(k+1) <= stop:
+                k += 1
+            lmn, lmx = self.level(k)
+            j = start >> k
+            if mn is None:
+                mn, mx = lmn[j], lmx[j]
+            else:
+                mn, mx = np.fmin(mn, lmn[j]), np.fmax(mx, lmx[j])
+            start += 2**k
+        return mn, mx
+    def envelope(self, start, stop, nbins):
+        """
+        Splits data[start:stop] in about nbins (at least nbins/2) bins and returns
+        the exact min and max of each one.
+        The returned values are (bin_starts, bin_stop, mins, maxs) where bin_starts are the indices
+        of the first point of every bin and bin_stop is the end of the last bin.
+        The bins are aligned on the pyramid blocks so the first one can start before start and the last
+        can end after stop (by less than one bin).
+        """
+        n = len(self)
+        start = max(start, 0)
+        stop = min(stop, n)
+        per_bin = max((stop-start)/max(nbins, 1), 1)
+        k = 0
+        while k < self.nlevels and 2**(k+1) <= per_bin:
+            k += 1
+        bs = 2**k
+        lmn, lmx = self.level(k)
+        j0 = start//bs
+        j1 = min(-(-stop//bs), len(lmn))
+        m = max(int(per_bin//bs), 1)
+        idx = np.arange(0, j1-j0, m)
+        mins = np.fmin.reduceat(lmn[j0:j1], idx, axis=0)
+        maxs = np.fmax.reduceat(lmx[j0:j1], idx, axis=0)
+        return (idx+j0)*bs, min(j1*bs, n), mins, maxs
+
+def _xlim_to_data(v, x):
+    """ converts a matplotlib axis limit v to the same type as x """
+    if np.issubdtype(x.dtype, np.datetime64):
+        return np.datetime64(int(num2epoch(v)*1e6), 'us').astype(x.dtype)
+    return v
+
+def _monotonic_order(x):
+    """ returns 1 for non-decreasing x, -1 for non-increasing x and 0 otherwise. """
+    if len(x) < 2:
+        return 1
+    d = x[1:] >= x[:-1]
+    if np.all(d):
+        return 1
+    if not np.any(x[1:] > x[:-1]):
+        return -1
+    return 0
+
+def minmax_decimate(x, pyramid, xlim=None, ncols=1000, order=1):
+    """
+    Returns x, y to plot a line showing the data of the pyramid
+    (see MinMaxPyramid) with a resolution of ncols over the xlim range.
+    x is the x data, which needs to be sorted (order=1 for increasing, -1 for decreasing).
+    When there are more than 2 points per column, every column is replaced by
+    its min and max, which keeps the exact envelope of the data (spikes are not lost).
+    The points outside of xlim are replaced by their min and max (at the first and last x),
+    so autoscaling still sees all the data.
+    y has the same number of dimensions as the pyramid data.
+    """
+    n = len(pyramid)
+    data = pyramid.data
+    if xlim is None:
+        i0, i1 = 0, n
+    else:
+        xmin, xmax = sorted(xlim)
+        xmin, xmax = _xlim_to_data(xmin, x), _xlim_to_data(xmax, x)
+        if order >= 0:
+            i0 = np.searchsorted(x, xmin, side='left')
+            i1 = np.searchsorted(x, xmax, side='right')
+        else:
+            xr = x[::-1]
+            i0 = n - np.searchsorted(xr, xmax, side='right')
+            i1 = n - np.searchsorted(xr, xmin, side='left')
+        # include one more point on each side so the lines go to the edges
+        i0 = max(i0-1, 0)
+        i1 = min(i1+1, n)
+        if i1 <= i0:
+            i0, i1 = max(i0-1, 0), min(i0+1, n)
+    if i1-i0 <= 2*ncols:
+        xs = x[i0:i1]
+        ys = data[i0:i1]
+        stop = i1
+    else:
+        starts, stop, mins, maxs = pyramid.envelope(i0, i1, ncols)
+        i0 = starts[0]
+        xs = np.repeat(x[starts], 2)
+        ys = np.empty((2*len(starts),)+mins.shape[1:], dtype=mins.dtype)
+        ys[0::2] = mins
+        ys[1::2] = maxs
+    xparts = [xs]
+    yparts = [ys]
+    if i0 > 0:
+        mn, mx = pyramid.range_minmax(0, i0)
+        xparts.insert(0, x[[0, 0]])
+        yparts.insert(0, np.array([mn, mx]))
+    if stop < n:
+        mn, mx = pyramid.range_minmax(stop, n)
+        xparts.append(x[[n-1, n-1]])
+        yparts.append(np.array([mn, mx]))
+    if len(xparts) == 1:
+        return xs, ys
+    return np.concatenate(xparts), np.concatenate(yparts)
+
+def _axes_ncols(ax):
+    """ returns the width of the axes in pixels """
+    return max(int(ax.bbox.width), 10)
+
+class MinMaxLine(object):
+    """
+    Attaches a min/max decimation to a matplotlib line (see minmax_decimate).
+    The full data is taken from the line and is replaced by its
+    envelope at screen resolution, which is recalculated on every zoom or pan.
+    """
+    def __init__(self, line):
+        self.line = line
+        self.x = np.asarray(line.get_xdata(orig=True))
+        self.order = _monotonic_order(self.x)
+        if self.order == 0:
+            raise ValueError('MinMaxLine requires sorted x data.')
+        self.pyramid = MinMaxPyramid(np.asarray(line.get_ydata(orig=True)))
+        ax = line.axes
+        # The callbacks only keep a weak reference to the method so we keep
+        # ourself alive with the line.
+        line._minmax_line = self
+        for a in ax.get_shared_x_axes().get_siblings(ax):
+            a.callbacks.connect('xlim_changed', self.xlim_changed)
+        self.redo(ax)
+    def redo(self, ax=None, xlim=None):
+        if ax is None:
+            ax = self.line.axes
+        if xlim is None and not ax.get_autoscalex_on():
+            xlim = ax.get_xlim()
+        x, y = minmax_decimate(self.x, self.pyramid, xlim, _axes_ncols(ax), self.order)
+        self.line.set_data(x, y)
+    def xlim_changed(self, ax):
+        self.redo(ax, ax.get_xlim())
+
 class ExtraDialog(QtGui.QDialog):
     def __init__(self, value, parent=None):
         if value is None:
@@ -443,7 +671,18 @@ class ExtraDialog(QtGui.QDialog):
 
 
 class Trace(TraceBase):
-    def __init__(self, width=9.00, height=7.00, dpi=72, time_mode = False, comment_func=None, wait_time=None):
+    def __init__(self, width=9.00, height=7.00, dpi=72, time_mode = False, comment_func=None, wait_time=None,
+                 max_fps=None, max_points=None, decimate=True):
+        """
+        max_fps is the maximum number of redraws per second produced by addPoint.
+                Points added faster than that are accumulated and shown on the next redraw.
+                Defaults to the traces max_frame_rate entry of the pyHegel configuration.
+                Use 0 to redraw after every point (the old behavior).
+        max_points when given, only the last max_points points are kept (and shown).
+        decimate when True (default) and the x data is sorted, the curves are drawn
+                 using their min/max envelope at screen resolution (see minmax_decimate)
+                 when there are many more points than pixels.
+        """
         super(Trace, self).__init__(width=width, height=height, dpi=dpi)
         if is_py2:
             ax = host_subplot_class(self.fig, 111)
@@ -452,8 +691,18 @@ class Trace(TraceBase):
             ax = self.fig.subplots()
         self.offset = 50
         self.axs = [ax]
-        self.xs = None
-        self.ys = None
+        self.max_points = max_points
+        self.decimate = decimate
+        self._clear_buffers()
+        if max_fps is None:
+            max_fps = config.pyHegel_conf.traces_max_frame_rate
+        self.max_fps = max_fps
+        self._last_draw_time = 0.
+        self._update_pending = False
+        self._update_timer = QtCore.QTimer()
+        self._update_timer.setSingleShot(True)
+        self._update_timer.timeout.connect(self._delayed_update)
+        ax.callbacks.connect('xlim_changed', self._xlim_changed)
         self.xmax = None
         self.xmin = None
         self.legend_strs = None
@@ -535,6 +784,7 @@ class Trace(TraceBase):
                 t = 'Running'
                 c = 'green'
         else:
+            self.flush_update()
             self.pause_button.setEnabled(False)
             self.abort_button.setEnabled(False)
             self.comment_button.setEnabled(False)
@@ -604,24 +854,145 @@ class Trace(TraceBase):
         self.update()
     def set_xlabel(self, label):
         self.axs[0].set_xlabel(label)
+    # The points are kept in _xbuf/_ybuf which are larger than needed (they double in size
+    # when full) so that adding a point does not need to copy all the previous ones.
+    # The valid data is _xbuf[_start:_start+_npts]. When max_points is used, the buffers
+    # have twice that size and the last points are moved back to the start only when the end is reached.
+    def _clear_buffers(self):
+        self._xbuf = None
+        self._ybuf = None
+        self._start = 0
+        self._npts = 0
+        # _x_order is None (unknown), 1 (increasing), -1 (decreasing) or 0 (unsorted)
+        self._x_order = None
+        # _data_gen changes every time points are removed or replaced (the pyramid needs a rebuild)
+        self._data_gen = 0
+        self._pyramid = None
+        self._pyramid_gen = None
+    def _update_x_order(self, x):
+        if self._npts == 0 or self._x_order == 0:
+            return
+        prev = self._xbuf[self._start+self._npts-1]
+        if x == prev:
+            return
+        order = 1 if x > prev else -1
+        if self._x_order is None:
+            self._x_order = order
+        elif self._x_order != order:
+            self._x_order = 0
+    @property
+    def xs(self):
+        if self._xbuf is None:
+            return None
+        return self._xbuf[self._start:self._start+self._npts]
+    @property
+    def ys(self):
+        if self._ybuf is None:
+            return None
+        return self._ybuf[self._start:self._start+self._npts]
+    def _append_point(self, x, ys):
+        ys = np.asarray(ys)
+        xdtype = np.result_type(np.asarray(x).dtype, float)
+        if self._xbuf is None:
+            n = 1024 if self.max_points is None else 2*self.max_points
+            self._xbuf = np.empty(n, dtype=xdtype)
+            self._ybuf = np.empty((n,)+ys.shape, dtype=np.result_type(ys.dtype, float))
+        elif np.result_type(self._xbuf.dtype, xdtype) != self._xbuf.dtype:
+            # the buffer can come from setPoints with integers
+            self._xbuf = self._xbuf.astype(np.result_type(self._xbuf.dtype, xdtype))
+        self._update_x_order(x)
+        end = self._start + self._npts
+        if end >= len(self._xbuf):
+            npts = self._npts
+            if self.max_points is not None and npts >= self.max_points:
+                npts = self.max_points - 1
+                xbuf, ybuf = self._xbuf, self._ybuf
+            else:
+                n = max(2*len(self._xbuf), 16)
+                xbuf = np.empty(n, dtype=np.result_type(self._xbuf.dtype, float))
+                ybuf = np.empty((n,)+self._ybuf.shape[1:], dtype=np.result_type(self._ybuf.dtype, float))
+            xbuf[:npts] = self._xbuf[end-npts:end]
+            ybuf[:npts] = self._ybuf[end-npts:end]
+            self._xbuf, self._ybuf = xbuf, ybuf
+            self._start = 0
+            if npts != self._npts:
+                self._data_gen += 1
+            self._npts = end = npts
+        self._xbuf[end] = x
+        self._ybuf[end] = ys
+        self._npts += 1
+        if self.max_points is not None and self._npts > self.max_points:
+            self._start += 1
+            self._data_gen += 1
+            self._npts -= 1
     def addPoint(self, x, ys):
         if self.time_mode:
             # convert from sec since epoch to matplotlib date format
             x = _time2date(x)
-        if self.xs is None:
-            self.xs = np.array([x])
-        else:  self.xs = np.append(self.xs, x)
-        if self.ys is None:
-            self.ys = np.array([ys])
-        else:  self.ys = np.append(self.ys, [ys], axis=0)
-        self.update()
+        self._append_point(x, ys)
+        self.request_update()
     def setPoints(self, x, y):
         if self.time_mode:
             # convert from sec since epoch to matplotlib date format
             x = _time2date(x)
-        self.xs = np.array(x)
-        self.ys = np.array(y.T)
+        self._xbuf = np.array(x)
+        self._ybuf = np.array(y.T)
+        self._start = 0
+        self._npts = len(self._xbuf)
+        self._x_order = _monotonic_order(self._xbuf)
+        self._data_gen += 1
         self.update()
+    def request_update(self):
+        """
+        Does an update, unless the last one was too recent according to max_fps.
+        In that case the update is delayed (using a Qt timer), so
+        many requests end up producing only one update.
+        """
+        if self.max_fps is None or self.max_fps <= 0:
+            self.update()
+            return
+        if self._update_pending:
+            # The timer only fires when Qt events are processed. This makes sure
+            # a busy loop still redraws at max_fps.
+            if time.time() - self._last_draw_time < 1./self.max_fps:
+                return
+            self._update_timer.stop()
+        else:
+            delay = self._last_draw_time + 1./self.max_fps - time.time()
+            if delay > 0:
+                self._update_pending = True
+                self._update_timer.start(int(delay*1000)+1)
+                return
+        self.update()
+    def _delayed_update(self):
+        if self._update_pending:
+            self.update()
+    def _curves_data(self, xlim=None):
+        """
+        Returns the x and ys to draw. ys has one column per curve.
+        When decimating, they are for the xlim view (or the full range when None).
+        """
+        x, ys = self.xs, self.ys
+        ax = self.axs[0]
+        if not self.decimate or self._x_order == 0 or len(x) <= 2*_axes_ncols(ax):
+            return x, ys
+        if self._pyramid is None or self._pyramid_gen != self._data_gen:
+            self._pyramid = MinMaxPyramid(ys)
+            self._pyramid_gen = self._data_gen
+        elif self._pyramid.data is not ys:
+            self._pyramid.extend(ys)
+        return minmax_decimate(x, self._pyramid, xlim, _axes_ncols(ax), self._x_order or 1)
+    def _xlim_changed(self, ax):
+        if self.first_update or self.xs is None:
+            return
+        x, ys = self._curves_data(ax.get_xlim())
+        for crv, y in zip(self.crvs, ys.T):
+            crv.set_data(x, y)
+    def flush_update(self):
+        """ Performs a pending update immediately (see request_update) """
+        if self._update_pending:
+            self._update_timer.stop()
+            self.update()
     def setlegend(self, str_lst):
         self.legend_strs = str_lst
         self.update()
@@ -644,6 +1015,8 @@ class Trace(TraceBase):
         if draw:
             self.draw()
     def update(self):
+        self._update_pending = False
+        self._last_draw_time = time.time()
         if self.xs is None:
             self.draw()
             return
@@ -672,6 +1045,7 @@ class Trace(TraceBase):
                 else:
                     ax.spines['right'].set_position(('outward', offset*i))
                 self.axs.append(ax)
+                ax.callbacks.connect('xlim_changed', self._xlim_changed)
                 # add them to figure so selecting axes (press 1, 2, a) works properly
                 self.fig.add_axes(ax)
                 if self.time_mode:
@@ -681,11 +1055,14 @@ class Trace(TraceBase):
                 ax.set_xlim(self.xmin, self.xmax, auto=autox)
             self.crvs = []
             #self.ax.clear()
-        x = self.xs
+        if self.axs[0].get_autoscalex_on():
+            x, ys = self._curves_data()
+        else:
+            x, ys = self._curves_data(self.axs[0].get_xlim())
         plot_kwargs = {}
         if is_py3:
             color_cycler = rcParams['axes.prop_cycle']()
-        for i,(y,ax) in enumerate(zip(self.ys.T, self.axs)):
+        for i,(y,ax) in enumerate(zip(ys.T, self.axs)):
             style = '.-'
             if is_py3:
                 line_color = next(color_cycler)['color']
@@ -729,40 +1106,201 @@ def lots_avg(n):
     """
     This returns a fucntion that will return the average of blocks of n points
     """
-    return lambda x: x.reshape((-1, n)).mean(axis=1)
+    def avg(x):
+        m = len(x)//n
+        return x[:m*n].reshape((-1, n)).mean(axis=1)
+    return avg
+
+class LotsPyramid(object):
+    """
+    Min/max/mean pyramid of a large 1D (memory mapped) data array.
+    Level k (k>=1) contains the min, max and mean of blocks of factor**k points.
+    The levels are all saved in a single sidecar file (a .npy file of a
+    structured array) which is reused the next time the same data file is opened
+    (it is rebuilt if it is older than the data file or does not match).
+    When the sidecar file cannot be written, the pyramid is kept in memory.
+    """
+    _chunk_size = 2**24
+    def __init__(self, data, sidecar_filename=None, factor=32, quiet=False):
+        self.data = data
+        self.factor = factor
+        self.sidecar_filename = sidecar_filename
+        n = len(data)
+        self.level_sizes = []
+        while n > 1:
+            n = -(-n//factor)
+            self.level_sizes.append(n)
+        self.level_offsets = [int(o) for o in np.cumsum([0]+self.level_sizes)]
+        self.rec_dtype = np.dtype([('min', data.dtype), ('max', data.dtype), ('mean', np.float32)])
+        self.levels_data = None
+        if sidecar_filename is not None:
+            self._open_sidecar(data)
+        if self.levels_data is None:
+            self._build(quiet)
+    def _open_sidecar(self, data):
+        fn = self.sidecar_filename
+        if not os.path.isfile(fn):
+            return
+        try:
+            src_fn = data.filename
+        except AttributeError:
+            src_fn = None
+        if src_fn is not None and os.path.getmtime(fn) < os.path.getmtime(src_fn):
+            return
+        try:
+            levels = np.load(fn, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return
+        if levels.dtype != self.rec_dtype or levels.shape != (self.level_offsets[-1],):
+            return
+        self.levels_data = levels
+    def _build(self, quiet=False):
+        total = self.level_offsets[-1]
+        levels = None
+        tmp_filename = None
+        if self.sidecar_filename is not None:
+            # The file is built under a temporary name and renamed once complete
+            # so an interrupted build does not leave a partial (but valid looking) sidecar.
+            tmp_filename = self.sidecar_filename + '.tmp'
+            try:
+                levels = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=self.rec_dtype, shape=(total,))
+            except (IOError, OSError) as exc:
+                warnings.warn('Unable to create the pyramid file (%s). Keeping it in memory.'%exc)
+                tmp_filename = None
+        if levels is None:
+            levels = np.empty(total, dtype=self.rec_dtype)
+        if not quiet and len(self.data) > self._chunk_size:
+            print('Building the data overview pyramid (only done once)...')
+        try:
+            self._fill_levels(levels)
+            if tmp_filename is not None:
+                levels.flush()
+                del levels # close the memmap before the rename
+                try:
+                    replace = os.replace
+                except AttributeError: # python 2
+                    if os.path.exists(self.sidecar_filename):
+                        os.remove(self.sidecar_filename)
+                    replace = os.rename
+                replace(tmp_filename, self.sidecar_filename)
+                levels = np.load(self.sidecar_filename, mmap_mode='r')
+        except BaseException:
+            if tmp_filename is not None:
+                levels = None
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+            raise
+        self.levels_data = levels
+    def _fill_levels(self, levels):
+        prev_min = prev_max = self.data
+        prev_mean = None
+        prev_n = len(self.data)
+        f = self.factor
+        block = 1 # number of data points in a block of the previous level
+        # chunk is a multiple of factor
+        chunk = max(self._chunk_size//f, 1)*f
+        for k, n in enumerate(self.level_sizes):
+            lvl = levels[self.level_offsets[k]:self.level_offsets[k+1]]
+            for a in range(0, prev_n, chunk):
+                b = min(a+chunk, prev_n)
+                nfull = (b-a)//f
+                j0 = a//f
+                parts = []
+                if nfull:
+                    parts.append((a, a+nfull*f, nfull))
+                if nfull*f < b-a:
+                    parts.append((a+nfull*f, b, 1))
+                for pa, pb, m in parts:
+                    j = j0 if pa == a else j0+nfull
+                    mn = np.asarray(prev_min[pa:pb]).reshape((m, -1))
+                    mx = np.asarray(prev_max[pa:pb]).reshape((m, -1))
+                    lvl['min'][j:j+m] = mn.min(axis=1)
+                    lvl['max'][j:j+m] = mx.max(axis=1)
+                    if prev_mean is None:
+                        mean = mn.mean(axis=1, dtype=np.float64)
+                    else:
+                        mean_data = np.asarray(prev_mean[pa:pb], dtype=np.float64)
+                        # every child is block points, except the very last one of the level
+                        weights = np.full(pb-pa, float(block))
+                        if pb == prev_n:
+                            weights[-1] = len(self.data) - (prev_n-1)*block
+                        mean = (mean_data*weights).reshape((m, -1)).sum(axis=1) / weights.reshape((m, -1)).sum(axis=1)
+                    lvl['mean'][j:j+m] = mean
+            prev_min, prev_max, prev_mean = lvl['min'], lvl['max'], lvl['mean']
+            prev_n = n
+            block *= f
+    @property
+    def nlevels(self):
+        return len(self.level_sizes)
+    def level(self, k):
+        """ returns the structured array (min, max, mean) of level k>=1 """
+        return self.levels_data[self.level_offsets[k-1]:self.level_offsets[k]]
+    def choose_level(self, npts, ncols):
+        """ returns the smallest level that has less than 2*ncols blocks for npts points """
+        k = 0
+        while k < self.nlevels and npts/self.factor**k > 2*ncols:
+            k += 1
+        return k
+    def read(self, k, start, stop):
+        """
+        returns (bin_starts, mins, maxs, means) for the blocks of level k>=1
+        that contain data[start:stop].
+        """
+        bs = self.factor**k
+        j0 = max(start, 0)//bs
+        j1 = min(-(-stop//bs), self.level_sizes[k-1])
+        lvl = self.level(k)[j0:j1]
+        return np.arange(j0, j1)*bs, lvl['min'], lvl['max'], lvl['mean']
 
 class TraceLots(TraceBase):
     def __init__(self, filename, width=9.00, height=7.00, dpi=72,
-                 block_size=10*1024, dtype=np.uint8, trans=None):
+                 block_size=10*1024, dtype=np.uint8, trans=None,
+                 pyramid=True, pyramid_file=None, pyramid_factor=32):
         """
         This class allows the exploration of very large raw (binary) data file.
         The filename has to be provided.
-        block_size is the number of points to show at a time
-         (the slider will move in increments of half of this)
+        block_size is the number of points to show at a time initially
+         (the slider will move in increments of half of the current view)
         dtype is a numpy dtype for the data (uint8, uint16 ...)
         trans is a transformation function on the data.
               The function takes the read data as input and must return
-              the data to display.
+              the data to display. It is only applied to the data in view
+              (or to the block means when zoomed out).
               See lots_pick and lots_avg as possible functions
+        pyramid when True, a min/max/mean overview is built (see LotsPyramid)
+                which allows zooming out up to the full file (with the Overview button
+                or the toolbar) and then back down to the single samples.
+                It is saved in pyramid_file (defaults to filename+'.pyramid.npy')
+                and reused on the next opening.
+        pyramid_factor is the number of points (or blocks) combined from one level
+                to the next in the pyramid.
+        The x axis is the sample index in the file.
         """
         super(TraceLots, self).__init__(width=width, height=height, dpi=dpi)
         self.filename = filename
-        self.dtype = dtype
+        self.dtype = np.dtype(dtype)
         self.trans = trans
-        self.byte_per_point = 1
-        if dtype().nbytes == 2:
-            self.byte_per_point = 2
+        self.byte_per_point = self.dtype.itemsize
         self.block_nbpoints = block_size
         self.block_size = block_size*self.byte_per_point
-        self.fh = open(filename, 'rb')
+        if os.path.getsize(filename) < self.byte_per_point:
+            raise ValueError('File %s is too small.'%filename)
+        self.data = np.memmap(filename, dtype=self.dtype, mode='r')
+        self.nbpoints = len(self.data)
+        self.pyramid = None
+        if pyramid:
+            if pyramid_file is None:
+                pyramid_file = filename + '.pyramid.npy'
+            self.pyramid = LotsPyramid(self.data, pyramid_file, factor=pyramid_factor)
         ax = self.fig.add_subplot(111)
         self.ax = ax
-        self.fh.seek(0, 2) # go to end of file
-        self.nbpoints = self.fh.tell() // self.byte_per_point
-        self.readit() # sets self.vals
-        self.mainplot = ax.plot(self.vals)[0]
+        self.view = (0, min(block_size, self.nbpoints))
+        self.envelope = None
+        self.envelope_plot = None
+        self.mainplot = ax.plot([], [])[0]
         self.bar = QtGui.QScrollBar(QtCore.Qt.Horizontal)
-        self.bar.setMaximum(self.nbpoints//block_size*2 -1) # every step is half a block size
         self.bar_label = QtGui.QLabel()
         self.central_widget = QtGui.QWidget()
         self.central_layout = QtGui.QVBoxLayout()
@@ -773,22 +1311,91 @@ class TraceLots(TraceBase):
         self.central_layout.addWidget(self.bar_label)
         self.central_widget.setLayout(self.central_layout)
         self.MainWidget.setCentralWidget(self.central_widget)
+        if self.pyramid is not None:
+            self.overview_button = QtGui.QPushButton('Overview')
+            self.toolbar.addSeparator()
+            self.toolbar.addWidget(self.overview_button)
+            self.overview_button.clicked.connect(self.show_overview)
+        self._set_bar_range()
         self.bar.valueChanged.connect(self.bar_update)
-        self.bar_update(0)
+        ax.callbacks.connect('xlim_changed', self._xlim_changed)
+        ax.set_xlim(*self.view)
+        self._xlim_changed(ax)
+        self.draw()
+    def _view_width(self):
+        return max(self.view[1] - self.view[0], 2)
+    def _set_bar_range(self):
+        step = self._view_width()//2
+        self.bar.blockSignals(True)
+        self.bar.setMaximum(max(self.nbpoints//step - 1, 0)) # every step is half a view
+        self.bar.setValue(self.view[0]//step)
+        self.bar.blockSignals(False)
     def bar_update(self, val):
-        offset = val * self.block_nbpoints //2
-        self.bar_label.setText('offest: {:,}'.format(offset))
-        self.readit(offset)
-        self.update()
+        width = self._view_width()
+        offset = val * (width//2)
+        self.ax.set_xlim(offset, offset+width)
+        self.draw()
+    def show_overview(self):
+        self.ax.set_xlim(0, self.nbpoints)
+        self.draw()
+    def _xlim_changed(self, ax):
+        start, stop = ax.get_xlim()
+        start = int(np.floor(max(start, 0)))
+        stop = int(np.ceil(min(stop, self.nbpoints)))
+        if stop - start < 2:
+            return
+        self.view = (start, stop)
+        self._set_bar_range()
+        self.readit(start)
+        self.update(draw=False)
     def readit(self, offset=0):
-        self.fh.seek(offset*self.byte_per_point)
-        vals = np.fromfile(self.fh, dtype=self.dtype, count=self.block_size)
+        """ reads the data for the view starting at offset (sets self.vals, self.vals_x) """
+        start = max(offset, 0)
+        stop = min(start + self._view_width(), self.nbpoints)
+        k = 0
+        if self.pyramid is not None:
+            k = self.pyramid.choose_level(stop - start, _axes_ncols(self.ax))
+        if k == 0:
+            # only reads the part of the memory map in view
+            vals = np.array(self.data[start:stop])
+            self.envelope = None
+        else:
+            starts, mins, maxs, vals = self.pyramid.read(k, start, stop)
+            bs = self.pyramid.factor**k
+            self.envelope = (starts + bs/2., mins, maxs)
+            start = starts[0]
+            stop = starts[-1] + bs
+        npts = len(vals)
         if self.trans is not None:
             vals = self.trans(vals)
+        if len(vals) == npts:
+            x = np.arange(start, stop) if k == 0 else self.envelope[0]
+        else:
+            # trans changed the number of points, spread them over the range they come from
+            x = start + (np.arange(len(vals)) + .5)*(stop-start)/max(len(vals), 1)
+        self.vals_x = x
         self.vals = vals
-    def update(self):
-        self.mainplot.set_ydata(self.vals)
-        self.draw()
+        self.bar_label.setText('offset: {:,}   level: {}'.format(start, k))
+    def update(self, draw=True):
+        ax = self.ax
+        self.mainplot.set_data(self.vals_x, self.vals)
+        if self.envelope_plot is not None:
+            self.envelope_plot.remove()
+            self.envelope_plot = None
+        if self.envelope is not None:
+            x, mins, maxs = self.envelope
+            self.envelope_plot = ax.fill_between(x, mins, maxs, color=self.mainplot.get_color(),
+                                                 alpha=.3, linewidth=0, step='mid')
+            lo, hi = float(np.min(mins)), float(np.max(maxs))
+        elif len(self.vals):
+            lo, hi = float(np.min(self.vals)), float(np.max(self.vals))
+        else:
+            lo, hi = 0., 1.
+        if ax.get_autoscaley_on():
+            margin = max((hi-lo)*.05, 0.5)
+            ax.set_ylim(lo-margin, hi+margin, auto=True)
+        if draw:
+            self.draw()
 
 class TraceWater(TraceBase):
     def __init__(self, xy, y=None, width=9.00, height=7.00, dpi=72,
@@ -939,15 +1546,24 @@ def plot_time(x, *extrap, **extrak):
        Added Parameter:
         xrotation: which rotates the x ticks (defautls to 10 deg)
         xticksize: changes x axis thick size (defaults to 9)
+        decimate: when True, the lines are drawn using their min/max envelope
+                  at screen resolution (see MinMaxLine), recalculated on zoom/pan.
+                  The default (None) does it when there are more than 10000 points
+                  and x is sorted. Use False to disable.
     """
     x = _time2date(x)
     xrotation = extrak.pop('xrotation', 10)
     xticksize = extrak.pop('xticksize', 9)
+    decimate = extrak.pop('decimate', None)
     if _plot_date_discouraged:
         ret = pyplot.plot(x, *extrap, **extrak)
     else:
         ret = pyplot.plot_date(x, *extrap, **extrak)
     ax = ret[0].axes
+    if decimate or (decimate is None and np.size(x) > 10000):
+        for line in ret:
+            if decimate or _monotonic_order(np.asarray(line.get_xdata(orig=True))) != 0:
+                MinMaxLine(line)
     # Rotate axes ticks
     # could also use self.fig.autofmt_xdate()
     lbls = ax.get_xticklabels()
@@ -991,7 +1607,7 @@ def plot_time_stack(x, *ys, **kwargs):
        The ys can be a single 2D numpy array (first dim is line index, second is pt index)
         or a list of 1D array.
        The last ys can be a fmt argument (like ".-")
-       other kargs are passed to plot_time.
+       other kargs are passed to plot_time (like decimate).
        you can provide a labels argument and it will be applied to the graph (same shape as the data,
           use None to skip labels on an axes).
        It plots in the current figure. If the current figure already has enough
@@ -74,6 +74,7 @@ from scipy.special import gamma
 
 from pyHegel import qd_data
 from .qd_data import QD_Data
+from . import container
 
 try:
     try:
@@ -130,8 +131,13 @@ def read_comments(filename, comments='#', pick=None, before=False, skiprows=0, e
     count = 0
     skip_count = 0
     result = []
-    with io.open(filename, 'rt', encoding=encoding) as f:
-        for line in f:
+    f = None
+    if container.is_container(filename):
+        lines = container.read_container(filename).lines()
+    else:
+        lines = f = io.open(filename, 'rt', encoding=encoding)
+    try:
+        for line in lines:
             if skip_count < skiprows:
                 skip_count += 1
                 continue
@@ -162,6 +168,9 @@ def read_comments(filename, comments='#', pick=None, before=False, skiprows=0, e
                 # comment is probably on the end of a data line, make it point to this line.
                 result.append( (comment, count, timestamp) )
                 count += 1
+    finally:
+        if f is not None:
+            f.close()
     return result, count
 
 
@@ -292,6 +301,12 @@ def readfile(filename, prepend=None, getnames=False, getheaders=False, csv='auto
     If the file extension ends with .npy, it is read with np.load as a numpy
     file.
 
+    If the file extension is .phc, it is read as a binary container
+    (see the container module) and returns the same data as the equivalent text file.
+    To read the data of a device saved in the container (instead of separate files),
+    use opts=dict(dataset='dev_name') where dev_name is the column header of the device
+    (like 'dmm1.readval'). The result is the same as reading all the separate files.
+
     concatenante, when True, will merge rows from multiple files together.
       It can also be set to an integer to select the axes to merge (it
       is -1 when using True)
@@ -349,12 +364,25 @@ def readfile(filename, prepend=None, getnames=False, getheaders=False, csv='auto
         return
     elif len(filelist) > 1:
         print('Found %i files'%len(filelist))
-        multi = True
-    else:
-        multi = False
     hdrs = []
     titles = []
-    if dtype is None and not filelist[0].lower().endswith('.npy'): # binary files don't have headers
+    containers = {}
+    dataset = None
+    if container.is_container(filelist[0]):
+        opts = opts.copy()
+        dataset = opts.pop('dataset', None)
+        if dataset is not None and do_comments:
+            raise ValueError('comments are not available for a dataset')
+        cdata = containers[filelist[0]] = container.read_container(filelist[0])
+        if dataset is None:
+            if len(cdata.rows) == 0:
+                raise RuntimeError('File "%s" contains no data, except for possibly some headers'%filelist[0])
+            hdrs = cdata.headers
+        else:
+            hdrs = cdata.dataset_headers(dataset)
+        if len(hdrs): # at least one line, we use the last one, strip start # and end newline
+            titles = hdrs[-1][1:-1].split('\t')
+    elif dtype is None and not filelist[0].lower().endswith('.npy'): # binary files don't have headers
         with io.open(filelist[0], 'rt', encoding=encoding) as f: # only the first file
             while True:
                 line = f.readline()
@@ -379,12 +407,31 @@ def readfile(filename, prepend=None, getnames=False, getheaders=False, csv='auto
         do_reshape = lambda data, fn: data
     if concatenate is True:
         concatenate = -1
+    # sources is a list of (filename, data) where data is None for the files still to be read.
+    sources = []
+    for fn in filelist:
+        if container.is_container(fn):
+            if fn not in containers:
+                containers[fn] = container.read_container(fn)
+            if dataset is None:
+                sources.append((fn, containers[fn].data()))
+            else:
+                sources.extend([(fn, d) for d in containers[fn].dataset_data(dataset)])
+        else:
+            sources.append((fn, None))
+    if len(sources) == 0:
+        print('No data found')
+        return
+    multi = len(sources) > 1
     ret = []
     comments_array = []
     first_shape = None
     orig_ndim = None
-    for fn in filelist:
-        if dtype is not None:
+    for fn, current in sources:
+        if current is not None:
+            # already read (binary container)
+            pass
+        elif dtype is not None:
             current = np.fromfile(fn, dtype=dtype, **opts)
         elif fn.lower().endswith('.npy'):
             current = np.load(fn, **opts)
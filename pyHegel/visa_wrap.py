@@ -501,21 +501,57 @@ def _read_helper(self, termination='default', encoding=None, chunk_size=None):
     else:
         return msg.decode(encoding)
 
-def _read_raw_n_all_helper(self, count, chunk_size=None):
-    """ Read until count is obtained, possibly asking data in chunks of chunk (unless it is None)
+def _read_into_ctypes(vi_read, session, buf, offset, size):
+    """ Uses the viRead function to read up to size bytes directly into buf (a writable buffer
+        like a bytearray or a numpy array) starting at byte offset.
+        Returns the number of bytes read and True if the read stopped because of an end.
+    """
+    cbuf = (ctypes.c_ubyte * size).from_buffer(buf, offset)
+    ret_count = ctypes.c_uint32()
+    ret = vi_read(session, cbuf, size, _byref(ret_count))
+    return ret_count.value, ret != constants.VI_SUCCESS_MAX_CNT
+
+def _read_into_copy(data, end, buf, offset):
+    """ Same as _read_into_ctypes but for already read data (requires a copy) """
+    n = len(data)
+    if n:
+        cbuf = (ctypes.c_ubyte * n).from_buffer(buf, offset)
+        ctypes.memmove(cbuf, data, n)
+    return n, end
+
+def _read_raw_n_all_into_helper(self, buf, offset=0, count=None, chunk_size=None):
+    """ Read into the writable buffer buf (bytearray or contiguous numpy array) starting
+        at byte offset until count bytes are obtained (by default, until buf is full),
+        possibly asking data in chunks of chunk (unless it is None).
         It will pass through ends detected because of AttrVI_ATTR_ASRL_END_IN set to
           SerialTermination.termination_char
+        Returns True if the last read stopped because of an end.
     """
+    if count is None:
+        count = _buffer_nbytes(buf) - offset
     if chunk_size is None:
         chunk_size = count
     n_read = 0
-    result = bytearray(count)
+    end = False
     while n_read<count:
         chunk_size = min(chunk_size, count-n_read)
-        s = self.read_raw_n(chunk_size)
-        n = len(s)
-        result[n_read:n_read+n] = s
+        n, end = self.read_raw_n_into(buf, offset+n_read, chunk_size)
         n_read += n
+    return end
+
+def _buffer_nbytes(buf):
+    nbytes = getattr(buf, 'nbytes', None)
+    if nbytes is None:
+        nbytes = len(buf)
+    return nbytes
+
+def _read_raw_n_all_helper(self, count, chunk_size=None):
+    """ Read until count is obtained, possibly asking data in chunks of chunk (unless it is None)
+        It will pass through ends detected because of AttrVI_ATTR_ASRL_END_IN set to
+          SerialTermination.termination_char
+    """
+    result = bytearray(count)
+    self.read_raw_n_all_into(result, chunk_size=chunk_size)
     return result
 
 def _query_helper(self, message, termination='default', read_termination='default', write_termination='default', encoding=None, raw=False, chunk_size=None):
@@ -728,7 +764,16 @@ class old_Instrument(redirect_instr):
         finally:
             visa._removefilter("ignore", "VI_SUCCESS_MAX_CNT")
         return ret
+    def read_raw_n_into(self, buf, offset=0, size=None):
+        if size is None:
+            size = _buffer_nbytes(buf) - offset
+        try:
+            _warnings.filterwarnings("ignore", "VI_SUCCESS_MAX_CNT")
+            return _read_into_ctypes(vpp43.visa_library().viRead, self.vi, buf, offset, size)
+        finally:
+            visa._removefilter("ignore", "VI_SUCCESS_MAX_CNT")
     read_raw_n_all = _read_raw_n_all_helper
+    read_raw_n_all_into = _read_raw_n_all_into_helper
     def read_raw(self, size=None):
         # the pyvisa one does not have the size option
         # It uses self.chunk_size internally
@@ -865,7 +910,24 @@ class new_Instrument(redirect_instr):
     def read_raw_n(self, size):
         with self.ignore_warning(constants.VI_SUCCESS_MAX_CNT):
             return self.visalib.read(self.session, size)[0]
+    def read_raw_n_into(self, buf, offset=0, size=None):
+        """ Reads up to size bytes (default is to the end of buf) into buf at byte offset.
+            With the ctypes visa library, the data is transferred directly (no copies).
+            Returns the number of bytes read and True if the read stopped because of an end.
+        """
+        if size is None:
+            size = _buffer_nbytes(buf) - offset
+        # check if we are using the ctwrapper default backend
+        vi_read = getattr(self.visalib, 'viRead', None)
+        if vi_read is None:
+            vi_read = getattr(getattr(self.visalib, 'lib', None), 'viRead', None)
+        with self.ignore_warning(constants.VI_SUCCESS_MAX_CNT):
+            if vi_read is not None:
+                return _read_into_ctypes(vi_read, self.session, buf, offset, size)
+            data, status = self.visalib.read(self.session, size)
+        return _read_into_copy(data, status != constants.VI_SUCCESS_MAX_CNT, buf, offset)
     read_raw_n_all = _read_raw_n_all_helper
+    read_raw_n_all_into = _read_raw_n_all_into_helper
     get_ressource_impl_manuf_name = _get_ressource_impl_manuf_name
 
 